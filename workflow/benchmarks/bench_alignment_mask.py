@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Genes/minute of the native alignment mask, optionally checked against (and timed with)
+the qiime import/mask/export round trip.
+
+Usage:
+    bench_alignment_mask.py ( --alignment_fastas_dir=PATH ) [ --alignment_fastas_suffix=STR ] [ --sample_n_genes=INT ]
+                            [ --check_qiime ] [ --max_gap_frequency=FLOAT ] [ --min_conservation=FLOAT ]
+
+Options:
+    --alignment_fastas_dir=PATH    Dir with fasta alignments.
+    --alignment_fastas_suffix=STR  Suffix of the fasta alignments [default: .fasta].
+    --sample_n_genes=INT           Only use the first n alignments.
+    --check_qiime                  Also mask with qiime and assert identical masked alignments.
+    --max_gap_frequency=FLOAT      Max gap frequency of a kept column [default: 1.0].
+    --min_conservation=FLOAT       Min frequency of the most common non-gap character of a kept column [default: 0.4].
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+from alignment_mask import mask_alignment_file, read_alignment
+
+
+def qiime_mask(input_file, tmp_dir, max_gap_frequency, min_conservation):
+    name = os.path.join(tmp_dir, os.path.basename(input_file))
+    upper = name + '.upper.fasta'
+    headers, matrix = read_alignment(input_file)
+    with open(upper, 'w') as f:
+        for header, row in zip(headers, matrix):
+            f.write('>{}\n{}\n'.format(header, row.tobytes().decode()))
+    subprocess.run(['qiime', 'tools', 'import', '--input-path', upper, '--output-path', name + '.qza', '--type', 'FeatureData[AlignedSequence]'], check=True)
+    subprocess.run(['qiime', 'alignment', 'mask', '--i-alignment', name + '.qza', '--o-masked-alignment', name + '.masked.qza',
+                    '--p-max-gap-frequency', str(max_gap_frequency), '--p-min-conservation', str(min_conservation)], check=True)
+    subprocess.run(['qiime', 'tools', 'export', '--input-path', name + '.masked.qza', '--output-path', name + '.export'], check=True)
+    return os.path.join(name + '.export', 'aligned-dna-sequences.fasta')
+
+
+def alignment_rows(fasta_file):
+    headers, matrix = read_alignment(fasta_file)
+    return {header.split()[0]: row.tobytes() for header, row in zip(headers, matrix)}
+
+
+def main(alignment_fastas_dir, alignment_fastas_suffix, sample_n_genes=None, check_qiime=False, max_gap_frequency=1.0, min_conservation=0.4, *args, **kwargs):
+    max_gap_frequency, min_conservation = float(max_gap_frequency), float(min_conservation)
+    alignments = sorted(map(str, Path(alignment_fastas_dir).glob('*' + alignment_fastas_suffix)))
+    if sample_n_genes:
+        alignments = alignments[:int(sample_n_genes)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        native_files = []
+        for alignment in alignments:
+            native_files.append(os.path.join(tmp_dir, os.path.basename(alignment) + '.native.fasta'))
+            mask_alignment_file(alignment, native_files[-1], max_gap_frequency=max_gap_frequency, min_conservation=min_conservation)
+        native_time = time.perf_counter() - start
+        print('backend', 'genes', 'seconds', 'genes_per_minute', sep='\t')
+        print('native', len(alignments), f'{native_time:.2f}', f'{60 * len(alignments) / native_time:.1f}', sep='\t')
+
+        if check_qiime:
+            start = time.perf_counter()
+            qiime_files = [qiime_mask(alignment, tmp_dir, max_gap_frequency, min_conservation) for alignment in alignments]
+            qiime_time = time.perf_counter() - start
+            print('qiime', len(alignments), f'{qiime_time:.2f}', f'{60 * len(alignments) / qiime_time:.1f}', sep='\t')
+
+            for alignment, native_file, qiime_file in zip(alignments, native_files, qiime_files):
+                assert alignment_rows(native_file) == alignment_rows(qiime_file), 'Masked alignment differs from qiime: {}'.format(alignment)
+            print(f'# parity: {len(alignments)} masked alignments identical to qiime', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Compression of the alignment reduction (alignment_patterns.py) on simulated
+core-gene alignments (clonal groups of identical sequences, mostly constant
+columns) and a check that tree topologies do not change.
+
+Sequences evolve on a random tree (Jukes-Cantor like, --rate substitutions per
+site per unit of branch length), each simulated taxon is repeated in a clonal
+group of 1 to --max_copies identical rows. For every alignment:
+
+- the p-distances of the weighted site patterns are the ones of the full alignment
+  (of the distinct sequences) and the neighbor joining trees have the same splits;
+- the duplicates are grafted back as zero-length sisters of their representative;
+- with --raxml, raxmlHPC on the full alignment and on the reduced one (-a weights,
+  same seed) give the same topology once the duplicates are pruned (RF distance).
+
+Usage:
+    bench_alignment_reduction.py [ --genes=INT ] [ --taxa=INT ] [ --max_copies=INT ] [ --columns=INT ]
+                                 [ --rate=FLOAT ] [ --seed=INT ] [ --raxml ]
+
+Options:
+    --genes=INT        Simulated alignments [default: 5].
+    --taxa=INT         Distinct sequences of an alignment [default: 40].
+    --max_copies=INT   Max rows of a clonal group [default: 8].
+    --columns=INT      Columns of an alignment [default: 3000].
+    --rate=FLOAT       Substitutions per site per branch length unit [default: 0.01].
+    --seed=INT         Random seed [default: 42].
+    --raxml            Also compare raxmlHPC topologies (raxmlHPC on the PATH).
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+from Bio import Phylo
+from Bio.Phylo.TreeConstruction import DistanceMatrix, DistanceTreeConstructor
+
+import newick_stream
+from alignment_mask import read_alignment, write_alignment
+from alignment_patterns import reduce_alignment_file, read_duplicates, graft_tree_file
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def simulate_alignment(taxa, max_copies, columns, rate, rng):
+    """
+    (headers, matrix, clonal group of each header).
+    """
+    nodes = [rng.choice(BASES, columns)]
+    while len(nodes) < taxa:
+        parent = nodes.pop(rng.integers(len(nodes)))
+        for _ in range(2):
+            child = parent.copy()
+            mutated = rng.random(columns) < rate * rng.exponential(1.0)
+            child[mutated] = rng.choice(BASES, int(mutated.sum()))
+            nodes.append(child)
+    headers, rows, groups = [], [], []
+    for idx, sequence in enumerate(nodes):
+        for copy in range(rng.integers(1, max_copies + 1)):
+            headers.append('G{:03d}_{}'.format(idx, copy))
+            rows.append(sequence)
+            groups.append(idx)
+    order = rng.permutation(len(headers))
+    return [headers[i] for i in order], np.array(rows)[order], [groups[i] for i in order]
+
+
+def p_distances(matrix, weights):
+    distances = np.zeros((len(matrix), len(matrix)))
+    for idx, row in enumerate(matrix):
+        distances[idx] = ((matrix != row) * weights).sum(axis=1) / weights.sum()
+    return distances
+
+
+def nj_newick(headers, distances):
+    lower = [list(distances[idx, :idx + 1]) for idx in range(len(headers))]
+    tree = DistanceTreeConstructor().nj(DistanceMatrix(list(headers), lower))
+    for clade in tree.get_nonterminals():
+        clade.name = None
+    return tree.format('newick')
+
+
+def splits(tree, bits):
+    counts, _ = newick_stream.count_splits(io.StringIO(tree), bits)
+    return set(counts)
+
+
+def pruned(tree, keep):
+    tree = Phylo.read(io.StringIO(tree), 'newick')
+    for leaf in tree.get_terminals():
+        if leaf.name not in keep:
+            tree.prune(leaf)
+    return tree.format('newick')
+
+
+def raxml_tree(fasta_file, work_dir, name, weights_file=None):
+    cmd = ['raxmlHPC', '-m', 'GTRCAT', '-p', '1723', '-s', fasta_file, '-n', name, '-w', work_dir]
+    if weights_file:
+        cmd += ['-a', weights_file]
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(work_dir, 'RAxML_bestTree.' + name)) as f:
+        return f.read(), time.perf_counter() - start
+
+
+def main(genes, taxa, max_copies, columns, rate, seed, raxml, *args, **kwargs):
+    rng = np.random.default_rng(int(seed))
+    print('gene', 'rows', 'unique_rows', 'columns', 'patterns', 'cell_ratio', 'reduce_seconds', 'nj_same', 'raxml_rf', 'raxml_speedup', sep='\t')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for gene in range(int(genes)):
+            headers, matrix, groups = simulate_alignment(int(taxa), int(max_copies), int(columns), float(rate), rng)
+            fasta_file = os.path.join(tmp_dir, 'gene_{}.fasta'.format(gene))
+            write_alignment(headers, matrix, fasta_file)
+
+            start = time.perf_counter()
+            prefix = os.path.join(tmp_dir, 'gene_{}.reduced'.format(gene))
+            sizes = reduce_alignment_file(fasta_file, prefix)
+            reduce_seconds = time.perf_counter() - start
+
+            reduced_headers, reduced = read_alignment(prefix + '.fasta')
+            with open(prefix + '.weights') as f:
+                weights = np.array(f.read().split(), dtype=np.int64)
+            duplicates = read_duplicates(prefix + '.duplicates.tsv')
+            assert len(reduced_headers) == len(set(groups)), 'Clonal groups not collapsed.'
+            assert all(groups[headers.index(dup)] == groups[headers.index(rep)] for rep, dups in duplicates.items() for dup in dups)
+
+            # Pattern compression: same distances, same neighbor joining tree.
+            keep = [headers.index(header) for header in reduced_headers]
+            full_distances = p_distances(matrix[keep], np.ones(matrix.shape[1], dtype=np.int64))
+            assert np.allclose(full_distances, p_distances(reduced, weights)), 'Weighted pattern distances differ.'
+            full_tree, reduced_tree = nj_newick(reduced_headers, full_distances), nj_newick(reduced_headers, p_distances(reduced, weights))
+            bits = newick_stream.leaf_bits(reduced_tree)
+            nj_same = splits(full_tree, bits) == splits(reduced_tree, bits)
+
+            # Duplicates grafted back as zero-length sisters.
+            with open(prefix + '.nj.tree', 'w') as f_out:
+                f_out.write(reduced_tree)
+            graft_tree_file(prefix + '.nj.tree', prefix + '.duplicates.tsv', prefix + '.nj.grafted.tree')
+            with open(prefix + '.nj.grafted.tree') as f:
+                grafted = Phylo.read(f, 'newick')
+            assert sorted(leaf.name for leaf in grafted.get_terminals()) == sorted(headers), 'Grafted tree leaves differ.'
+            for rep, dups in duplicates.items():
+                clade = grafted.common_ancestor(rep, *dups)
+                assert len(clade.get_terminals()) == 1 + len(dups), 'Duplicates of {} are not its sisters.'.format(rep)
+                assert all(leaf.branch_length == 0 for leaf in clade.get_terminals())
+
+            raxml_rf, speedup = '', ''
+            if raxml:
+                full_raxml, full_seconds = raxml_tree(fasta_file, tmp_dir, 'full{}'.format(gene))
+                reduced_raxml, reduced_seconds = raxml_tree(prefix + '.fasta', tmp_dir, 'reduced{}'.format(gene), prefix + '.weights')
+                full_splits, reduced_splits = splits(pruned(full_raxml, set(reduced_headers)), bits), splits(reduced_raxml, bits)
+                raxml_rf = len(full_splits ^ reduced_splits)
+                speedup = f'{full_seconds / reduced_seconds:.1f}'
+
+            print(gene, sizes['rows'], sizes['unique_rows'], sizes['columns'], sizes['patterns'],
+                  f"{sizes['rows'] * sizes['columns'] / (sizes['unique_rows'] * sizes['patterns']):.1f}",
+                  f'{reduce_seconds:.3f}', nj_same, raxml_rf, speedup, sep='\t', flush=True)
+            assert nj_same, 'Neighbor joining topology changed by the reduction.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
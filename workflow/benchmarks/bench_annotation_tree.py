@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Seconds to list the pancluster fastas of a prokka-like tree (one dir per genome)
+with Path.rglob, with AnnotationTree without a cache (first run), with an up to
+date cache and with a cache where a few genome dirs changed.
+
+Usage:
+    bench_annotation_tree.py [ --genomes=INT ] [ --changed=INT ] [ --work_dir=PATH ]
+
+Options:
+    --genomes=INT     Genome dirs in the tree [default: 15000].
+    --changed=INT     Genome dirs changed before the last run [default: 10].
+    --work_dir=PATH   Dir for the tree (e.g. on the network filesystem), temporary dir if not given.
+"""
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+from annotation_tree import AnnotationTree, CACHE_NAME
+
+SUFFIX = '.panclusters.fa.gz'
+PROKKA_FILES = ('.gbk.gz', '.gff', '.faa', '.ffn', SUFFIX, SUFFIX + '.fai', SUFFIX + '.gzi')
+
+
+def make_tree(root, genomes):
+    old = time.time() - 3600
+    for idx in range(genomes):
+        genome_dir = os.path.join(root, 'G{:06d}'.format(idx))
+        os.makedirs(genome_dir)
+        for suffix in PROKKA_FILES:
+            open(os.path.join(genome_dir, 'G{:06d}{}'.format(idx, suffix)), 'w').close()
+        os.utime(genome_dir, (old, old))
+    os.utime(root, (old, old))
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main(genomes, changed, work_dir, *args, **kwargs):
+    with tempfile.TemporaryDirectory(dir=work_dir) as root, tempfile.TemporaryDirectory() as output_dir:
+        make_tree(root, int(genomes))
+        cache_file = os.path.join(output_dir, CACHE_NAME)
+
+        results = {}
+        results['rglob'] = timed(lambda: sorted(str(path) for path in Path(root).rglob('*' + SUFFIX)))
+        results['no_cache'] = timed(lambda: sorted(AnnotationTree(root, cache_file=cache_file).files(SUFFIX)))
+        results['cache'] = timed(lambda: sorted(AnnotationTree(root, cache_file=cache_file).files(SUFFIX)))
+        for idx in range(int(changed)):
+            open(os.path.join(root, 'G{:06d}'.format(idx), 'new_file'), 'w').close()
+        results['cache_changed'] = timed(lambda: sorted(AnnotationTree(root, cache_file=cache_file).files(SUFFIX)))
+
+        cache_mb = os.path.getsize(cache_file) / 2**20
+
+    print('listing', 'seconds', 'files', sep='\t')
+    for name, (elapsed, files) in results.items():
+        print(name, f'{elapsed:.2f}', len(files), sep='\t')
+    print('cache_mb', f'{cache_mb:.1f}', sep='\t')
+    assert all(files == results['rglob'][1] for _, files in results.values()), 'Listings differ.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
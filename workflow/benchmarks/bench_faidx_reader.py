@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare records/second of the native BGZF/faidx reader against one 'samtools faidx' call per record.
+
+Usage:
+    bench_faidx_reader.py ( --fastas_list=PATH ) [ --records=N ] [ --seed=N ]
+
+Options:
+    -f --fastas_list=PATH   File with the paths of indexed '.panclusters.fa.gz' files (one per line).
+    -n --records=N          Number of records to sample from the '.fai' indexes [default: 2000].
+    -s --seed=N             Random seed for the sampled records [default: 42].
+"""
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+from bgzf_fasta import IndexedFastaPool, read_fai
+from root_core_cluster import extract_record_from_fasta_faidx
+
+
+def main(fastas_list, records, seed, *args, **kwargs):
+    with open(fastas_list, 'r') as f:
+        fastas = [line.strip() for line in f if line.strip()]
+
+    candidates = [(fasta, record_id) for fasta in fastas for record_id in read_fai(fasta + '.fai')]
+    random.seed(int(seed))
+    requests = random.sample(candidates, min(int(records), len(candidates)))
+
+    start = time.perf_counter()
+    subprocess_records = [extract_record_from_fasta_faidx(fasta, record_id) for fasta, record_id in requests]
+    subprocess_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pool = IndexedFastaPool()
+    native_records = pool.fetch_many(requests)
+    pool.close()
+    native_time = time.perf_counter() - start
+
+    assert subprocess_records == native_records, 'Native reader output differs from samtools faidx.'
+
+    print('backend', 'records', 'seconds', 'records_per_second', sep='\t')
+    print('samtools', len(requests), f'{subprocess_time:.3f}', f'{len(requests) / subprocess_time:.1f}', sep='\t')
+    print('native', len(requests), f'{native_time:.3f}', f'{len(requests) / native_time:.1f}', sep='\t')
+    print(f'# speedup: {subprocess_time / native_time:.1f}x', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Check the streaming CDS extractor against Bio.SeqIO and compare per-genome throughput.
+
+Usage:
+    bench_gbk_cds.py ( --gbk_list=PATH ) [ --genomes=N ]
+
+Options:
+    -g --gbk_list=PATH   File with the paths of prokka '.gbk.gz' files (one per line).
+    -n --genomes=N       Only use the first N genomes of the list.
+"""
+
+import os
+import sys
+import gzip
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from Bio import SeqIO
+from docopt import docopt
+
+from gbk_cds import iter_cds_from_file
+
+
+def biopython_cds(gbk_file: str) -> list:
+    with gzip.open(gbk_file, 'rt') as f:
+        return [
+            (feature.qualifiers['locus_tag'][0], str(feature.location.extract(record).seq))
+            for record in SeqIO.parse(f, 'genbank')
+            for feature in record.features
+            if feature.type == 'CDS' and feature.qualifiers.get('locus_tag', None)
+        ]
+
+
+def main(gbk_list, genomes=None, *args, **kwargs):
+    with open(gbk_list, 'r') as f:
+        gbk_files = [line.strip() for line in f if line.strip()]
+    if genomes:
+        gbk_files = gbk_files[:int(genomes)]
+
+    biopython_time = streaming_time = 0.0
+    cds_count = 0
+    print('genome', 'cds', 'biopython_seconds', 'streaming_seconds', sep='\t')
+    for gbk_file in gbk_files:
+        start = time.perf_counter()
+        expected = biopython_cds(gbk_file)
+        genome_biopython = time.perf_counter() - start
+
+        start = time.perf_counter()
+        observed = list(iter_cds_from_file(gbk_file))
+        genome_streaming = time.perf_counter() - start
+
+        assert observed == expected, 'Streaming CDS differ from Bio.SeqIO: {}'.format(gbk_file)
+
+        biopython_time += genome_biopython
+        streaming_time += genome_streaming
+        cds_count += len(observed)
+        print(os.path.basename(gbk_file), len(observed), f'{genome_biopython:.3f}', f'{genome_streaming:.3f}', sep='\t')
+
+    print(f'# genomes: {len(gbk_files)}  cds: {cds_count}', file=sys.stderr)
+    print(f'# biopython: {len(gbk_files) / biopython_time:.2f} genomes/s', file=sys.stderr)
+    print(f'# streaming: {len(gbk_files) / streaming_time:.2f} genomes/s ({biopython_time / streaming_time:.1f}x)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Wall time and peak RSS of the panaroo Rtab/csv loaders of get_pangenome_genes.py
+(columnar loader against the previous readlines/dict implementation).
+
+Usage:
+    bench_panaroo_loader.py ( --panaroo_results_preffix=PATH ) [ --coregenome_threshold=FLOAT ]
+
+Options:
+    -i --panaroo_results_preffix=PATH   Prefix of the panaroo '.Rtab' and '.csv' tables.
+    -c --coregenome_threshold=FLOAT     Core genome threshold [default: 0.95].
+"""
+
+import os
+import sys
+import time
+import resource
+from multiprocessing import Process, Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+import get_pangenome_genes
+
+
+def legacy_loader(panaroo_results_preffix: str, coregenome_threshold: float) -> dict:
+    with open(panaroo_results_preffix + '.Rtab', 'r') as f:
+        file_lines = iter(map(lambda x: x.strip().split('\t'), f.readlines()))
+        header = next(file_lines)
+        min_persistence = get_pangenome_genes.get_min_persistence(coregenome_threshold, len(header) - 1)
+        cluster_names = set(map(lambda x: x[0], filter(lambda x: x.count('0') < min_persistence, file_lines)))
+
+    data = {}
+    with open(panaroo_results_preffix + '.csv', 'r') as f:
+        file_lines = iter(map(lambda x: x.strip().split(','), f.readlines()))
+        data['columns'] = next(file_lines)
+        for i in filter(lambda x: x[0] in cluster_names, file_lines):
+            data[i[0]] = i
+    clusters_names = [i for i in data.keys() if i != 'columns']
+    return {
+        genome_id: dict(map(lambda x: (data[x][idx], x), clusters_names))
+        for idx, genome_id in tuple(enumerate(data['columns']))[3:]
+    }
+
+
+def columnar_loader(panaroo_results_preffix: str, coregenome_threshold: float) -> dict:
+    cluster_names = get_pangenome_genes.get_cluster_names(panaroo_results_preffix + '.Rtab', coregenome_threshold)
+    table = get_pangenome_genes.get_coregenome_data(panaroo_results_preffix + '.csv', cluster_names)
+    return {
+        genome_id: get_pangenome_genes.genome_locustags(table, idx)
+        for idx, genome_id in enumerate(table.genome_ids)
+    }
+
+
+def columnar_load_only(panaroo_results_preffix: str, coregenome_threshold: float):
+    cluster_names = get_pangenome_genes.get_cluster_names(panaroo_results_preffix + '.Rtab', coregenome_threshold)
+    return get_pangenome_genes.get_coregenome_data(panaroo_results_preffix + '.csv', cluster_names)
+
+
+LOADERS = {
+    'legacy': legacy_loader,
+    'columnar_table': columnar_load_only,
+    'columnar_all_lookups': columnar_loader,
+}
+
+
+def run_loader(name: str, panaroo_results_preffix: str, coregenome_threshold: float, queue: Queue) -> None:
+    start = time.perf_counter()
+    result = LOADERS[name](panaroo_results_preffix, coregenome_threshold)
+    elapsed = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    signature = sorted((k, sorted(v.items())) for k, v in result.items()) if isinstance(result, dict) else None
+    queue.put((name, elapsed, peak_rss_mb, hash(str(signature)) if signature is not None else None))
+
+
+def main(panaroo_results_preffix, coregenome_threshold, *args, **kwargs):
+    coregenome_threshold = float(coregenome_threshold)
+    results = []
+    for name in LOADERS:
+        queue = Queue()
+        process = Process(target=run_loader, args=(name, panaroo_results_preffix, coregenome_threshold, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    print('loader', 'seconds', 'peak_rss_mb', sep='\t')
+    for name, elapsed, peak_rss_mb, _ in results:
+        print(name, f'{elapsed:.2f}', f'{peak_rss_mb:.1f}', sep='\t')
+
+    signatures = {name: signature for name, _, _, signature in results if signature is not None}
+    assert signatures['legacy'] == signatures['columnar_all_lookups'], 'Columnar lookups differ from the legacy loader.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
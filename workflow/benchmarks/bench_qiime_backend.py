@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Per-gene overhead of the qiime2 'cli' and 'api' backends of convert_mask_and_run_phylogeny.py:
+import of the (natively masked) alignment, optional qiime mask, and export of the
+artifact, on a pool of workers (warm interpreters for 'api').
+
+Usage:
+    bench_qiime_backend.py ( --alignment_fastas_dir=PATH ) [ --alignment_fastas_suffix=STR ] [ --sample_n_genes=INT ]
+                           [ --workers=INT ] [ --with_mask ]
+
+Options:
+    --alignment_fastas_dir=PATH    Dir with fasta alignments.
+    --alignment_fastas_suffix=STR  Suffix of the fasta alignments [default: .fasta].
+    --sample_n_genes=INT           Only use the first n alignments [default: 50].
+    --workers=INT                  Worker processes per backend [default: 4].
+    --with_mask                    Also run 'alignment mask' on the imported artifact.
+"""
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+import convert_mask_and_run_phylogeny as phylogeny
+
+
+def gene_round_trip(input_file, output_dir, backend, with_mask):
+    start = time.perf_counter()
+    qza_file = os.path.join(output_dir, os.path.basename(input_file) + '.qza')
+    phylogeny.qiime2_import_alignment(input_file, qza_file, backend=backend)
+    if with_mask:
+        qza_file = phylogeny.mask_alignments(qza_file, output_dir, backend=backend)
+    export_dir = qza_file.replace('.qza', '.export')
+    if backend == 'api':
+        phylogeny.qiime2_api()['Artifact'].load(qza_file).export_data(export_dir)
+    else:
+        phylogeny.subprocess.run(['qiime', 'tools', 'export', '--input-path', qza_file, '--output-path', export_dir], check=True)
+    return time.perf_counter() - start
+
+
+def run_backend(backend, input_files, workers, with_mask):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        initializer = phylogeny.qiime2_api if backend == 'api' else None
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as executor:
+            per_gene = list(executor.map(partial(gene_round_trip, output_dir=tmp_dir, backend=backend, with_mask=with_mask), input_files))
+        return time.perf_counter() - start, per_gene
+
+
+def main(alignment_fastas_dir, alignment_fastas_suffix, sample_n_genes, workers, with_mask, *args, **kwargs):
+    input_files = sorted(map(str, Path(alignment_fastas_dir).glob('*' + alignment_fastas_suffix)))[:int(sample_n_genes)]
+    assert input_files, 'No alignments found in {}'.format(alignment_fastas_dir)
+
+    print('backend', 'genes', 'wall_seconds', 'mean_gene_seconds', 'genes_per_minute', sep='\t')
+    for backend in ('cli', 'api'):
+        wall, per_gene = run_backend(backend, input_files, int(workers), with_mask)
+        print(backend, len(per_gene), f'{wall:.2f}', f'{sum(per_gene) / len(per_gene):.3f}', f'{60 * len(per_gene) / wall:.1f}', sep='\t')
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
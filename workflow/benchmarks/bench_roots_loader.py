@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Seconds and peak RSS to load the roots of one species from genus-wide roots
+tables of growing size: read_roots of root_core_cluster.py (whole table),
+read_specie_roots of roots_index.py when the index has to be built (first run)
+and when it already exists (every later run). Both must give the same roots.
+
+Usage:
+    bench_roots_loader.py [ --rows=STR ] [ --species=INT ] [ --members=INT ] [ --seed=INT ]
+
+Options:
+    --rows=STR       Comma separated table sizes (rows) [default: 100000,1000000,4000000].
+    --species=INT    Species in the genus [default: 20].
+    --members=INT    Members of each root cluster [default: 8].
+    --seed=INT       Random seed [default: 42].
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+
+def write_roots_table(roots_file, rows, species, members, rng):
+    names = ['Specie_{:03d}'.format(idx) for idx in range(species)]
+    with open(roots_file, 'w') as f_out:
+        for cluster_idx in range(rows // members):
+            root = '{}#group_{}'.format(rng.choice(names), cluster_idx)
+            f_out.writelines('{}\t{}#{}_{}\n'.format(root, rng.choice(names), 'refound', cluster_idx * members + idx) for idx in range(members))
+    return names[0]
+
+
+def load(loader, roots_file, specie, queue):
+    start = time.perf_counter()
+    if loader == 'full':
+        from root_core_cluster import read_roots
+        roots = {k: v for k, v in read_roots(roots_file).items() if k.startswith(specie + '#')}
+    else:
+        from roots_index import read_specie_roots
+        roots = read_specie_roots(roots_file, specie)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, roots))
+
+
+def run(loader, roots_file, specie):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=load, args=(loader, roots_file, specie, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(rows, species, members, seed, *args, **kwargs):
+    rng = random.Random(int(seed))
+    print('rows', 'loader', 'seconds', 'peak_rss_mb', 'root_clusters', sep='\t')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for table_rows in map(int, rows.split(',')):
+            roots_file = os.path.join(tmp_dir, 'roots.{}.tsv'.format(table_rows))
+            specie = write_roots_table(roots_file, table_rows, int(species), int(members), rng)
+            results = {}
+            for loader in ('full', 'index_build', 'index'):
+                results[loader] = run(loader, roots_file, specie)
+                elapsed, peak_rss_mb, roots = results[loader]
+                print(table_rows, loader, f'{elapsed:.2f}', f'{peak_rss_mb:.1f}', len(roots), sep='\t', flush=True)
+            assert results['full'][2] == results['index_build'][2] == results['index'][2], 'Roots differ between loaders.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
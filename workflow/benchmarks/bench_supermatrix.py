@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Seconds and peak RSS of supermatrix.py on simulated run_msa.py outputs (a
+manifest and one alignment per cluster, each genome present in a cluster with
+probability --occupancy), compared with concatenating the alignments in memory
+({genome: [sequences]}). Both must give the same matrix.
+
+Usage:
+    bench_supermatrix.py [ --clusters=INT ] [ --genomes=INT ] [ --columns=INT ] [ --occupancy=FLOAT ]
+                         [ --threads=INT ] [ --seed=INT ]
+
+Options:
+    --clusters=INT      Cluster alignments [default: 2000].
+    --genomes=INT       Genomes [default: 300].
+    --columns=INT       Mean columns of an alignment [default: 1000].
+    --occupancy=FLOAT   Probability of a genome to be in a cluster [default: 0.9].
+    --threads=INT       Workers of supermatrix.py [default: 4].
+    --seed=INT          Random seed [default: 42].
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+
+def write_msa_outputs(work_dir, clusters, genomes, columns, occupancy, rng):
+    fasta_dir, aln_dir = os.path.join(work_dir, 'fastas'), os.path.join(work_dir, 'alignments')
+    os.makedirs(aln_dir)
+    genome_ids = ['GCF_{:09d}.1'.format(idx) for idx in range(genomes)]
+    manifest_file = os.path.join(work_dir, 'renamed_fasta_names.csv')
+    with open(manifest_file, 'w') as manifest:
+        for idx in range(clusters):
+            core_cluster = 'group_{}'.format(idx)
+            fasta_file = os.path.join(fasta_dir, 'Klebsiella_pneumoniae.{}.{:016x}.fasta'.format(core_cluster, idx))
+            manifest.write('{},{},{}\n'.format(core_cluster, fasta_file, rng.choice(('rooted', 'unrooted'))))
+            length = max(1, int(rng.expovariate(1 / columns)))
+            with open(os.path.join(aln_dir, os.path.basename(fasta_file).replace('.fasta', '.aln.fasta')), 'w') as f_out:
+                for genome in genome_ids:
+                    if rng.random() < occupancy:
+                        f_out.write('>{}#{}\n{}\n'.format(genome, core_cluster, ''.join(rng.choices('acgt-', k=length))))
+    return manifest_file, aln_dir
+
+
+def in_memory(manifest_file, aln_dir, output_prefix, threads):
+    from supermatrix import list_clusters, genome_id
+    from alignment_mask import read_alignment
+    rows, total = {}, 0
+    for _, aln_file in list_clusters(manifest_file, aln_dir):
+        headers, matrix = read_alignment(aln_file)
+        for header, row in zip(headers, matrix):
+            rows.setdefault(genome_id(header), []).append((total, row.tobytes()))
+        total += matrix.shape[1]
+    with open(output_prefix + '.fasta', 'wb') as f_out:
+        for genome in sorted(rows):
+            sequence = bytearray(b'-' * total)
+            for start, row in rows[genome]:
+                sequence[start:start + len(row)] = row
+            f_out.write(b'>' + genome.encode() + b'\n' + bytes(sequence) + b'\n')
+
+
+def streaming(manifest_file, aln_dir, output_prefix, threads):
+    from supermatrix import build
+    build(manifest_file, aln_dir, output_prefix, threads=threads)
+
+
+def run(builder, args, queue):
+    start = time.perf_counter()
+    builder(*args)
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put((time.perf_counter() - start, usage / 1024))
+
+
+def measure(builder, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run, args=(builder, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(clusters, genomes, columns, occupancy, threads, seed, *args, **kwargs):
+    rng = random.Random(int(seed))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_file, aln_dir = write_msa_outputs(tmp_dir, int(clusters), int(genomes), int(columns), float(occupancy), rng)
+        print('builder', 'seconds', 'peak_rss_mb', 'matrix_mb', sep='\t')
+        outputs = []
+        for name, builder in (('in_memory', in_memory), ('supermatrix', streaming)):
+            output_prefix = os.path.join(tmp_dir, name)
+            seconds, peak_rss_mb = measure(builder, manifest_file, aln_dir, output_prefix, int(threads))
+            outputs.append(output_prefix + '.fasta')
+            print(name, f'{seconds:.2f}', f'{peak_rss_mb:.1f}', f'{os.path.getsize(outputs[-1]) / 2**20:.1f}', sep='\t', flush=True)
+        with open(outputs[0], 'rb') as f_memory, open(outputs[1], 'rb') as f_stream:
+            assert f_memory.read() == f_stream.read(), 'Supermatrices differ.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
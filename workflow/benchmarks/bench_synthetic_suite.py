@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Wall time, throughput and peak RSS of the workflow scripts on synthetic data
+(synthetic_data.py) at several scales, so scaling curves can be compared
+between commits. 'bgzip' and 'samtools' are replaced by in-process stubs on PATH.
+
+Each benchmark runs as a child process; its peak RSS is the ru_maxrss of
+wait4 (the child and the workers it waited for). Results are printed as tsv
+and appended to --output when given (commit, scale, benchmark, items,
+seconds, items_per_second, peak_rss_mb, returncode).
+
+Usage:
+    bench_synthetic_suite.py ( --work_dir=PATH ) [ --scales=STR ] [ --benchmarks=STR ] [ --species=N ]
+                             [ --trees=N ] [ --threads=N ] [ --seed=N ] [ --output=PATH ]
+
+Options:
+    --work_dir=PATH     Dir for the generated data (reused between runs) and the outputs.
+    --scales=STR        Comma separated GENOMESxCLUSTERS scales [default: 20x100,50x200,100x400].
+    --benchmarks=STR    Comma separated benchmarks to run [default: all].
+    --species=N         Species in the synthetic genus [default: 3].
+    --trees=N           Gene trees of each scale [default: 200].
+    --threads=N         Threads given to the scripts [default: 4].
+    --seed=N            Random seed [default: 42].
+    --output=PATH       Append the results to this tsv.
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+from glob import glob
+
+from docopt import docopt
+
+import synthetic_data
+import stage_trace
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARKS_DIR, '..', 'scripts')
+
+STUB_BGZIP = '''#!{python}
+import os, sys
+sys.path.insert(0, {benchmarks_dir!r})
+from synthetic_data import write_bgzf
+fasta_file = sys.argv[-1]
+with open(fasta_file, 'rb') as f:
+    write_bgzf(fasta_file + '.gz', f.read())
+os.remove(fasta_file + '.gz.gzi')
+os.remove(fasta_file)
+'''
+
+STUB_SAMTOOLS = '''#!{python}
+import sys, gzip
+sys.path.insert(0, {benchmarks_dir!r})
+from synthetic_data import fai_lines
+assert sys.argv[1] == 'faidx' and len(sys.argv) == 3, 'samtools stub only indexes: samtools faidx FASTA'
+fasta_file = sys.argv[2]
+opener = gzip.open if fasta_file.endswith('.gz') else open
+with opener(fasta_file, 'rb') as f, open(fasta_file + '.fai', 'w') as f_out:
+    f_out.writelines(fai_lines(f.read()))
+'''
+
+HEADER = ('commit', 'scale', 'benchmark', 'items', 'seconds', 'items_per_second', 'peak_rss_mb', 'returncode')
+
+
+def write_stubs(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, template in (('bgzip', STUB_BGZIP), ('samtools', STUB_SAMTOOLS)):
+        stub = os.path.join(bin_dir, name)
+        with open(stub, 'w') as f_out:
+            f_out.write(template.format(python=sys.executable, benchmarks_dir=BENCHMARKS_DIR))
+        os.chmod(stub, 0o755)
+
+
+def dataset(work_dir, genomes, clusters, species, trees, seed):
+    data_dir = os.path.join(work_dir, 'data', '{}x{}.s{}.t{}.seed{}'.format(genomes, clusters, species, trees, seed))
+    done = os.path.join(data_dir, '.done')
+    if not os.path.exists(done):
+        shutil.rmtree(data_dir, ignore_errors=True)
+        start = time.perf_counter()
+        synthetic_data.generate(data_dir, genomes=genomes, clusters=clusters, species=species, trees=trees, seed=seed)
+        open(done, 'w').close()
+        print('# generated {} in {:.1f}s'.format(data_dir, time.perf_counter() - start), file=sys.stderr)
+    return data_dir
+
+
+def count_lines(path):
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+
+
+def get_pangenome_genes(data_dir, out_dir, threads):
+    # Outputs go next to the GenBank files: remove them so every run rebuilds.
+    for output in glob(os.path.join(data_dir, 'annotation', '*', '*.panclusters.fa*')):
+        os.remove(output)
+    cmd = script('get_pangenome_genes.py') + [
+        '--panaroo_results_preffix', os.path.join(data_dir, 'panaroo', 'gene_presence_absence'),
+        '--coregenome_threshold', '0.95',
+        '--annotation_path_list', os.path.join(data_dir, 'annotation_list.txt'),
+        '--threads', str(threads),
+    ]
+    return cmd, count_lines(os.path.join(data_dir, 'annotation_list.txt')), None
+
+
+def root_core_cluster(data_dir, out_dir, threads):
+    cmd = script('root_core_cluster.py') + [
+        '--panaroo_genus_dir', os.path.join(data_dir, 'genus'),
+        '--specie', synthetic_data.MAIN_SPECIE,
+        '--roots_file', os.path.join(data_dir, 'roots.tsv'),
+        '--annotation_dir', os.path.join(data_dir, 'panclusters'),
+        '--panaroo_dir', os.path.join(data_dir, 'panaroo'),
+        '--fasta_suffix', '.panclusters.fa.gz',
+        '--output_dir', out_dir,
+        '--core_clusters_file', os.path.join(data_dir, 'core_clusters.txt'),
+        '--threads', str(threads),
+    ]
+    return cmd, count_lines(os.path.join(data_dir, 'core_clusters.txt')), None
+
+
+def assembly_msa_input(data_dir, out_dir, threads):
+    cmd = script('assembly_msa_input.py') + [
+        '--annotation_dir', os.path.join(data_dir, 'panclusters'),
+        '--panaroo_dir', os.path.join(data_dir, 'panaroo'),
+        '--fasta_suffix', '.panclusters.fa.gz',
+        '--output_dir', out_dir,
+        '--specie', synthetic_data.MAIN_SPECIE,
+        '--core_clusters_file', os.path.join(data_dir, 'core_clusters.txt'),
+        '--threads', str(threads),
+        '--genome_major',
+    ]
+    return cmd, count_lines(os.path.join(data_dir, 'core_clusters.txt')), None
+
+
+def dist2fastme(data_dir, out_dir, threads):
+    cmd = script('dist2fastme.py') + [os.path.join(data_dir, 'mash', 'dist.tsv'), os.path.join(data_dir, 'mash', 'mask.tsv'), str(threads)]
+    return cmd, count_lines(os.path.join(data_dir, 'mash', 'mask.tsv')), os.path.join(out_dir, 'dist.phylip')
+
+
+def sample_dist(data_dir, out_dir, threads, replicates=20):
+    genomes = count_lines(os.path.join(data_dir, 'mash', 'mask.tsv'))
+    phylip = os.path.join(out_dir, 'dist.phylip')
+    shutil.copy(os.path.join(data_dir, 'mash', 'dist.phylip'), phylip)
+    cmd = script('sample_dist.py') + [phylip, str(genomes // 2), str(replicates), os.path.join(out_dir, 'sample'), '1']
+    return cmd, replicates * (genomes // 2), None
+
+
+def unmask_tree(data_dir, out_dir, threads):
+    trees_dir = os.path.join(data_dir, 'trees')
+    cmd = script('unmask_tree.py') + ['--threads', str(threads), '--output_dir', out_dir, os.path.join(trees_dir, 'mask.tsv'), trees_dir]
+    return cmd, len(glob(os.path.join(trees_dir, '*.nwk'))), None
+
+
+def extract_labels(data_dir, out_dir, threads):
+    trees_dir = os.path.join(data_dir, 'trees')
+    cmd = script('extract_labels.py') + ['occupancy', '--threads', str(threads), '--output_prefix', os.path.join(out_dir, 'trees'), trees_dir]
+    return cmd, len(glob(os.path.join(trees_dir, '*.nwk'))), None
+
+
+BENCHMARKS = {
+    'get_pangenome_genes': get_pangenome_genes,
+    'root_core_cluster': root_core_cluster,
+    'assembly_msa_input': assembly_msa_input,
+    'dist2fastme': dist2fastme,
+    'sample_dist': sample_dist,
+    'unmask_tree': unmask_tree,
+    'extract_labels': extract_labels,
+}
+
+
+def run(cmd, env, stdout_file, log_file):
+    """
+    (seconds, peak_rss_mb, returncode) of a child process.
+    """
+    with open(stdout_file or os.devnull, 'w') as f_out, open(log_file, 'w') as f_log:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, stdout=f_out, stderr=f_log, env=env)
+        rusage = stage_trace.wait_process(process)
+        elapsed = time.perf_counter() - start
+    return elapsed, rusage.ru_maxrss / 1024, process.returncode
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, encoding='utf-8').strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+
+
+def main(work_dir, scales, benchmarks, species, trees, threads, seed, output, *args, **kwargs):
+    work_dir = os.path.abspath(work_dir)
+    names = list(BENCHMARKS) if benchmarks == 'all' else benchmarks.split(',')
+    assert set(names) <= set(BENCHMARKS), 'Unknown benchmarks: {}'.format(sorted(set(names) - set(BENCHMARKS)))
+
+    bin_dir = os.path.join(work_dir, 'bin')
+    write_stubs(bin_dir)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    commit = current_commit()
+
+    rows = []
+    print(*HEADER, sep='\t')
+    for scale in scales.split(','):
+        genomes, clusters = map(int, scale.lower().split('x'))
+        data_dir = dataset(work_dir, genomes, clusters, int(species), int(trees), int(seed))
+        for name in names:
+            out_dir = os.path.join(work_dir, 'runs', scale, name)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            cmd, items, stdout_file = BENCHMARKS[name](data_dir, out_dir, int(threads))
+            seconds, peak_rss_mb, returncode = run(cmd, env, stdout_file, os.path.join(out_dir, 'run.log'))
+            row = (commit, scale, name, items, f'{seconds:.2f}', f'{items / seconds:.1f}', f'{peak_rss_mb:.1f}', returncode)
+            print(*row, sep='\t', flush=True)
+            if returncode:
+                print('# {} failed, see {}'.format(name, os.path.join(out_dir, 'run.log')), file=sys.stderr)
+            rows.append(row)
+
+    if output:
+        new_file = not os.path.exists(output)
+        with open(output, 'a') as f_out:
+            if new_file:
+                f_out.write('\t'.join(HEADER) + '\n')
+            f_out.writelines('\t'.join(map(str, row)) + '\n' for row in rows)
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
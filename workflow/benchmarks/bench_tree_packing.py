@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Makespan of the tree stage of convert_mask_and_run_phylogeny.py with the old
+fixed split (4 threads per job, threads/4 jobs, input order) and with the cost
+model packing (TreeJobPacker) before and after it learned from recorded runtimes.
+
+Tree jobs are simulated: a job sleeps cpu_seconds / speedup(threads), with
+cpu_seconds ~ taxa^1.4 * columns^1.1 (other exponents than the default model,
+so there is something to learn) and a speedup that stops growing at ~500
+columns per thread. Alignments are random sized (heavy tailed, as gene sets of
+a genus) and scaled so the ideal makespan is --seconds.
+
+Usage:
+    bench_tree_packing.py [ --genes=INT ] [ --threads=INT ] [ --seconds=FLOAT ] [ --seed=INT ]
+
+Options:
+    --genes=INT       Gene alignments [default: 300].
+    --threads=INT     Core budget [default: 16].
+    --seconds=FLOAT   Ideal makespan (total cpu seconds / threads) [default: 6].
+    --seed=INT        Random seed [default: 42].
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+import convert_mask_and_run_phylogeny as phylogeny
+
+
+def true_cpu_seconds(taxa, columns, scale):
+    return scale * taxa ** 1.4 * columns ** 1.1
+
+
+def speedup(threads, columns):
+    return max(1.0, min(threads, columns / 500)) ** 0.9
+
+
+def simulated_tree(input_file, threads=1, scale=1.0):
+    taxa, columns = phylogeny.alignment_dimensions(input_file)
+    time.sleep(true_cpu_seconds(taxa, columns, scale) / speedup(threads, columns))
+    return input_file
+
+
+def write_alignments(out_dir, genes, rng):
+    files = []
+    for idx in range(genes):
+        taxa = min(2000, int(rng.paretovariate(1.5) * 20))
+        columns = min(20000, int(rng.lognormvariate(6.8, 0.7)))
+        fasta_file = os.path.join(out_dir, 'gene_{}.fasta'.format(idx))
+        with open(fasta_file, 'w') as f_out:
+            f_out.write('>t0\n{}\n'.format('A' * columns))
+            f_out.writelines('>t{}\n\n'.format(taxon) for taxon in range(1, taxa))
+        files.append(fasta_file)
+    return files
+
+
+def fixed_split(files, threads, scale):
+    job_threads = 4 if threads >= 4 else 1
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, threads // job_threads)) as executor:
+        list(executor.map(partial(simulated_tree, threads=job_threads, scale=scale), files))
+    return time.perf_counter() - start, []
+
+
+def packed(files, threads, scale, runtimes, out_dir):
+    costs = phylogeny.plan_tree_costs(files, runtimes, 'raxml', None)
+    files = sorted(files, key=lambda input_file: costs[input_file][0], reverse=True)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        packer = phylogeny.TreeJobPacker(executor, threads, threads, costs, 'raxml', None, out_dir)
+        phylogeny.run_pipeline(files, [('tree', partial(simulated_tree, scale=scale), packer)])
+    return time.perf_counter() - start, packer.rows
+
+
+def main(genes, threads, seconds, seed, *args, **kwargs):
+    threads, rng = int(threads), random.Random(int(seed))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = write_alignments(tmp_dir, int(genes), rng)
+        total = sum(true_cpu_seconds(*phylogeny.alignment_dimensions(f), 1.0) for f in files)
+        scale = float(seconds) * threads / total
+
+        results = [('fixed_4_threads', *fixed_split(files, threads, scale))]
+        results.append(('packed_default_model', *packed(files, threads, scale, [], tmp_dir)))
+        # Learn from half of the genes only, the other half must be predicted by the fitted model.
+        recorded = [row for row in results[-1][2] if int(row['gene'].split('_')[1].split('.')[0]) % 2]
+        results.append(('packed_learned_model', *packed(files, threads, scale, recorded, tmp_dir)))
+
+    print('policy', 'makespan_seconds', 'ideal_seconds', 'efficiency', sep='\t')
+    for name, makespan, _ in results:
+        print(name, f'{makespan:.2f}', seconds, f'{float(seconds) / makespan:.0%}', sep='\t')
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Seconds and peak RSS to relabel a (random, seeded) multi-tree newick file with
+Bio.Phylo (parse, rename terminals, format) and with the streaming relabeler of
+unmask_tree.py. Both must give the same leaf labels, tree by tree.
+
+Usage:
+    bench_unmask_tree.py [ --taxa=INT ] [ --trees=INT ] [ --seed=INT ]
+
+Options:
+    --taxa=INT    Leaves per tree [default: 15000].
+    --trees=INT   Trees in the file [default: 10].
+    --seed=INT    Random seed [default: 42].
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+from multiprocessing import Process, Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+from newick_stream import relabel, iter_tokens, unquote, TERMINAL
+from synthetic_data import random_tree
+
+
+def biopython_relabel(tree_file, mask):
+    from Bio import Phylo
+    output = io.StringIO()
+    for tree in Phylo.parse(tree_file, 'newick'):
+        for node in tree.get_terminals():
+            node.name = mask[node.name]
+        output.write(tree.format('newick'))
+    return output.getvalue()
+
+
+def stream_relabel(tree_file, mask):
+    output = io.StringIO()
+    with open(tree_file) as f:
+        relabel(f, output, mask, set())
+    return output.getvalue()
+
+
+def leaf_labels(newick):
+    trees, labels = [], []
+    for kind, text in iter_tokens(io.StringIO(newick)):
+        if kind == TERMINAL:
+            labels.append(unquote(text))
+        elif text == ';':
+            trees.append(labels)
+            labels = []
+    return trees
+
+
+def run(name, tree_file, mask, queue):
+    start = time.perf_counter()
+    newick = {'biopython': biopython_relabel, 'stream': stream_relabel}[name](tree_file, mask)
+    elapsed = time.perf_counter() - start
+    queue.put((name, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, leaf_labels(newick)))
+
+
+def main(taxa, trees, seed, *args, **kwargs):
+    rng = random.Random(int(seed))
+    labels = ['G{:06d}'.format(idx) for idx in range(int(taxa))]
+    mask = {label: 'genome_{}'.format(idx) for idx, label in enumerate(labels)}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tree_file = os.path.join(tmp_dir, 'trees.nwk')
+        with open(tree_file, 'w') as f:
+            for _ in range(int(trees)):
+                rng.shuffle(labels)
+                f.write(random_tree(labels, rng))
+
+        results = {}
+        for name in ('biopython', 'stream'):
+            queue = Queue()
+            process = Process(target=run, args=(name, tree_file, mask, queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+
+    print('relabeler', 'seconds', 'peak_rss_mb', sep='\t')
+    for name, elapsed, peak_rss_mb, _ in results.values():
+        print(name, f'{elapsed:.2f}', f'{peak_rss_mb:.1f}', sep='\t')
+    print('speedup', '{:.1f}x'.format(results['biopython'][1] / results['stream'][1]), sep='\t')
+    assert results['biopython'][3] == results['stream'][3], 'Leaf labels differ between Bio.Phylo and the streaming relabeler.'
+
+
+if __name__ == '__main__':
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Seeded generator of synthetic workflow inputs for the benchmarks.
+
+Layout of OUTPUT_DIR:
+    panaroo/gene_presence_absence.{Rtab,csv}    panaroo tables of the main species.
+    annotation/GENOME/GENOME.gbk.gz             prokka-like GenBank files (+ annotation_list.txt).
+    panclusters/GENOME.panclusters.fa.gz        bgzipped core cluster fastas with .fai/.gzi (get_pangenome_genes.py output).
+    genus/SPECIE/pan_genome_reference.prefixed.fa.gz   indexed panaroo references of every species.
+    roots.tsv                                   mmseqs-like clusters of the references (root_core_cluster.py roots).
+    core_clusters.txt                           core clusters of the main species (coregenome_threshold 0.95).
+    mash/dist.tsv, mash/mask.tsv, mash/dist.phylip     mash distance matrix, its dist2fastme.py mask and PHYLIP matrix.
+    trees/gene_N.nwk, trees/mask.tsv            masked gene trees over random taxon subsets and their mask.
+
+Usage:
+    synthetic_data.py ( --output_dir=PATH ) [ --genomes=N ] [ --clusters=N ] [ --species=N ] [ --trees=N ] [ --seed=N ]
+
+Options:
+    --output_dir=PATH   Dir for the generated data.
+    --genomes=N         Genomes of the main species [default: 50].
+    --clusters=N        Pangenome clusters of the main species [default: 200].
+    --species=N         Species in the genus dir (main species included) [default: 3].
+    --trees=N           Gene trees [default: 100].
+    --seed=N            Random seed [default: 42].
+"""
+
+import os
+import sys
+import gzip
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from docopt import docopt
+
+from bgzf_fasta import BgzfWriter, BgzfFastaWriter, write_gzi
+from get_pangenome_genes import get_min_persistence
+
+MAIN_SPECIE = 'Klebsiella_pneumoniae'
+COREGENOME_THRESHOLD = 0.95
+BASES = 'ACGT'
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def write_bgzf(output_file: str, data: bytes) -> None:
+    """
+    Write 'data' as BGZF with its '.gzi' index (bgzip -i).
+    """
+    with BgzfWriter(output_file) as writer:
+        writer.write(data)
+    write_gzi(output_file + '.gzi', writer.coffsets, writer.uoffsets)
+
+
+def fai_lines(data: bytes) -> list:
+    """
+    '.fai' lines of an uncompressed fasta (one line sequences or wrapped at a fixed width).
+    """
+    lines, name, length, offset, linebases, linewidth = [], None, 0, 0, 0, 0
+    position = 0
+    for line in data.splitlines(keepends=True):
+        if line.startswith(b'>'):
+            if name is not None:
+                lines.append(f'{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n')
+            name, length, offset, linebases, linewidth = line[1:].split()[0].decode(), 0, position + len(line), 0, 0
+        else:
+            if not linebases:
+                linebases, linewidth = len(line.rstrip(b'\r\n')), len(line)
+            length += len(line.rstrip(b'\r\n'))
+        position += len(line)
+    if name is not None:
+        lines.append(f'{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n')
+    return lines
+
+
+def write_indexed_fasta(output_file: str, records: list) -> None:
+    """
+    bgzipped fasta with '.fai' and '.gzi' ('bgzip -i' + 'samtools faidx') of [(record_id, sequence)].
+    """
+    with BgzfFastaWriter(output_file) as writer:
+        for record_id, sequence in records:
+            writer.write(record_id, sequence)
+
+
+def mutate(sequence: str, rate: float, rng: random.Random) -> str:
+    n_sites = int(len(sequence) * rate)
+    sequence = list(sequence)
+    for site in rng.sample(range(len(sequence)), n_sites):
+        sequence[site] = rng.choice(BASES)
+    return ''.join(sequence)
+
+
+def genbank_record(contig_id: str, sequence: str, cds: list) -> str:
+    """
+    Prokka-like GenBank record; cds is [(locus_tag, start, end, strand)] (1-based, inclusive).
+    """
+    lines = [
+        f'LOCUS       {contig_id:<21}{len(sequence):>7} bp    DNA     linear       01-JAN-2024',
+        f'DEFINITION  {MAIN_SPECIE.replace("_", " ")}.',
+        'FEATURES             Location/Qualifiers',
+        f'     source          1..{len(sequence)}',
+        f'                     /organism="{MAIN_SPECIE.replace("_", " ")}"',
+        '                     /mol_type="genomic DNA"',
+    ]
+    for locus_tag, start, end, strand in cds:
+        location = f'{start}..{end}' if strand > 0 else f'complement({start}..{end})'
+        lines += [
+            f'     gene            {location}',
+            f'                     /locus_tag="{locus_tag}"',
+            f'     CDS             {location}',
+            f'                     /locus_tag="{locus_tag}"',
+            '                     /product="hypothetical protein"',
+        ]
+    lines.append('ORIGIN')
+    lowered = sequence.lower()
+    for idx in range(0, len(lowered), 60):
+        line = lowered[idx:idx + 60]
+        lines.append(f'{idx + 1:>9} ' + ' '.join(line[pos:pos + 10] for pos in range(0, len(line), 10)))
+    lines.append('//')
+    return '\n'.join(lines) + '\n'
+
+
+def random_tree(labels: list, rng: random.Random) -> str:
+    """
+    Newick text of a random binary tree (random joins) over 'labels', with branch lengths and supports.
+    """
+    nodes = ['{}:{:.6f}'.format(label, rng.random()) for label in labels]
+    while len(nodes) > 1:
+        a = nodes.pop(rng.randrange(len(nodes)))
+        b = nodes.pop(rng.randrange(len(nodes)))
+        nodes.append('({},{}){}:{:.6f}'.format(a, b, rng.randint(0, 100), rng.random()))
+    return nodes[0].rsplit(':', 1)[0] + ';\n'
+
+
+def generate_pangenome(output_dir: str, genomes: int, clusters: int, rng: random.Random) -> tuple:
+    """
+    panaroo tables, GenBank files and panclusters fastas of the main species; returns (genome_ids, core_clusters, cluster_sequences).
+    """
+    genome_ids = ['G{:05d}'.format(idx) for idx in range(genomes)]
+    cluster_names = ['group_{}'.format(idx) for idx in range(clusters)]
+    cluster_sequences = {name: ''.join(rng.choices(BASES, k=3 * rng.randint(100, 500))) for name in cluster_names}
+
+    # 80% (soft) core clusters, absent in ~1% of the genomes, the rest accessory.
+    presence = {}
+    for idx, name in enumerate(cluster_names):
+        frequency = 0.99 if idx < 0.8 * clusters else rng.uniform(0.1, 0.9)
+        presence[name] = [rng.random() < frequency for _ in genome_ids]
+    min_persistence = get_min_persistence(coregenome_threshold=COREGENOME_THRESHOLD, genome_count=genomes)
+    core_clusters = [name for name in cluster_names if presence[name].count(False) < min_persistence]
+    assert core_clusters, 'No core clusters with {} genomes (min persistence {}), use more genomes.'.format(genomes, min_persistence)
+
+    locustags = {name: [''] * genomes for name in cluster_names}
+    os.makedirs(os.path.join(output_dir, 'annotation'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'panclusters'), exist_ok=True)
+    annotation_list = []
+    for genome_idx, genome_id in enumerate(genome_ids):
+        genes = [name for name in cluster_names if presence[name][genome_idx]]
+        rng.shuffle(genes)
+        sequences = {name: mutate(cluster_sequences[name], 0.01, rng) for name in genes}
+
+        records = []
+        for contig_idx, start_gene in enumerate(range(0, len(genes), 50)):
+            contig, cds, position = [], [], 0
+            for gene_idx, name in enumerate(genes[start_gene:start_gene + 50], start=start_gene):
+                spacer = ''.join(rng.choices(BASES, k=rng.randint(20, 200)))
+                strand = rng.choice((1, -1))
+                locus_tag = '{}_{:05d}'.format(genome_id, gene_idx + 1)
+                locustags[name][genome_idx] = locus_tag
+                sequence = sequences[name] if strand > 0 else sequences[name].translate(COMPLEMENT)[::-1]
+                contig += [spacer, sequence]
+                position += len(spacer)
+                cds.append((locus_tag, position + 1, position + len(sequence), strand))
+                position += len(sequence)
+            records.append(genbank_record('{}_contig_{}'.format(genome_id, contig_idx + 1), ''.join(contig), cds))
+
+        gbk_dir = os.path.join(output_dir, 'annotation', genome_id)
+        os.makedirs(gbk_dir, exist_ok=True)
+        gbk_file = os.path.join(gbk_dir, genome_id + '.gbk.gz')
+        with gzip.open(gbk_file, 'wt', compresslevel=1) as f_out:
+            f_out.writelines(records)
+        annotation_list.append(os.path.abspath(gbk_file))
+
+        core_records = sorted((f'{genome_id}#{name}', sequences[name]) for name in core_clusters if name in sequences)
+        write_indexed_fasta(os.path.join(output_dir, 'panclusters', genome_id + '.panclusters.fa.gz'), core_records)
+
+    with open(os.path.join(output_dir, 'annotation_list.txt'), 'w') as f_out:
+        f_out.write('\n'.join(annotation_list) + '\n')
+
+    panaroo_dir = os.path.join(output_dir, 'panaroo')
+    os.makedirs(panaroo_dir, exist_ok=True)
+    with open(os.path.join(panaroo_dir, 'gene_presence_absence.Rtab'), 'w') as f_out:
+        f_out.write('\t'.join(['Gene'] + genome_ids) + '\n')
+        for name in cluster_names:
+            f_out.write('\t'.join([name] + ['1' if present else '0' for present in presence[name]]) + '\n')
+    with open(os.path.join(panaroo_dir, 'gene_presence_absence.csv'), 'w') as f_out:
+        f_out.write(','.join(['Gene', 'Non-unique Gene name', 'Annotation'] + genome_ids) + '\n')
+        for name in cluster_names:
+            f_out.write(','.join([name, '', 'hypothetical protein'] + locustags[name]) + '\n')
+
+    with open(os.path.join(output_dir, 'core_clusters.txt'), 'w') as f_out:
+        f_out.writelines(name + '\n' for name in core_clusters)
+
+    return genome_ids, core_clusters, cluster_sequences
+
+
+def generate_genus(output_dir: str, species: int, core_clusters: list, cluster_sequences: dict, rng: random.Random) -> None:
+    """
+    panaroo references of every species and the mmseqs-like roots tsv of the main species clusters.
+    """
+    species_names = [MAIN_SPECIE] + ['Klebsiella_sp_{}'.format(idx) for idx in range(1, species)]
+    roots = []
+    for specie in species_names:
+        records = []
+        for idx, name in enumerate(sorted(cluster_sequences)):
+            record_id = '{}#{}'.format(specie, name if specie == MAIN_SPECIE else 'group_{}'.format(idx + 100000))
+            records.append((record_id, cluster_sequences[name] if specie == MAIN_SPECIE else mutate(cluster_sequences[name], 0.1, rng)))
+            if name in core_clusters and (specie == MAIN_SPECIE or rng.random() < 0.7):
+                roots.append('{}#{}\t{}\n'.format(MAIN_SPECIE, name, record_id))
+        specie_dir = os.path.join(output_dir, 'genus', specie)
+        os.makedirs(specie_dir, exist_ok=True)
+        write_indexed_fasta(os.path.join(specie_dir, 'pan_genome_reference.prefixed.fa.gz'), records)
+
+    with open(os.path.join(output_dir, 'roots.tsv'), 'w') as f_out:
+        f_out.writelines(roots)
+
+
+def generate_distances(output_dir: str, genome_ids: list, rng: random.Random) -> None:
+    """
+    mash-like distances of random points (clonal groups), with a dist2fastme.py mask and the PHYLIP matrix.
+    """
+    points = [(rng.gauss(0, 1), rng.gauss(0, 1)) for _ in genome_ids]
+    mash_dir = os.path.join(output_dir, 'mash')
+    os.makedirs(mash_dir, exist_ok=True)
+    mask = {genome_id: 'M{:019d}'.format(idx) for idx, genome_id in enumerate(genome_ids)}
+    with open(os.path.join(mash_dir, 'dist.tsv'), 'w') as f_dist, open(os.path.join(mash_dir, 'dist.phylip'), 'w') as f_phylip:
+        f_dist.write('\t'.join(['#query'] + genome_ids) + '\n')
+        f_phylip.write(f'{len(genome_ids)}\n')
+        for genome_id, (x1, y1) in zip(genome_ids, points):
+            dists = ['{:.7f}'.format(min(1.0, 0.01 * ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5)) for x2, y2 in points]
+            f_dist.write('\t'.join([genome_id] + dists) + '\n')
+            f_phylip.write('\t'.join([mask[genome_id]] + [format(float(dist), '.10f') for dist in dists]) + '\n')
+    with open(os.path.join(mash_dir, 'mask.tsv'), 'w') as f_out:
+        f_out.write('\n'.join(map('\t'.join, mask.items())) + '\n')
+
+
+def generate_trees(output_dir: str, genome_ids: list, trees: int, rng: random.Random) -> None:
+    """
+    Masked gene trees over 50-100% of the genomes (occupancy) and their 'masked<TAB>genome' mask.
+    """
+    trees_dir = os.path.join(output_dir, 'trees')
+    os.makedirs(trees_dir, exist_ok=True)
+    mask = {'T{:06d}'.format(idx): genome_id for idx, genome_id in enumerate(genome_ids)}
+    masked_ids = list(mask)
+    for idx in range(trees):
+        taxa = rng.sample(masked_ids, max(3, int(len(masked_ids) * rng.uniform(0.5, 1.0))))
+        with open(os.path.join(trees_dir, 'gene_{}.nwk'.format(idx)), 'w') as f_out:
+            f_out.write(random_tree(taxa, rng))
+    with open(os.path.join(trees_dir, 'mask.tsv'), 'w') as f_out:
+        f_out.write('\n'.join(map('\t'.join, mask.items())) + '\n')
+
+
+def generate(output_dir: str, genomes: int = 50, clusters: int = 200, species: int = 3, trees: int = 100, seed: int = 42) -> None:
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    genome_ids, core_clusters, cluster_sequences = generate_pangenome(output_dir, genomes, clusters, rng)
+    generate_genus(output_dir, species, core_clusters, cluster_sequences, rng)
+    generate_distances(output_dir, genome_ids, rng)
+    generate_trees(output_dir, genome_ids, trees, rng)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    generate(
+        args['--output_dir'],
+        genomes=int(args['--genomes']), clusters=int(args['--clusters']),
+        species=int(args['--species']), trees=int(args['--trees']), seed=int(args['--seed']),
+    )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Alignment masking with NumPy, same filters as 'qiime alignment mask'.
+
+A column is kept when its gap frequency is <= max_gap_frequency and its most
+frequent non-gap character is present in >= min_conservation of the
+sequences. Characters are compared case-insensitively (the masked alignment
+is written uppercase, as the QIIME export does).
+
+Usage:
+    alignment_mask.py ( --input=PATH ) ( --output=PATH ) [ --max_gap_frequency=FLOAT ] [ --min_conservation=FLOAT ]
+
+Options:
+    --input=PATH                 Input fasta alignment.
+    --output=PATH                Masked fasta alignment.
+    --max_gap_frequency=FLOAT    Max gap frequency of a kept column [default: 1.0].
+    --min_conservation=FLOAT     Min frequency of the most common non-gap character of a kept column [default: 0.4].
+"""
+
+import os
+import logging
+import numpy as np
+from docopt import docopt
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+GAP_CHARS = b'-.'
+
+
+def read_alignment(fasta_file: str) -> tuple:
+    """
+    (headers, uint8 matrix sequences x columns, uppercased) of a fasta alignment.
+    """
+    headers, sequences = [], []
+    with open(fasta_file, 'rb') as f:
+        sequence = []
+        for line in f:
+            if line.startswith(b'>'):
+                if headers:
+                    sequences.append(b''.join(sequence))
+                headers.append(line[1:].rstrip(b'\r\n').decode())
+                sequence = []
+            else:
+                sequence.append(line.strip())
+        if headers:
+            sequences.append(b''.join(sequence))
+
+    lengths = set(map(len, sequences))
+    assert len(lengths) <= 1, 'Sequences of {} have different lengths: {}'.format(fasta_file, sorted(lengths))
+
+    matrix = np.frombuffer(b''.join(sequences), dtype=np.uint8).reshape(len(sequences), lengths.pop() if lengths else 0)
+    return headers, np.where((matrix >= ord('a')) & (matrix <= ord('z')), matrix - 32, matrix).astype(np.uint8)
+
+
+def gap_matrix(matrix: np.ndarray) -> np.ndarray:
+    return np.isin(matrix, np.frombuffer(GAP_CHARS, dtype=np.uint8))
+
+
+def compute_mask(matrix: np.ndarray, max_gap_frequency: float = 1.0, min_conservation: float = 0.4) -> np.ndarray:
+    """
+    Boolean vector of the columns kept by the gap and conservation filters.
+    """
+    assert 0.0 <= max_gap_frequency <= 1.0, 'max_gap_frequency must be between 0 and 1.'
+    assert 0.0 <= min_conservation <= 1.0, 'min_conservation must be between 0 and 1.'
+
+    sequences, columns = matrix.shape
+    if not sequences:
+        return np.zeros(columns, dtype=bool)
+
+    gaps = gap_matrix(matrix)
+    gap_mask = gaps.sum(axis=0) / sequences <= max_gap_frequency
+
+    max_counts = np.zeros(columns, dtype=np.int64)
+    for char in np.unique(matrix[~gaps]):
+        np.maximum(max_counts, (matrix == char).sum(axis=0), out=max_counts)
+    conservation_mask = max_counts / sequences >= min_conservation
+
+    return gap_mask & conservation_mask
+
+
+def write_alignment(headers: list, matrix: np.ndarray, output_file: str) -> None:
+    with open(output_file, 'wb') as f_out:
+        for header, row in zip(headers, matrix):
+            f_out.write(b'>' + header.encode() + b'\n' + row.tobytes() + b'\n')
+
+
+def mask_alignment_file(input_file: str, output_file: str, max_gap_frequency: float = 1.0, min_conservation: float = 0.4) -> tuple:
+    """
+    Mask a fasta alignment into output_file, returns (kept columns, total columns).
+    """
+    headers, matrix = read_alignment(input_file)
+    mask = compute_mask(matrix, max_gap_frequency=max_gap_frequency, min_conservation=min_conservation)
+    write_alignment(headers, matrix[:, mask], output_file)
+    return int(mask.sum()), len(mask)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    kept, total = mask_alignment_file(
+        args['--input'], args['--output'],
+        max_gap_frequency=float(args['--max_gap_frequency']),
+        min_conservation=float(args['--min_conservation']),
+    )
+    print(f'{kept}/{total} columns kept.')
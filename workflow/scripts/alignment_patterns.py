@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Alignment reduction before tree inference, with NumPy.
+
+Identical rows are collapsed to their first sequence (the others are listed in
+PREFIX.duplicates.tsv, 'REPRESENTATIVE<TAB>DUPLICATE', to be grafted back as
+zero-length sister tips), fully undetermined columns are dropped and the
+remaining columns are compressed to their unique site patterns, written to
+PREFIX.fasta with their counts in PREFIX.weights (a RAxML -a column weight
+file). The likelihood of a tree on the reduced alignment with the weights is
+the one on the full alignment.
+
+Usage:
+    alignment_patterns.py reduce ( --input=PATH ) ( --output_prefix=PATH )
+    alignment_patterns.py graft ( --tree=PATH ) ( --duplicates=PATH ) ( --output=PATH )
+
+Options:
+    --input=PATH            Input fasta alignment (e.g. masked).
+    --output_prefix=PATH    Prefix of the reduced alignment, weights and duplicates files.
+    --tree=PATH             Newick trees inferred on the reduced alignment.
+    --duplicates=PATH       Duplicates file of the reduced alignment.
+    --output=PATH           Newick trees with the duplicates grafted back.
+"""
+
+import os
+import logging
+import numpy as np
+from docopt import docopt
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+from alignment_mask import read_alignment, write_alignment
+import newick_stream
+
+# Characters carrying no information on a site (a column of only these adds nothing to the likelihood).
+UNDETERMINED_CHARS = b'-.N?'
+
+
+def unique_rows(matrix: np.ndarray) -> tuple:
+    """
+    (indexes of the first row of each distinct sequence, in input order; representative index of every row).
+    """
+    if not len(matrix):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, first, inverse = np.unique(matrix, axis=0, return_index=True, return_inverse=True)
+    return np.sort(first), first[inverse.reshape(-1)]
+
+
+def site_patterns(matrix: np.ndarray) -> tuple:
+    """
+    (indexes of the first column of each distinct site pattern, in input order; column count of each pattern).
+    """
+    if not matrix.shape[1]:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, first, counts = np.unique(matrix.T, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return first[order], counts[order]
+
+
+def undetermined_columns(matrix: np.ndarray) -> np.ndarray:
+    return np.isin(matrix, np.frombuffer(UNDETERMINED_CHARS, dtype=np.uint8)).all(axis=0)
+
+
+def reduce_alignment_file(input_file: str, output_prefix: str) -> dict:
+    """
+    Write PREFIX.fasta, PREFIX.weights and PREFIX.duplicates.tsv, returns the sizes before and after.
+    """
+    headers, matrix = read_alignment(input_file)
+    representatives, row_representative = unique_rows(matrix)
+
+    reduced = matrix[representatives][:, ~undetermined_columns(matrix)]
+    patterns, weights = site_patterns(reduced)
+
+    write_alignment([headers[idx] for idx in representatives], reduced[:, patterns], output_prefix + '.fasta')
+    with open(output_prefix + '.weights', 'w') as f_out:
+        f_out.write(' '.join(map(str, weights)) + '\n')
+    with open(output_prefix + '.duplicates.tsv', 'w') as f_out:
+        for idx, representative in enumerate(row_representative):
+            if idx != representative:
+                f_out.write('{}\t{}\n'.format(headers[representative], headers[idx]))
+
+    return {
+        'rows': len(headers), 'unique_rows': len(representatives),
+        'columns': matrix.shape[1], 'determined_columns': reduced.shape[1], 'patterns': len(patterns),
+    }
+
+
+def read_duplicates(duplicates_file: str) -> dict:
+    """
+    {representative: [duplicates]} of a duplicates file.
+    """
+    duplicates = {}
+    with open(duplicates_file, 'r') as f:
+        for line in f:
+            representative, duplicate = line.rstrip('\n').split('\t')
+            duplicates.setdefault(representative, []).append(duplicate)
+    return duplicates
+
+
+def graft_tree_file(tree_file: str, duplicates_file: str, output_file: str) -> int:
+    """
+    Write the trees of tree_file with the duplicates grafted back, returns the number of trees.
+    """
+    with open(tree_file, 'r') as f, open(output_file + '.tmp', 'w') as f_out:
+        trees = newick_stream.graft_duplicates(f, f_out, read_duplicates(duplicates_file))
+    os.replace(output_file + '.tmp', output_file)
+    return trees
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    if args['reduce']:
+        sizes = reduce_alignment_file(args['--input'], args['--output_prefix'])
+        print('{unique_rows}/{rows} rows, {determined_columns}/{columns} columns as {patterns} site patterns.'.format(**sizes))
+    else:
+        trees = graft_tree_file(args['--tree'], args['--duplicates'], args['--output'])
+        print(f'{trees} trees grafted.')
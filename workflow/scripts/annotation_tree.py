@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Cached listing of the annotation tree (prokka dirs with the gbk and pancluster fasta files).
+
+The listing is kept in a cache file chosen by the caller (usually in its output
+dir, ROOT is never written), a '#ROOT' header then one row per directory:
+'DIR<TAB>MTIME_NS<TAB>SUBDIRS<TAB>FILES' (names joined by '/'). A directory is only
+read again (scandir) when its mtime changed (a file was added, removed or renamed
+in it), unchanged directories cost one stat, done by 'threads' threads (latency of
+a network filesystem). The cache is written only when something changed. Symlinks
+to directories are listed as files and not followed (as Path.rglob).
+
+Usage:
+    annotation_tree.py ROOT [ --cache=PATH ] [ --suffix=STR ] [ --threads=N ]
+
+Options:
+    --cache=PATH    Cache file of the listing, the whole tree is read if not given.
+    --suffix=STR    Only print the files with this suffix [default: ].
+    --threads=N     Directories stat'ed in parallel [default: 16].
+"""
+
+import os
+import time
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+from docopt import docopt
+
+# Name of the cache in the output dir of the callers.
+CACHE_NAME = '.annotation_tree.tsv'
+STAT_THREADS = 16
+# Dirs changed this recently may change again within the same mtime tick: not trusted next time.
+RECENT_SECONDS = 2
+
+
+class AnnotationTree:
+    """
+    Files under 'root', refreshed from 'cache_file' (if given) in the constructor.
+    """
+
+    def __init__(self, root: str, cache_file: str = None, threads: int = STAT_THREADS):
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file
+        self.threads = threads
+        self.rescanned = 0
+        cached = self.read()
+        self.dirs = self.refresh(cached)
+        if self.cache_file and self.dirs != cached:
+            self.write()
+        logger.info('{} dirs in annotation tree {} ({} read again).'.format(len(self.dirs), self.root, self.rescanned))
+
+    def read(self) -> dict:
+        """
+        {relative dir: (mtime_ns, subdirs, files)} of the cache file, empty if it lists another root.
+        """
+        dirs = {}
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return dirs
+        with open(self.cache_file, 'r') as f:
+            if f.readline().rstrip('\n') != '#' + self.root:
+                logger.warning('Annotation tree cache {} is not for {}, the tree will be read again.'.format(self.cache_file, self.root))
+                return dirs
+            for line in f:
+                relpath, mtime_ns, subdirs, files = line.rstrip('\n').split('\t')
+                dirs[relpath] = (int(mtime_ns), tuple(filter(None, subdirs.split('/'))), tuple(filter(None, files.split('/'))))
+        return dirs
+
+    def write(self) -> None:
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            with open(tmp_file, 'w') as f_out:
+                f_out.write('#{}\n'.format(self.root))
+                for relpath, (mtime_ns, subdirs, files) in self.dirs.items():
+                    f_out.write('{}\t{}\t{}\t{}\n'.format(relpath, mtime_ns, '/'.join(subdirs), '/'.join(files)))
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logger.warning('Annotation tree cache not written ({}), the tree will be read again next time.'.format(e))
+
+    def scan(self, relpath: str, cached: dict) -> tuple:
+        """
+        (mtime_ns, subdirs, files) of a dir, from the cache when its mtime did not change. None if gone.
+        """
+        path = os.path.join(self.root, relpath)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            cached_entry = cached.get(relpath)
+            if cached_entry and cached_entry[0] == mtime_ns:
+                return cached_entry
+            subdirs, files = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # Not following symlinks: a link to a parent dir would be walked forever.
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        self.rescanned += 1
+        if time.time_ns() - mtime_ns < RECENT_SECONDS * 10**9:
+            mtime_ns = 0
+        return mtime_ns, tuple(sorted(subdirs)), tuple(sorted(files))
+
+    def refresh(self, cached: dict) -> dict:
+        """
+        Walk the tree level by level, the dirs of a level are checked in parallel (in chunks).
+        """
+        dirs, level = {}, ['']
+        scan_chunk = lambda relpaths: [self.scan(relpath, cached) for relpath in relpaths]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while level:
+                next_level = []
+                chunk_size = max(1, -(-len(level) // (self.threads * 4)))
+                chunks = [level[i:i + chunk_size] for i in range(0, len(level), chunk_size)]
+                entries = itertools.chain.from_iterable(executor.map(scan_chunk, chunks))
+                for relpath, entry in zip(level, entries):
+                    if entry is None:
+                        continue
+                    dirs[relpath] = entry
+                    next_level.extend(os.path.join(relpath, name) for name in entry[1])
+                level = next_level
+        return dirs
+
+    def files(self, suffix: str = '') -> list:
+        """
+        Absolute paths of the files ending with 'suffix' (like Path(root).rglob('*' + suffix)).
+        """
+        return [
+            os.path.join(self.root, relpath, name)
+            for relpath, (_, _, files) in self.dirs.items()
+            for name in files if name.endswith(suffix)
+        ]
+
+    def genomes(self, suffix: str, genome_ids: set = None) -> dict:
+        """
+        {genome_id: path} of the files named GENOME_ID + suffix.
+        """
+        genomes = {}
+        for path in self.files(suffix):
+            genome_id = os.path.basename(path)[:-len(suffix)] if suffix else os.path.basename(path)
+            if genome_ids is None or genome_id in genome_ids:
+                assert genome_id not in genomes, "Duplicated genome id: {}".format(genome_id)
+                genomes[genome_id] = path
+        return genomes
+
+    def exists(self, path: str) -> bool:
+        relpath = os.path.relpath(os.path.abspath(path), self.root)
+        entry = self.dirs.get(os.path.dirname(relpath))
+        return bool(entry) and os.path.basename(relpath) in entry[2]
+
+
+def main(ROOT, suffix, threads, cache=None, *args, **kwargs):
+    print(*sorted(AnnotationTree(ROOT, cache_file=cache, threads=int(threads)).files(suffix)), sep='\n')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        datefmt='%Y-%m-%d %H:%M:%S',
+        )
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
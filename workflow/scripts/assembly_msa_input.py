@@ -5,6 +5,7 @@ Generate multifastas to align.
 Usage:
     assembly_msa_input.py ( --annotation_dir=PATH ) ( --panaroo_dir=PATH ) ( --fasta_suffix=STR )
                           ( --output_dir=PATH ) ( --specie=STR ) ( --core_clusters_file=PATH ) [ --threads=N ]
+                          [ --genome_major | --cluster_archive=PREFIX ] [ --max_open_files=N ] [ --annotation_cache=PATH ] [ --dry_run ]
 
 Options:
     -h --help                     Show this screen.
@@ -15,6 +16,14 @@ Options:
     -c --core_clusters_file=PATH  Path to the core genes file (one per line).
     -o --output_dir=PATH          Path to the output directory.
     -t --threads=N                Threads number [default: 1].
+    -g --genome_major             Stream each genome fasta once and append its records to the cluster
+                                  files, instead of one indexed lookup per genome for every cluster.
+    --cluster_archive=PREFIX      Read each cluster multifasta as one contiguous slice of the cluster-major
+                                  archive written by 'get_pangenome_genes.py --cluster_archive'.
+    -m --max_open_files=N         Max cluster files kept open by each worker with --genome_major [default: 256].
+    --annotation_cache=PATH       Cache of the annotation dir listing (annotation_tree.py),
+                                  OUTPUT_DIR/.annotation_tree.tsv if not given.
+    -n --dry_run                  Only report which cluster multifastas would be (re)built or removed.
 """
 
 # Native imports
@@ -24,28 +33,29 @@ import datetime
 import datetime
 import re
 from pathlib import Path
-from collections import defaultdict
-import uuid
+from collections import defaultdict, OrderedDict
 import logging
 import subprocess
 from multiprocessing import Pool
 import itertools
+import gzip
 logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
 
 # 3th party modules
 from docopt import docopt
 
-def list_and_filter_files(annotation_dir: str, genome_ids: set, fasta_suffix: str) -> list:
+# Local modules
+import stage_trace
+from annotation_tree import AnnotationTree, CACHE_NAME
+from cluster_archive import ClusterArchive
+from cluster_manifest import MANIFEST_NAME, ManifestEntry, read_manifest, write_manifest, inputs_hash, is_up_to_date, finalize_cluster_fasta, remove_stale_fasta, report_changes, slugify
+
+def list_and_filter_files(annotation_dir: str, genome_ids: set, fasta_suffix: str, cache_file: str = None) -> list:
     """
-    List all the files in the annotation directory and filter them by specie and fasta_suffix.
+    List all the files in the annotation directory and filter them by specie and fasta_suffix
+    (listing cached in 'cache_file', only the dirs changed since the last run are read again).
     """
-    genomes_fasta = {}
-    for fasta in Path(annotation_dir).rglob('*' + fasta_suffix):
-        genome_id = os.path.basename(fasta).replace(fasta_suffix, "")
-        if genome_id in genome_ids:
-            assert not genome_id in genomes_fasta, "Duplicated genome id."
-            genomes_fasta[genome_id] = str(fasta.absolute())
-    return genomes_fasta
+    return AnnotationTree(annotation_dir, cache_file=cache_file).genomes(fasta_suffix, genome_ids)
 
 def read_core_clusters_from_file(core_clusters_file: str) -> dict:
     with open(core_clusters_file, 'r') as f:
@@ -67,14 +77,170 @@ def extract_record_from_fasta_faidx(fasta_file: str, record_id: str) -> str:
     Extract a record from a samtools indexed fasta file.
     """
     try:
-        record = subprocess.check_output(['samtools', 'faidx', fasta_file, record_id], encoding='utf-8').split('\n')
+        record = stage_trace.check_output(['samtools', 'faidx', fasta_file, record_id], stage='faidx', item=record_id, encoding='utf-8').split('\n')
         header = record[0]
         sequence = ''.join(record[1:-1])
         return f'{header}\n{sequence}'
     except subprocess.CalledProcessError as e:
         logger.info("Extracting record_id ('{}') from fasta file, RECORD might not exists on fasta: {}.".format(record_id, e))
 
-def main(core_clusters_file: str, specie: str, annotation_dir: str, panaroo_dir: str, fasta_suffix: str, output_dir: str, threads: int = 1, *args, **kwargs) -> None:
+class AppendFilePool:
+    """
+    LRU pool of files opened for append, keeps a worker under the fd limit.
+    """
+
+    def __init__(self, max_open: int = 256):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+
+    def write(self, file_name: str, data: str) -> None:
+        handle = self.handles.get(file_name)
+        if handle is None:
+            handle = open(file_name, 'a')
+            self.handles[file_name] = handle
+            if len(self.handles) > self.max_open:
+                self.handles.popitem(last=False)[1].close()
+        else:
+            self.handles.move_to_end(file_name)
+        handle.write(data)
+
+    def close(self) -> None:
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+def read_fasta_records(fasta_file: str):
+    """
+    Stream (record_id, sequence) from a (b)gzipped or plain fasta, sequence lines are joined.
+    """
+    opener = gzip.open if fasta_file.endswith('.gz') else open
+    with opener(fasta_file, 'rt') as f:
+        record_id, sequence = None, []
+        for line in f:
+            if line.startswith('>'):
+                if record_id is not None:
+                    yield record_id, ''.join(sequence)
+                header = line[1:].split()
+                record_id, sequence = header[0] if header else '', []
+            else:
+                sequence.append(line.strip())
+        if record_id is not None:
+            yield record_id, ''.join(sequence)
+
+# Cluster files being built and their worker parts (and the '.building.fasta' ones of older runs).
+BUILDING_FILE_RE = re.compile(r'\.building\.(tmp|fasta)(\.\d+\.part)?$')
+
+def shard_part_file(cluster_fasta_file: str, worker_idx: int) -> str:
+    return f'{cluster_fasta_file}.{worker_idx}.part'
+
+def remove_stale_building_files(output_dir: str) -> None:
+    """
+    Remove the cluster files and worker parts left by an interrupted run (parts are appended to), whatever its --threads.
+    """
+    if not os.path.isdir(output_dir):
+        return
+    for entry in os.scandir(output_dir):
+        if entry.is_file() and BUILDING_FILE_RE.search(entry.name):
+            logger.warning("Removing stale building file: {}".format(entry.path))
+            os.remove(entry.path)
+
+def shard_genomes(worker_idx: int, genomes: list, cluster_files: dict, max_open_files: int = 256) -> int:
+    """
+    Stream every genome fasta once and append each core record to its cluster part file.
+    """
+    out_files = AppendFilePool(max_open=max_open_files)
+    records_count = 0
+    try:
+        for genome_id, fasta_file in genomes:
+            with stage_trace.span('stream_genome', item=genome_id, worker=worker_idx):
+                seen = set()
+                prefix = genome_id + '#'
+                for record_id, sequence in read_fasta_records(fasta_file):
+                    if not record_id.startswith(prefix):
+                        continue
+                    core_cluster = record_id[len(prefix):]
+                    if core_cluster not in cluster_files or core_cluster in seen:
+                        continue
+                    seen.add(core_cluster)
+                    out_files.write(shard_part_file(cluster_files[core_cluster], worker_idx), f'>{record_id}\n{sequence}\n')
+                    records_count += 1
+            logger.debug("Worker {} finished genome {}.".format(worker_idx, genome_id))
+    finally:
+        out_files.close()
+    return records_count
+
+def merge_shard_parts(cluster_fasta_file: str, workers: int) -> None:
+    """
+    Concatenate the worker part files of a cluster, records sorted by header
+    (same layout and order as the cluster-major output).
+    """
+    with stage_trace.span('merge_cluster', item=os.path.basename(cluster_fasta_file)):
+        lines = []
+        for worker_idx in range(workers):
+            part_file = shard_part_file(cluster_fasta_file, worker_idx)
+            if os.path.exists(part_file):
+                with open(part_file, 'r') as f:
+                    lines.extend(f.read().splitlines())
+                os.remove(part_file)
+        records = sorted(zip(lines[0::2], lines[1::2]))
+        with open(cluster_fasta_file, 'w') as f_out:
+            f_out.write('\n'.join(f'{header}\n{sequence}' for header, sequence in records))
+
+def split_genomes(genomes_fastas: dict, genome_ids: set, workers: int) -> list:
+    """
+    Split genomes between workers balancing the total file size (largest first).
+    """
+    genomes = sorted(
+        ((genome_id, genomes_fastas[genome_id]) for genome_id in genome_ids if genomes_fastas.get(genome_id)),
+        key=lambda x: os.path.getsize(x[1]),
+        reverse=True,
+    )
+    shards = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for genome_id, fasta_file in genomes:
+        idx = loads.index(min(loads))
+        shards[idx].append((genome_id, fasta_file))
+        loads[idx] += os.path.getsize(fasta_file)
+    return shards
+
+def write_clusters_genome_major(genomes_fastas: dict, genome_ids: set, cluster_files: dict, threads: int = 1, max_open_files: int = 256) -> None:
+    """
+    Genome-major assembly: one sequential read per genome, workers split the genome list.
+    """
+    shards = split_genomes(genomes_fastas=genomes_fastas, genome_ids=genome_ids, workers=threads)
+    with Pool(processes=threads) as pool:
+        logger.info("Streaming {} genomes with {} workers ...".format(sum(map(len, shards)), threads))
+        records_count = pool.starmap(
+            shard_genomes,
+            [(worker_idx, genomes, cluster_files, max_open_files) for worker_idx, genomes in enumerate(shards)]
+        )
+        logger.info("Streamed {} records, merging worker parts ...".format(sum(records_count)))
+        pool.starmap(merge_shard_parts, [(cluster_fasta_file, threads) for cluster_fasta_file in cluster_files.values()])
+
+def write_clusters_from_archive(archive_prefix: str, genome_ids: set, cluster_files: dict) -> None:
+    """
+    Cluster multifastas from the memory mapped cluster-major archive (species genomes only).
+    """
+    archive = ClusterArchive(archive_prefix)
+    missing = set(cluster_files) - set(archive.clusters)
+    if missing:
+        logger.warning("{} clusters not in the archive, their multifastas will be empty.".format(len(missing)))
+    genomes = set(genome_ids)
+    for core_cluster, cluster_fasta_file in cluster_files.items():
+        with stage_trace.span('archive_cluster', item=core_cluster):
+            with open(cluster_fasta_file, 'w') as f_out:
+                f_out.write(archive.cluster_fasta(core_cluster, genomes))
+
+def build_cluster_requests(core_cluster: str, genome_ids: list, genomes_fastas: dict) -> list:
+    return [(genomes_fastas[genome_id] , f'{genome_id}#{core_cluster}') for genome_id in genome_ids if genomes_fastas.get(genome_id) ]
+
+def building_fasta_file(output_dir: str, core_cluster: str) -> str:
+    """
+    Cluster file until it is finalized, not ending in '.fasta' (run_msa.py aligns every '*.fasta' of the dir).
+    """
+    return os.path.join(output_dir, '.{}.building.tmp'.format(slugify(core_cluster)))
+
+def main(core_clusters_file: str, specie: str, annotation_dir: str, panaroo_dir: str, fasta_suffix: str, output_dir: str, threads: int = 1, genome_major: bool = False, cluster_archive: str = None, max_open_files: int = 256, annotation_cache: str = None, dry_run: bool = False, *args, **kwargs) -> None:
 
     # Configure logging
     logging.basicConfig(
@@ -88,51 +254,84 @@ def main(core_clusters_file: str, specie: str, annotation_dir: str, panaroo_dir:
 
     assert all([os.path.exists(x) for x in [annotation_dir, panaroo_dir]]), "One or more paths do not exist."
 
-    logger.info("Extracting species genome_ids from panaroo output ...")
-    genome_ids = extract_species_genome_ids_from_panaroo_out(panaroo_dir=panaroo_dir)
+    with stage_trace.span('read_inputs'):
+        logger.info("Extracting species genome_ids from panaroo output ...")
+        genome_ids = extract_species_genome_ids_from_panaroo_out(panaroo_dir=panaroo_dir)
 
-    logger.info("Reading species core genes ...")
-    core_clusters = read_core_clusters_from_file(core_clusters_file=core_clusters_file)
+        logger.info("Reading species core genes ...")
+        core_clusters = read_core_clusters_from_file(core_clusters_file=core_clusters_file)
 
-    logger.info("Listing genomes fastas ...")
-    genomes_fastas = list_and_filter_files(annotation_dir=annotation_dir, genome_ids=genome_ids, fasta_suffix=fasta_suffix)
+        logger.info("Listing genomes fastas ...")
+        genomes_fastas = list_and_filter_files(annotation_dir=annotation_dir, genome_ids=genome_ids, fasta_suffix=fasta_suffix, cache_file=annotation_cache or os.path.join(output_dir, CACHE_NAME))
 
-    logger.info("Generating multifastas ...")
+    manifest_file = os.path.abspath(os.path.join(output_dir, MANIFEST_NAME))
+    manifest = read_manifest(manifest_file)
+    logger.info("Read {} clusters from manifest: {}".format(len(manifest), manifest_file))
 
-    fasta_ids = set()
-    fasta_renamed = []
+    logger.info("Planning multifastas ...")
+    genome_ids = sorted(genome_ids)
+    signatures = {}
+    plan = {
+        core_cluster: inputs_hash(build_cluster_requests(core_cluster, genome_ids, genomes_fastas), signatures)
+        for core_cluster in sorted(core_clusters)
+    }
 
-    for core_cluster in core_clusters:
-        logger.info("Generating multifasta for core cluster: {}".format(core_cluster))
+    changes = report_changes(plan, manifest)
+    if dry_run:
+        logger.info("Dry run, nothing written.")
+        return
 
-        # check if id is in fasta_ids, if it is, create another
-        cluster_fasta_id = uuid.uuid1().hex
-        while cluster_fasta_id in fasta_ids:
-            cluster_fasta_id = uuid.uuid1().hex
-        fasta_ids.add(cluster_fasta_id)
+    logger.info("Generating multifastas ...")
+    remove_stale_building_files(output_dir)
 
-        cluster_fasta_file = os.path.join(output_dir, cluster_fasta_id + ".fasta")
-        logger.info("Writing multifasta to: {}".format(cluster_fasta_file))
+    to_build = {core_cluster: building_fasta_file(output_dir, core_cluster) for core_cluster in changes['new'] + changes['changed']}
 
-        with open(cluster_fasta_file, 'w') as f_out:
-            with Pool(processes=threads) as pool:
-                logger.info("Initiating pool of {} threads for core_cluster: {}".format(threads, core_cluster))
-                specie_sequences = pool.starmap(
-                    extract_record_from_fasta_faidx,
-                    [(genomes_fastas[genome_id] , f'{genome_id}#{core_cluster}') for genome_id in genome_ids if genomes_fastas.get(genome_id) ]
-                )
-                specie_sequences = tuple(filter(None, specie_sequences))
-                logger.info("Finished pool of {} threads for core_cluster: {}".format(threads, core_cluster))
+    if cluster_archive and to_build:
+        with stage_trace.span('cluster_archive'):
+            write_clusters_from_archive(archive_prefix=cluster_archive, genome_ids=genome_ids, cluster_files=to_build)
+    elif genome_major and to_build:
+        with stage_trace.span('genome_major'):
+            write_clusters_genome_major(
+                genomes_fastas=genomes_fastas,
+                genome_ids=genome_ids,
+                cluster_files=to_build,
+                threads=threads,
+                max_open_files=max_open_files,
+            )
+    elif to_build:
+        with Pool(processes=threads) as pool:
+            logger.info("Initiating pool of {} threads ...".format(threads))
+            for core_cluster, cluster_fasta_file in to_build.items():
+                logger.info("Generating multifasta for core cluster: {}".format(core_cluster))
+                with stage_trace.span('cluster', item=core_cluster):
+                    specie_sequences = pool.starmap(
+                        extract_record_from_fasta_faidx,
+                        build_cluster_requests(core_cluster, genome_ids, genomes_fastas)
+                    )
+                    specie_sequences = tuple(filter(None, specie_sequences))
 
-            f_out.write('\n'.join(specie_sequences))
+                    with open(cluster_fasta_file, 'w') as f_out:
+                        f_out.write('\n'.join(specie_sequences))
+            logger.info("Finished pool of {} threads.".format(threads))
 
+    manifest_entries = [manifest[core_cluster] for core_cluster in changes['unchanged']]
+    for core_cluster, building_file in to_build.items():
+        with open(building_file, 'r') as f:
+            content = f.read()
+        os.remove(building_file)
 
+        cluster_fasta_file, cluster_content_hash = finalize_cluster_fasta(output_dir, specie, core_cluster, content, manifest.get(core_cluster))
+        logger.info("Wrote multifasta for cluster {}: {}".format(core_cluster, cluster_fasta_file))
+        manifest_entries.append(ManifestEntry(
+            core_cluster, cluster_fasta_file, 'unrooted',
+            cluster_content_hash, plan[core_cluster], content.count('>'),
+        ))
 
-    summary_name = os.path.abspath(os.path.join(output_dir, 'renamed_fasta_names.csv'))
-    logger.info("Writing summary file: {} ...".format(summary_name))
+    for core_cluster in changes['removed']:
+        remove_stale_fasta(manifest[core_cluster].path, output_dir)
 
-    with open(summary_name, 'w') as f:
-        f.write("\n".join(fasta_renamed))
+    logger.info("Writing manifest file: {} ...".format(manifest_file))
+    write_manifest(manifest_file, manifest_entries)
 
     logger.info("Finished.")
 
@@ -140,5 +339,7 @@ if __name__ == "__main__":
     clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
     args = clean_args(docopt(__doc__))
     args['threads'] = int(args['threads'])
+    args['max_open_files'] = int(args['max_open_files'])
     assert args['threads'] > 0, "Threads must be greater than 0."
-    main(**args)
+    with stage_trace.span('main', whole_process=True):
+        main(**args)
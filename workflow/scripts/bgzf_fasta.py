@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+In-process reader and writer for samtools indexed fasta files (plain or bgzipped).
+
+Reads the '.fai' (and '.gzi' for bgzipped files) indexes written by
+'samtools faidx' and returns records formatted as the scripts expected from
+'samtools faidx FASTA RECORD': '>RECORD\\nSEQUENCE' (sequence unwrapped).
+
+BgzfFastaWriter writes BGZF blocks and builds the '.fai'/'.gzi' indexes while
+writing, same files as 'bgzip' + 'samtools faidx' in a single pass.
+"""
+
+import os
+import zlib
+import struct
+import logging
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+# Uncompressed bytes per block and max block size, as htslib.
+BGZF_BLOCK_DATA = 0xff00
+BGZF_MAX_BLOCK_SIZE = 0x10000
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+FaiEntry = namedtuple('FaiEntry', 'length offset linebases linewidth')
+
+
+def read_fai(fai_file: str) -> dict:
+    """
+    Read a samtools '.fai' index: {record_id: FaiEntry}.
+    """
+    entries = {}
+    with open(fai_file, 'r') as f:
+        for line in f:
+            name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+            entries[name] = FaiEntry(int(length), int(offset), int(linebases), int(linewidth))
+    return entries
+
+
+def read_gzi(gzi_file: str) -> tuple:
+    """
+    Read a bgzip '.gzi' index: (compressed_offsets, uncompressed_offsets), first block included.
+    """
+    with open(gzi_file, 'rb') as f:
+        count, = struct.unpack('<Q', f.read(8))
+        offsets = struct.unpack('<{}Q'.format(count * 2), f.read(16 * count))
+    return (0,) + offsets[0::2], (0,) + offsets[1::2]
+
+
+def write_fai(fai_file: str, entries: dict) -> None:
+    with open(fai_file, 'w') as f_out:
+        for name, entry in entries.items():
+            f_out.write('{}\t{}\t{}\t{}\t{}\n'.format(name, *entry))
+
+
+def write_gzi(gzi_file: str, coffsets: list, uoffsets: list) -> None:
+    """
+    Write a bgzip '.gzi' index from the block offsets (first block excluded, as bgzip).
+    """
+    with open(gzi_file, 'wb') as f_out:
+        f_out.write(struct.pack('<Q', max(len(coffsets) - 1, 0)))
+        for coffset, uoffset in zip(coffsets[1:], uoffsets[1:]):
+            f_out.write(struct.pack('<QQ', coffset, uoffset))
+
+
+def bgzf_block(data: bytes, level: int = 6) -> bytes:
+    """
+    One BGZF block (gzip member with the 'BC' extra subfield) of at most BGZF_BLOCK_DATA bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(deflated) + BGZF_FOOTER_SIZE
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, block_size - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def read_bgzf_block_size(header: bytes) -> int:
+    """
+    Total size of a BGZF block from its header ('BC' extra subfield).
+    """
+    assert header[:4] == b'\x1f\x8b\x08\x04', 'Not a BGZF block.'
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = header[12:12 + xlen]
+    pos = 0
+    while pos < len(extra):
+        si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if si1 == 66 and si2 == 67:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    raise ValueError('BGZF block without BC subfield.')
+
+
+def scan_bgzf_blocks(bgzf_file: str) -> tuple:
+    """
+    Build the '.gzi' offsets by walking the BGZF block headers (no decompression).
+    """
+    coffsets, uoffsets = [], []
+    coffset = uoffset = 0
+    with open(bgzf_file, 'rb') as f:
+        while True:
+            f.seek(coffset)
+            header = f.read(BGZF_HEADER_SIZE)
+            if len(header) < BGZF_HEADER_SIZE:
+                break
+            block_size = read_bgzf_block_size(header)
+            f.seek(coffset + block_size - 4)
+            isize, = struct.unpack('<I', f.read(4))
+            coffsets.append(coffset)
+            uoffsets.append(uoffset)
+            coffset += block_size
+            uoffset += isize
+    return tuple(coffsets), tuple(uoffsets)
+
+
+def read_index(fasta_file: str) -> tuple:
+    """
+    Parsed indexes of a fasta: ({record_id: FaiEntry}, BGZF block offsets or None for a plain fasta).
+    """
+    with open(fasta_file, 'rb') as f:
+        bgzf = f.read(4) == b'\x1f\x8b\x08\x04'
+    blocks = None
+    if bgzf:
+        if os.path.exists(fasta_file + '.gzi'):
+            blocks = read_gzi(fasta_file + '.gzi')
+        else:
+            logger.debug('No .gzi index for {}, scanning BGZF blocks.'.format(fasta_file))
+            blocks = scan_bgzf_blocks(fasta_file)
+    return read_fai(fasta_file + '.fai'), blocks
+
+
+class IndexedFasta:
+    """
+    Random access to the records of one faidx indexed fasta.
+    """
+
+    def __init__(self, fasta_file: str, block_cache_size: int = 16, index: tuple = None):
+        self.fasta_file = fasta_file
+        self.index, blocks = index or read_index(fasta_file)
+        self.handle = open(fasta_file, 'rb')
+        self.bgzf = blocks is not None
+        self.block_cache = OrderedDict()
+        self.block_cache_size = block_cache_size
+
+        if self.bgzf:
+            self.coffsets, self.uoffsets = blocks
+
+    def close(self) -> None:
+        self.handle.close()
+        self.block_cache.clear()
+
+    def _read_block(self, coffset: int) -> bytes:
+        block = self.block_cache.get(coffset)
+        if block is not None:
+            self.block_cache.move_to_end(coffset)
+            return block
+
+        self.handle.seek(coffset)
+        header = self.handle.read(BGZF_HEADER_SIZE)
+        block_size = read_bgzf_block_size(header)
+        block = zlib.decompress(header + self.handle.read(block_size - BGZF_HEADER_SIZE), 31)
+
+        self.block_cache[coffset] = block
+        if len(self.block_cache) > self.block_cache_size:
+            self.block_cache.popitem(last=False)
+        return block
+
+    def _read_uncompressed(self, start: int, size: int) -> bytes:
+        if not self.bgzf:
+            self.handle.seek(start)
+            return self.handle.read(size)
+
+        idx = bisect_right(self.uoffsets, start) - 1
+        skip = start - self.uoffsets[idx]
+        chunks = []
+        remaining = size
+        while remaining > 0 and idx < len(self.coffsets):
+            block = self._read_block(self.coffsets[idx])[skip:skip + remaining]
+            chunks.append(block)
+            remaining -= len(block)
+            skip = 0
+            idx += 1
+        return b''.join(chunks)
+
+    def offset(self, record_id: str) -> int:
+        entry = self.index.get(record_id)
+        return entry.offset if entry else -1
+
+    def fetch(self, record_id: str) -> str:
+        """
+        Return '>RECORD\\nSEQUENCE' (same as the samtools path) or None if the record is absent.
+        """
+        entry = self.index.get(record_id)
+        if entry is None:
+            logger.info("Extracting record_id ('{}') from fasta file, RECORD might not exists on fasta: {}.".format(record_id, self.fasta_file))
+            return None
+
+        full_lines, rest = divmod(entry.length, entry.linebases) if entry.linebases else (0, entry.length)
+        raw = self._read_uncompressed(entry.offset, full_lines * entry.linewidth + rest)
+        sequence = raw.replace(b'\n', b'').replace(b'\r', b'')[:entry.length].decode('ascii')
+        return f'>{record_id}\n{sequence}'
+
+
+class IndexedFastaPool:
+    """
+    LRU pool of open IndexedFasta handles (keeps a worker under the fd limit).
+
+    The parsed indexes of every file seen are kept apart from the handles: a
+    file closed by the LRU is reopened without parsing its '.fai'/'.gzi' again.
+    """
+
+    def __init__(self, max_open: int = 256):
+        self.max_open = max_open
+        self.fastas = OrderedDict()
+        self.indexes = {}
+
+    def get(self, fasta_file: str) -> IndexedFasta:
+        fasta = self.fastas.get(fasta_file)
+        if fasta is not None:
+            self.fastas.move_to_end(fasta_file)
+            return fasta
+
+        if fasta_file not in self.indexes:
+            self.indexes[fasta_file] = read_index(fasta_file)
+        fasta = IndexedFasta(fasta_file, index=self.indexes[fasta_file])
+        self.fastas[fasta_file] = fasta
+        if len(self.fastas) > self.max_open:
+            _, oldest = self.fastas.popitem(last=False)
+            oldest.close()
+        return fasta
+
+    def fetch_many(self, requests: list) -> list:
+        """
+        Fetch [(fasta_file, record_id), ...]; results keep the order of requests.
+
+        Requests are served grouped by file and file offset so each file is
+        opened once and its blocks are decompressed once per call.
+        """
+        results = [None] * len(requests)
+        by_file = OrderedDict()
+        for pos, (fasta_file, record_id) in enumerate(requests):
+            by_file.setdefault(fasta_file, []).append((pos, record_id))
+
+        for fasta_file, records in by_file.items():
+            fasta = self.get(fasta_file)
+            for pos, record_id in sorted(records, key=lambda x: fasta.offset(x[1])):
+                results[pos] = fasta.fetch(record_id)
+        return results
+
+    def close(self) -> None:
+        for fasta in self.fastas.values():
+            fasta.close()
+        self.fastas.clear()
+
+
+class BgzfWriter:
+    """
+    Buffered BGZF writer keeping the compressed/uncompressed offsets of every block.
+    """
+
+    def __init__(self, output_file: str, level: int = 6):
+        self.handle = open(output_file, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.coffsets, self.uoffsets = [], []
+        self.coffset = self.uoffset = 0
+
+    def tell(self) -> int:
+        """
+        Uncompressed position of the next written byte.
+        """
+        return self.uoffset + len(self.buffer)
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_DATA:
+            self._flush_block(BGZF_BLOCK_DATA)
+
+    def _flush_block(self, size: int) -> None:
+        block = bgzf_block(bytes(self.buffer[:size]), self.level)
+        if len(block) > BGZF_MAX_BLOCK_SIZE:
+            # Incompressible data: smaller blocks (htslib does the same).
+            self._flush_block(size // 2)
+            return
+        self.handle.write(block)
+        self.coffsets.append(self.coffset)
+        self.uoffsets.append(self.uoffset)
+        self.coffset += len(block)
+        self.uoffset += size
+        del self.buffer[:size]
+
+    def close(self) -> None:
+        while self.buffer:
+            self._flush_block(min(len(self.buffer), BGZF_BLOCK_DATA))
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BgzfFastaWriter:
+    """
+    Write a bgzipped fasta and its '.fai'/'.gzi' indexes in one pass.
+
+    Sequences are written on a single line, to FASTA.tmp renamed on close. The
+    indexes are written after the rename, the '.fai' last, so an existing '.fai'
+    means a complete file set. On an exception in the 'with' block the partial
+    file is removed and no index is written.
+    """
+
+    def __init__(self, fasta_file: str, level: int = 6):
+        self.fasta_file = fasta_file
+        # The '.fai' of a previous file set is no longer true once this one starts.
+        if os.path.exists(fasta_file + '.fai'):
+            os.remove(fasta_file + '.fai')
+        self.writer = BgzfWriter(fasta_file + '.tmp', level=level)
+        self.index = OrderedDict()
+
+    def write(self, record_id: str, sequence: str) -> None:
+        assert record_id not in self.index, 'Duplicated record: {}'.format(record_id)
+        header = '>{}\n'.format(record_id).encode()
+        self.index[record_id] = FaiEntry(len(sequence), self.writer.tell() + len(header), len(sequence), len(sequence) + 1 if sequence else 0)
+        self.writer.write(header + sequence.encode() + b'\n')
+
+    def close(self) -> None:
+        self.writer.close()
+        os.replace(self.fasta_file + '.tmp', self.fasta_file)
+        write_gzi(self.fasta_file + '.gzi', self.writer.coffsets, self.writer.uoffsets)
+        write_fai(self.fasta_file + '.fai', self.index)
+
+    def abort(self) -> None:
+        """
+        Drop the partial file, without indexes.
+        """
+        self.writer.handle.close()
+        os.remove(self.fasta_file + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Cluster-major sequence archive: the core records of every genome grouped by cluster.
+
+    PREFIX.fa            records '>GENOME#CLUSTER\\nSEQUENCE\\n', clusters in name order and the
+                         records of a cluster in header order (same order as the cluster multifastas).
+    PREFIX.index.npy     one row per record (cluster, genome, offset, length) sorted by (cluster, genome),
+                         offsets and lengths of the record text in PREFIX.fa.
+    PREFIX.clusters.txt  cluster names (row number = cluster index).
+    PREFIX.genomes.txt   genome ids (row number = genome index).
+
+Built with an external merge sort: every genome is written as a run sorted by
+cluster (write_run), then the runs are merged (build) at most 'fan_in' at a
+time, so memory does not grow with the number of genomes. ClusterArchive
+memory maps the '.fa' and the index, a cluster is one contiguous slice.
+"""
+
+import os
+import gzip
+import heapq
+import struct
+import logging
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype([('cluster', '<u4'), ('genome', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+# Run record: cluster index, genome index, text length (then the text).
+RUN_RECORD = struct.Struct('<III')
+INDEX_CHUNK_ROWS = 1 << 20
+
+
+def archive_files(prefix: str) -> dict:
+    return {
+        'fasta': prefix + '.fa',
+        'index': prefix + '.index.npy',
+        'clusters': prefix + '.clusters.txt',
+        'genomes': prefix + '.genomes.txt',
+    }
+
+
+def genome_order(genome_ids) -> list:
+    """
+    Genome ids in the order of their records in a cluster multifasta (sorted '>GENOME#CLUSTER' headers).
+    """
+    return sorted(genome_ids, key=lambda genome_id: genome_id + '#')
+
+
+def iter_fasta_records(fasta_file: str):
+    """
+    Stream (record_id, sequence) bytes from a (b)gzipped or plain fasta, sequence lines are joined.
+    """
+    opener = gzip.open if fasta_file.endswith('.gz') else open
+    with opener(fasta_file, 'rb') as f:
+        record_id, sequence = None, []
+        for line in f:
+            if line.startswith(b'>'):
+                if record_id is not None:
+                    yield record_id, b''.join(sequence)
+                header = line[1:].split()
+                record_id, sequence = header[0] if header else b'', []
+            else:
+                sequence.append(line.strip())
+        if record_id is not None:
+            yield record_id, b''.join(sequence)
+
+
+def write_run(run_file: str, genome_idx: int, records) -> int:
+    """
+    Write the (cluster_idx, record_id, sequence) records of one genome sorted by cluster
+    (first record of a cluster kept). Returns the records written.
+    """
+    by_cluster = {}
+    for cluster_idx, record_id, sequence in records:
+        by_cluster.setdefault(cluster_idx, b'>' + record_id + b'\n' + sequence + b'\n')
+    with open(run_file + '.tmp', 'wb') as f_out:
+        for cluster_idx in sorted(by_cluster):
+            text = by_cluster[cluster_idx]
+            f_out.write(RUN_RECORD.pack(cluster_idx, genome_idx, len(text)))
+            f_out.write(text)
+    os.replace(run_file + '.tmp', run_file)
+    return len(by_cluster)
+
+
+def read_run(run_file: str):
+    """
+    Yield the (cluster_idx, genome_idx, text) records of a run file.
+    """
+    with open(run_file, 'rb', buffering=1 << 16) as f:
+        while True:
+            header = f.read(RUN_RECORD.size)
+            if not header:
+                return
+            cluster_idx, genome_idx, length = RUN_RECORD.unpack(header)
+            yield cluster_idx, genome_idx, f.read(length)
+
+
+def merge_runs(run_files: list):
+    return heapq.merge(*map(read_run, run_files))
+
+
+def merge_to_run(run_files: list, output_file: str) -> None:
+    with open(output_file, 'wb', buffering=1 << 16) as f_out:
+        for cluster_idx, genome_idx, text in merge_runs(run_files):
+            f_out.write(RUN_RECORD.pack(cluster_idx, genome_idx, len(text)))
+            f_out.write(text)
+
+
+def reduce_runs(run_files: list, work_prefix: str, fan_in: int, remove_runs: bool = True) -> list:
+    """
+    Merge groups of 'fan_in' runs until at most 'fan_in' are left (intermediate passes of the merge sort).
+    """
+    assert fan_in > 1, 'fan_in must be greater than 1.'
+    merge_pass = 0
+    while len(run_files) > fan_in:
+        merged = []
+        for group_idx in range(0, len(run_files), fan_in):
+            group = run_files[group_idx:group_idx + fan_in]
+            output_file = '{}.merge{}.{}.run'.format(work_prefix, merge_pass, len(merged))
+            merge_to_run(group, output_file)
+            if remove_runs:
+                for run_file in group:
+                    os.remove(run_file)
+            merged.append(output_file)
+        logger.info('Merge pass {}: {} runs -> {}.'.format(merge_pass, len(run_files), len(merged)))
+        run_files, merge_pass, remove_runs = merged, merge_pass + 1, True
+    return run_files
+
+
+def build(prefix: str, run_files: list, clusters: list, genomes: list, fan_in: int = 256, remove_runs: bool = True) -> int:
+    """
+    Merge the genome runs into the archive files of 'prefix'. Returns the archived records.
+    """
+    files = archive_files(prefix)
+    run_files = reduce_runs(list(run_files), prefix, fan_in, remove_runs=remove_runs)
+
+    records, offset = 0, 0
+    rows_file = files['index'] + '.rows.tmp'
+    with open(files['fasta'] + '.tmp', 'wb', buffering=1 << 20) as f_fasta, open(rows_file, 'wb') as f_rows:
+        rows = np.empty(INDEX_CHUNK_ROWS, dtype=INDEX_DTYPE)
+        filled = 0
+        for cluster_idx, genome_idx, text in merge_runs(run_files):
+            rows[filled] = (cluster_idx, genome_idx, offset, len(text))
+            filled += 1
+            if filled == INDEX_CHUNK_ROWS:
+                f_rows.write(rows.tobytes())
+                filled = 0
+            f_fasta.write(text)
+            offset += len(text)
+            records += 1
+        f_rows.write(rows[:filled].tobytes())
+
+    # The row count is only known now: copy the raw rows into the .npy.
+    index = np.lib.format.open_memmap(files['index'] + '.tmp.npy', mode='w+', dtype=INDEX_DTYPE, shape=(records,))
+    for start in range(0, records, INDEX_CHUNK_ROWS):
+        index[start:start + INDEX_CHUNK_ROWS] = np.fromfile(rows_file, dtype=INDEX_DTYPE, count=min(INDEX_CHUNK_ROWS, records - start), offset=start * INDEX_DTYPE.itemsize)
+    index.flush()
+    del index
+    os.remove(rows_file)
+
+    for key, names in (('clusters', clusters), ('genomes', genomes)):
+        with open(files[key] + '.tmp', 'w') as f_out:
+            f_out.writelines(name + '\n' for name in names)
+    for key in ('clusters', 'genomes', 'fasta'):
+        os.replace(files[key] + '.tmp', files[key])
+    # Index last: an index means a complete archive.
+    os.replace(files['index'] + '.tmp.npy', files['index'])
+
+    if remove_runs:
+        for run_file in run_files:
+            os.remove(run_file)
+    logger.info('Archived {} records ({} bytes) of {} clusters: {}'.format(records, offset, len(clusters), files['fasta']))
+    return records
+
+
+class ClusterArchive:
+    """
+    Read only, memory mapped view of an archive (can be opened by any number of processes).
+    """
+
+    def __init__(self, prefix: str):
+        files = archive_files(prefix)
+        with open(files['clusters']) as f:
+            self.clusters = f.read().splitlines()
+        with open(files['genomes']) as f:
+            self.genomes = f.read().splitlines()
+        self.cluster_idx = {name: idx for idx, name in enumerate(self.clusters)}
+        self.genome_idx = {name: idx for idx, name in enumerate(self.genomes)}
+        self.index = np.load(files['index'], mmap_mode='r')
+        if os.path.getsize(files['fasta']):
+            self.data = np.memmap(files['fasta'], dtype=np.uint8, mode='r')
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
+
+    def cluster_rows(self, cluster: str) -> np.ndarray:
+        idx = self.cluster_idx.get(cluster)
+        if idx is None:
+            return self.index[:0]
+        start, end = np.searchsorted(self.index['cluster'], [idx, idx + 1])
+        return self.index[start:end]
+
+    def cluster_bytes(self, cluster: str, genomes: set = None) -> bytes:
+        """
+        Records text of a cluster, one contiguous read (a slice per record when 'genomes' drops some).
+        """
+        rows = self.cluster_rows(cluster)
+        if not len(rows):
+            return b''
+        if genomes is not None:
+            keep = np.fromiter((self.genomes[idx] in genomes for idx in rows['genome'].tolist()), dtype=bool, count=len(rows))
+            if not keep.all():
+                return b''.join(self.data[row['offset']:row['offset'] + row['length']].tobytes() for row in rows[keep])
+        start, end = int(rows['offset'][0]), int(rows['offset'][-1] + rows['length'][-1])
+        return self.data[start:end].tobytes()
+
+    def cluster_fasta(self, cluster: str, genomes: set = None) -> str:
+        """
+        Cluster multifasta as written by assembly_msa_input.py (records joined by '\\n', no trailing newline).
+        """
+        return self.cluster_bytes(cluster, genomes).decode().rstrip('\n')
+
+    def record(self, cluster: str, genome_id: str) -> str:
+        """
+        '>GENOME#CLUSTER\\nSEQUENCE' or None.
+        """
+        genome_idx = self.genome_idx.get(genome_id)
+        rows = self.cluster_rows(cluster)
+        idx = np.searchsorted(rows['genome'], genome_idx) if genome_idx is not None else len(rows)
+        if idx == len(rows) or rows['genome'][idx] != genome_idx:
+            return None
+        row = rows[idx]
+        return self.data[row['offset']:row['offset'] + row['length']].tobytes().decode().rstrip('\n')
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Deterministic cluster fasta names and the 'renamed_fasta_names.csv' manifest.
+
+Manifest rows (no header, first three columns as before):
+    core_cluster,fasta_path,rooted|unrooted,content_hash,inputs_hash,records
+
+'inputs_hash' covers every (fasta_file, record_id) requested for the cluster
+plus the size/mtime of those fasta files, so a cluster is only rebuilt when
+its inputs change. 'content_hash' is the sha1 of the written multifasta and
+is part of the file name, so unchanged clusters keep their file (and every
+downstream alignment/tree built from it).
+"""
+
+import os
+import re
+import hashlib
+import logging
+from collections import namedtuple
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+MANIFEST_NAME = 'renamed_fasta_names.csv'
+CONTENT_HASH_SIZE = 16
+
+CLUSTER_FASTA_RE = re.compile(r'^(.+)\.[0-9a-f]{%d}\.fasta$' % CONTENT_HASH_SIZE)
+
+ManifestEntry = namedtuple('ManifestEntry', 'core_cluster path rooted content_hash inputs_hash records')
+
+
+def slugify(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def cluster_fasta_name(specie: str, core_cluster: str, cluster_content_hash: str) -> str:
+    return '{}.{}.{}.fasta'.format(slugify(specie), slugify(core_cluster), cluster_content_hash[:CONTENT_HASH_SIZE])
+
+
+def cluster_fasta_key(fasta_file: str) -> str:
+    """
+    'SPECIE.CLUSTER' of a cluster fasta name, the same whatever its content (basename of other files).
+    """
+    name = os.path.basename(fasta_file)
+    match = CLUSTER_FASTA_RE.match(name)
+    return match.group(1) if match else name
+
+
+def file_signature(path: str, signatures: dict) -> str:
+    """
+    'size:mtime_ns' of a file, memoized in 'signatures' (one stat per file and run).
+    """
+    signature = signatures.get(path)
+    if signature is None:
+        try:
+            stat = os.stat(path)
+            signature = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature = 'missing'
+        signatures[path] = signature
+    return signature
+
+
+def inputs_hash(requests: list, signatures: dict) -> str:
+    """
+    Hash of the (fasta_file, record_id) requests of a cluster and the state of their files.
+    """
+    digest = hashlib.sha1()
+    for fasta_file, record_id in requests:
+        digest.update('{}\t{}\t{}\n'.format(fasta_file, file_signature(fasta_file, signatures), record_id).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_file: str) -> dict:
+    """
+    {core_cluster: ManifestEntry}; rows from the old 3 column summary have empty hashes (always rebuilt).
+    """
+    manifest = {}
+    if not os.path.exists(manifest_file):
+        return manifest
+    with open(manifest_file, 'r') as f:
+        for line in filter(None, map(str.strip, f)):
+            fields = line.split(',')
+            fields += [''] * (len(ManifestEntry._fields) - len(fields))
+            manifest[fields[0]] = ManifestEntry(*fields[:len(ManifestEntry._fields)])
+    return manifest
+
+
+def write_manifest(manifest_file: str, entries: list) -> None:
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(','.join(map(str, entry)) for entry in sorted(entries)))
+    os.replace(tmp_file, manifest_file)
+
+
+def is_up_to_date(entry: ManifestEntry, cluster_inputs_hash: str) -> bool:
+    return bool(entry and entry.inputs_hash and entry.inputs_hash == cluster_inputs_hash and os.path.exists(entry.path))
+
+
+def finalize_cluster_fasta(output_dir: str, specie: str, core_cluster: str, content: str, previous: ManifestEntry = None) -> tuple:
+    """
+    Write 'content' under its content-addressed name, removing the superseded file of 'previous'.
+
+    An existing file with the same name is left untouched (keeps its mtime). Returns (path, content_hash).
+    """
+    cluster_content_hash = content_hash(content)
+    cluster_fasta_file = os.path.abspath(os.path.join(output_dir, cluster_fasta_name(specie, core_cluster, cluster_content_hash)))
+
+    if not os.path.exists(cluster_fasta_file):
+        tmp_file = cluster_fasta_file + '.tmp'
+        with open(tmp_file, 'w') as f_out:
+            f_out.write(content)
+        os.replace(tmp_file, cluster_fasta_file)
+    else:
+        logger.info("Cluster {} content unchanged: {}".format(core_cluster, cluster_fasta_file))
+
+    if previous and previous.path and previous.path != cluster_fasta_file:
+        remove_stale_fasta(previous.path, output_dir)
+
+    return cluster_fasta_file, cluster_content_hash
+
+
+def remove_stale_fasta(path: str, output_dir: str) -> None:
+    """
+    Remove an output that is no longer referenced by the manifest (only inside output_dir).
+    """
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(output_dir) and os.path.exists(path):
+        logger.info("Removing superseded multifasta: {}".format(path))
+        os.remove(path)
+
+
+def report_changes(plan: dict, manifest: dict) -> dict:
+    """
+    Log and return {'unchanged'|'changed'|'new'|'removed': [core_cluster, ...]}.
+
+    'plan' maps core_cluster -> inputs_hash of the current run.
+    """
+    changes = {'unchanged': [], 'changed': [], 'new': [], 'removed': []}
+    for core_cluster, cluster_inputs_hash in plan.items():
+        entry = manifest.get(core_cluster)
+        if entry is None:
+            changes['new'].append(core_cluster)
+        elif is_up_to_date(entry, cluster_inputs_hash):
+            changes['unchanged'].append(core_cluster)
+        else:
+            changes['changed'].append(core_cluster)
+    changes['removed'] = sorted(set(manifest) - set(plan))
+
+    for status, clusters in changes.items():
+        logger.info("{} clusters: {}".format(status.capitalize(), len(clusters)))
+        for core_cluster in clusters if status != 'unchanged' else []:
+            logger.info("  {}: {}".format(status, core_cluster))
+    return changes
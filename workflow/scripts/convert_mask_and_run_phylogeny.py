@@ -7,58 +7,139 @@ Usage:
     ./convert_mask_and_run_phylogeny.py ( --alignment_fastas_dir=PATH ) ( --output_dir=PATH )
                                         [ --alignment_fastas_suffix=STR ] [ --threads=INT ] [ --use_fasttree ]
                                         [ --bootstrap=INT ] [ --upper_case_aln ] [ --sample_n_genes=INT ]
+                                        [ --mask_backend=STR ] [ --max_gap_frequency=FLOAT ] [ --min_conservation=FLOAT ]
+                                        [ --prep_workers=INT ] [ --qiime_backend=STR ] [ --max_job_threads=INT ]
+                                        [ --bootstrap_shards=INT ] [ --reduce_alignment ] [ --keep_going ]
 
 Options:
     --alignment_fastas_dir=PATH    Input dir with MAFFT aligments to mask.
     --output_dir=PATH              Dir to store output files.
     --alignment_fastas_suffix=STR  Suffix of fasta aligmnets (for find ) [default: .fasta]
     --bootstrap=INT                Number of bootstrap replicats.
-    --use_fasttree                 Use fasttree to generate trees [default: raxml]
+    --use_fasttree                 Use fasttree to generate trees (raxml otherwise).
     --threads=INT                  Number of threads to run phylogeny [default: 1]
     --upper_case_aln               Enchore fasta aln is uppercase: 'acgt' -> 'ACGT'.
     --sample_n_genes=INT         Only run n trees.
+    --mask_backend=STR             'native' (NumPy masking, one qiime import of the masked fasta) or
+                                   'qiime' (qiime import + qiime alignment mask) [default: native].
+    --max_gap_frequency=FLOAT      Max gap frequency of a kept column [default: 1.0].
+    --min_conservation=FLOAT       Min frequency of the most common non-gap character of a kept column [default: 0.4].
+    --prep_workers=INT             Workers for the cheap stages (uppercase, mask, extract), running next to
+                                   the tree jobs (default: threads/4, at least 1).
+    --qiime_backend=STR            'cli' (one 'qiime' subprocess per call) or 'api' (long-lived workers
+                                   calling the qiime2 Artifact/plugin API in-process) [default: cli].
+    --max_job_threads=INT          Max threads given to a single tree job [default: 16].
+    --bootstrap_shards=INT         Split the raxml bootstrap replicates of each gene in this many shards (seeds
+                                   1723 + shard and 9384 + shard) run next to the best tree search, support
+                                   is mapped on the best tree in Python. 1: one qiime raxml-rapid-bootstrap
+                                   job per gene [default: 1].
+    --reduce_alignment             Collapse identical sequences and compress the masked alignment to weighted
+                                   site patterns (GENE.reduced.*), raxml runs on it directly (raxmlHPC -a) and
+                                   the duplicates are grafted back as zero-length sister tips (raxml only).
+    --keep_going                   Exit 0 when some genes failed (their trees are missing), the other trees are kept.
+
+Tree jobs are packed on the --threads cores by a cost model (taxa, columns and
+bootstrap replicates of each alignment, fitted to the runtimes recorded in
+OUTPUT_DIR/tree_runtimes.tsv by previous runs): genes enter the pipeline most
+expensive first, a ready tree job starts when its threads are free, and each job
+gets threads in proportion to its share of the remaining work. With
+--bootstrap_shards the best tree and the shards of a gene are packed as separate
+jobs, the support tree (GENE.GTRCAT.BS.tree) is written when all of them finished.
 """
 
 # native modules
 import os
 import sys
+import math
+import shutil
+import tempfile
+import threading
 import subprocess
-from multiprocessing import Pool
 from pathlib import Path
 from functools import partial
+from collections import Counter
 import random
+import time
 import logging
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
 logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
 
 # 3rd party modules
+import numpy as np
 from docopt import docopt
 
-def convert_alignment_to_qiime2_format(input_file, output_dir, alignment_fastas_suffix):
-    output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace(alignment_fastas_suffix, '.qza'))
+# Local modules
+import stage_trace
+import newick_stream
+from alignment_mask import mask_alignment_file
+from alignment_patterns import reduce_alignment_file, graft_tree_file
 
-    if os.path.exists(output_file_name):
-        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
-        return output_file_name
+# qiime2 modules of a worker, imported once (see qiime2_api).
+QIIME2_API = None
+
+TREE_RUNTIMES_FILE = 'tree_runtimes.tsv'
+TREE_RUNTIMES_COLUMNS = ('gene', 'method', 'taxa', 'columns', 'bootstrap', 'threads', 'seconds')
+# cpu seconds ~ exp(intercept) * taxa^a * columns^b * (1 + bootstrap), until enough runtimes are recorded to fit it.
+DEFAULT_COST_MODEL = (0.0, 2.0, 1.0)
+MIN_FIT_RUNTIMES = 10
+# Threads stop paying off below ~500 alignment columns per raxml thread, fasttree scales to ~4 threads.
+COLUMNS_PER_THREAD = 500
+FASTTREE_MAX_THREADS = 4
+# Seeds of the raxml searches, shard N of a sharded bootstrap uses seed + N.
+RAXML_SEED = 1723
+RAXML_BOOTSTRAP_SEED = 9384
+REDUCED_SUFFIX = '.reduced.fasta'
+# raxml refuses alignments with fewer sequences.
+RAXML_MIN_TAXA = 4
+
+def qiime2_api():
+    """
+    Import qiime2 and the plugins used here once per process (pool initializer for the 'api' backend).
+    """
+    global QIIME2_API
+    if QIIME2_API is None:
+        import qiime2
+        from qiime2.plugins import alignment, phylogeny
+        QIIME2_API = {
+            'Artifact': qiime2.Artifact,
+            'alignment': alignment.actions,
+            'phylogeny': phylogeny.actions,
+        }
+    return QIIME2_API
+
+def qiime2_import_alignment(input_file, output_file_name, backend='cli'):
+    if backend == 'api':
+        qiime2_api()['Artifact'].import_data('FeatureData[AlignedSequence]', input_file).save(output_file_name)
+        return
 
-    logger.info('Coverting {} to qiime2 format.'.format(input_file))
     cmd = [
         'qiime',
         'tools',
         'import',
-        '--input-path', input_file ,
+        '--input-path', input_file,
         '--output-path', output_file_name,
         '--type', "FeatureData[AlignedSequence]"
     ]
 
-    subprocess.run(
+    stage_trace.run(
         cmd,
         check=True,
     )
+
+def convert_alignment_to_qiime2_format(input_file, output_dir, alignment_fastas_suffix, backend='cli'):
+    output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace(alignment_fastas_suffix, '.qza'))
+
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    logger.info('Coverting {} to qiime2 format.'.format(input_file))
+    qiime2_import_alignment(input_file, output_file_name, backend=backend)
     logger.info('Finished Covertion: {}.'.format(input_file))
 
     return output_file_name
 
-def mask_alignments(input_file, output_dir):
+def mask_alignments(input_file, output_dir, max_gap_frequency=1.0, min_conservation=0.4, backend='cli'):
     output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.qza', '.masked.qza'))
 
     logger.info('Masking: {}.'.format(input_file))
@@ -72,20 +153,99 @@ def mask_alignments(input_file, output_dir):
         'mask',
         '--i-alignment', input_file,
         '--o-masked-alignment', output_file_name,
+        '--p-max-gap-frequency', str(max_gap_frequency),
+        '--p-min-conservation', str(min_conservation),
     ]
 
-    subprocess.run(
-        cmd,
-        check=True,
-    )
+    if backend == 'api':
+        api = qiime2_api()
+        api['alignment'].mask(
+            alignment=api['Artifact'].load(input_file),
+            max_gap_frequency=max_gap_frequency,
+            min_conservation=min_conservation,
+        ).masked_alignment.save(output_file_name)
+    else:
+        stage_trace.run(
+            cmd,
+            check=True,
+        )
     logger.info('Finished Mask: {}.'.format(input_file))
 
     return output_file_name
 
-def run_raxml(input_file, output_dir, threads, bootstrap=None):
+def mask_alignment_native(input_file, output_dir, alignment_fastas_suffix, max_gap_frequency=1.0, min_conservation=0.4, backend='cli'):
+    """
+    Mask the fasta alignment with NumPy and import only the masked alignment to qiime2.
+    """
+    masked_fasta = os.path.join(output_dir, os.path.basename(input_file).replace(alignment_fastas_suffix, '.masked.fasta'))
+    output_file_name = masked_fasta.replace('.masked.fasta', '.masked.qza')
+
+    logger.info('Masking: {}.'.format(input_file))
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    kept, total = mask_alignment_file(input_file, masked_fasta, max_gap_frequency=max_gap_frequency, min_conservation=min_conservation)
+    logger.info('Masked {}: {}/{} columns kept.'.format(input_file, kept, total))
+
+    qiime2_import_alignment(masked_fasta, output_file_name, backend=backend)
+    logger.info('Finished Mask: {}.'.format(input_file))
+
+    return output_file_name
+
+def reduce_masked_alignment(input_file, output_dir, backend='cli'):
+    """
+    GENE.reduced.fasta (+ .weights, .duplicates.tsv) of a masked alignment, see alignment_patterns.py.
+
+    The masked alignment itself when fewer than RAXML_MIN_TAXA distinct sequences are left (its
+    tree is then inferred by run_raxml, as without reduction).
+    """
+    output_prefix = gene_prefix(input_file, output_dir) + REDUCED_SUFFIX.replace('.fasta', '')
+    output_file_name = output_prefix + '.fasta'
+
+    logger.info('Reducing: {}.'.format(input_file))
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    work_dir = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(output_file_name)), dir=output_dir)
+    try:
+        sizes = reduce_alignment_file(masked_alignment_fasta(input_file, work_dir, backend=backend), output_prefix)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logger.info('Reduced {}: {}/{} rows, {}/{} columns as {} site patterns ({:.1f}x fewer cells).'.format(
+        input_file, sizes['unique_rows'], sizes['rows'], sizes['determined_columns'], sizes['columns'], sizes['patterns'],
+        sizes['rows'] * sizes['columns'] / max(1, sizes['unique_rows'] * sizes['patterns']),
+    ))
+
+    if sizes['unique_rows'] < RAXML_MIN_TAXA:
+        logger.warning('Only {} distinct sequences in {}, the tree is inferred on the unreduced alignment.'.format(sizes['unique_rows'], input_file))
+        for suffix in ('.fasta', '.weights', '.duplicates.tsv'):
+            os.remove(output_prefix + suffix)
+        return input_file
+
+    return output_file_name
+
+def gene_prefix(input_file, output_dir):
+    name = os.path.basename(input_file)
+    for suffix in ('.masked.qza', REDUCED_SUFFIX):
+        if name.endswith(suffix):
+            return os.path.join(output_dir, name[:-len(suffix)])
+    return os.path.join(output_dir, name)
+
+def tree_output_file(input_file, output_dir, bootstrap=None):
+    """
+    Tree artifact of a masked alignment, newick tree of a reduced one (raxml run outside qiime).
+    """
+    suffix = '.GTRCAT.BS.tree' if bootstrap else '.GTRCAT.tree'
+    if not input_file.endswith(REDUCED_SUFFIX):
+        suffix += '.qza'
+    return gene_prefix(input_file, output_dir) + suffix
+
+def run_raxml(input_file, output_dir, threads, bootstrap=None, backend='cli'):
+    output_file_name = tree_output_file(input_file, output_dir, bootstrap)
     if bootstrap:
         logger.info('Bootstrap is active: {} replicates.'.format(bootstrap))
-        output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.masked.qza', '.GTRCAT.BS.tree.qza'))
         cmd = [
             'qiime',
             'phylogeny',
@@ -100,7 +260,6 @@ def run_raxml(input_file, output_dir, threads, bootstrap=None):
         ]
     else:
         logger.info('Bootstrap is deactivated.'.format(bootstrap))
-        output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.masked.qza', '.GTRCAT.tree.qza'))
         cmd = [
             'qiime',
             'phylogeny',
@@ -117,24 +276,114 @@ def run_raxml(input_file, output_dir, threads, bootstrap=None):
         logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
         return output_file_name
 
-    subprocess.run(
-        cmd,
-        check=True,
-    )
+    if backend == 'api':
+        api = qiime2_api()
+        alignment = api['Artifact'].load(input_file)
+        if bootstrap:
+            result = api['phylogeny'].raxml_rapid_bootstrap(
+                alignment=alignment,
+                seed=1723,
+                rapid_bootstrap_seed=9384,
+                bootstrap_replicates=int(bootstrap),
+                substitution_model='GTRCAT',
+                n_threads=threads,
+            )
+        else:
+            result = api['phylogeny'].raxml(
+                alignment=alignment,
+                seed=1723,
+                substitution_model='GTRCAT',
+                n_threads=threads,
+            )
+        result.tree.save(output_file_name)
+    else:
+        stage_trace.run(
+            cmd,
+            check=True,
+        )
 
     logger.info('Finished tree: {}.'.format(input_file))
 
     return output_file_name
 
-def extract_tree_from_qiime2(input_file, output_dir):
-    output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.GTRCAT.tree.qza', '.GTRCAT.tree'))
+def raxml_command(alignment, work_dir, run_name, threads, input_file):
+    """
+    raxml GTRCAT command on 'alignment', with the site pattern weights of a reduced alignment.
+    """
+    cmd = [
+        'raxmlHPC-PTHREADS' if threads > 1 else 'raxmlHPC',
+        '-m', 'GTRCAT',
+        '-s', alignment,
+        '-n', run_name,
+        '-w', work_dir,
+    ]
+    if input_file.endswith(REDUCED_SUFFIX):
+        cmd += ['-a', input_file.replace(REDUCED_SUFFIX, '.reduced.weights')]
+    if threads > 1:
+        cmd += ['-T', str(threads)]
+    return cmd
+
+def link_alignment(fasta_file, work_dir):
+    # raxml writes the .reduced alignment next to its input: linked into the work dir, jobs do not collide.
+    alignment = os.path.join(work_dir, 'alignment.fasta')
+    os.symlink(os.path.abspath(fasta_file), alignment)
+    return alignment
+
+def move_raxml_trees(raxml_file, input_file, output_file_name):
+    """
+    Move raxml trees to 'output_file_name', with the duplicates grafted back for a reduced alignment.
+    """
+    if input_file.endswith(REDUCED_SUFFIX):
+        graft_tree_file(raxml_file, input_file.replace(REDUCED_SUFFIX, '.reduced.duplicates.tsv'), output_file_name)
+    else:
+        os.replace(raxml_file, output_file_name)
+
+def run_raxml_reduced(input_file, output_dir, threads, bootstrap=None, backend='cli'):
+    """
+    raxml on a reduced alignment (same seeds as run_raxml, rapid bootstrap and best tree search in one
+    run with -f a), writes the newick tree with the duplicates grafted back.
+
+    A masked alignment left unreduced (see reduce_masked_alignment) goes through run_raxml, its tree is extracted.
+    """
+    if not input_file.endswith(REDUCED_SUFFIX):
+        tree_file = run_raxml(input_file, output_dir, threads, bootstrap=bootstrap, backend=backend)
+        return extract_tree_from_qiime2(tree_file, output_dir, backend=backend)
+
+    output_file_name = tree_output_file(input_file, output_dir, bootstrap)
+
+    logger.info('Running tree for: {}.'.format(input_file))
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    work_dir = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(output_file_name)), dir=output_dir)
+    try:
+        cmd = raxml_command(link_alignment(input_file, work_dir), work_dir, 'tree', threads, input_file) + ['-p', str(RAXML_SEED)]
+        if bootstrap:
+            logger.info('Bootstrap is active: {} replicates.'.format(bootstrap))
+            cmd += ['-f', 'a', '-x', str(RAXML_BOOTSTRAP_SEED), '-N', str(bootstrap)]
+        stage_trace.run(
+            cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        move_raxml_trees(os.path.join(work_dir, ('RAxML_bipartitions.' if bootstrap else 'RAxML_bestTree.') + 'tree'), input_file, output_file_name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.info('Finished tree: {}.'.format(input_file))
+
+    return output_file_name
+
+def extract_tree_from_qiime2(input_file, output_dir, backend='cli'):
+    output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.tree.qza', '.tree'))
 
     logger.info('Extracting tree from: {}.'.format(input_file))
     if os.path.exists(output_file_name):
         logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
         return output_file_name
 
-    dir_output = os.path.join(output_dir, os.path.basename(input_file).replace('.GTRCAT.tree.qza', ''))
+    dir_output = os.path.join(output_dir, os.path.basename(input_file).replace('.tree.qza', ''))
 
     cmd = [
         'qiime',
@@ -144,10 +393,13 @@ def extract_tree_from_qiime2(input_file, output_dir):
         '--output-path', dir_output,
     ]
 
-    subprocess.run(
-        cmd,
-        check=True,
-    )
+    if backend == 'api':
+        qiime2_api()['Artifact'].load(input_file).export_data(dir_output)
+    else:
+        stage_trace.run(
+            cmd,
+            check=True,
+        )
 
     extracted_tree = os.path.join(dir_output, 'tree.nwk')
 
@@ -161,6 +413,117 @@ def extract_tree_from_qiime2(input_file, output_dir):
 
     return output_file_name
 
+def bootstrap_shard_sizes(bootstrap, shards):
+    """
+    Replicates of each shard (at most one replicate per shard more than the others).
+    """
+    shards = max(1, min(int(shards), int(bootstrap)))
+    return [bootstrap // shards + (1 if shard_idx < bootstrap % shards else 0) for shard_idx in range(shards)]
+
+def bootstrap_shard_file(input_file, output_dir, shard_idx):
+    return gene_prefix(input_file, output_dir) + '.GTRCAT.BS.shard{}.trees'.format(shard_idx)
+
+def masked_alignment_fasta(input_file, work_dir, backend='cli'):
+    """
+    Fasta of a masked alignment artifact: the one written by the native mask, exported otherwise.
+    """
+    if input_file.endswith(REDUCED_SUFFIX):
+        return input_file
+    masked_fasta = input_file.replace('.masked.qza', '.masked.fasta')
+    if os.path.exists(masked_fasta):
+        return masked_fasta
+
+    dir_output = os.path.join(work_dir, 'alignment')
+    if backend == 'api':
+        qiime2_api()['Artifact'].load(input_file).export_data(dir_output)
+    else:
+        stage_trace.run(
+            ['qiime', 'tools', 'export', '--input-path', input_file, '--output-path', dir_output],
+            check=True,
+        )
+    return os.path.join(dir_output, 'aligned-dna-sequences.fasta')
+
+def run_raxml_bootstrap_shard(input_file, output_dir, threads, shard_idx, replicates, backend='cli'):
+    """
+    Rapid bootstrap replicates of one shard (raxml -x, own seeds), the replicate trees are kept in GENE.GTRCAT.BS.shardN.trees.
+    """
+    output_file_name = bootstrap_shard_file(input_file, output_dir, shard_idx)
+
+    logger.info('Running bootstrap shard {} ({} replicates) for: {}.'.format(shard_idx, replicates, input_file))
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    work_dir = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(output_file_name)), dir=output_dir)
+    try:
+        alignment = link_alignment(masked_alignment_fasta(input_file, work_dir, backend=backend), work_dir)
+        run_name = 'shard{}'.format(shard_idx)
+        cmd = raxml_command(alignment, work_dir, run_name, threads, input_file) + [
+            '-p', str(RAXML_SEED + shard_idx),
+            '-x', str(RAXML_BOOTSTRAP_SEED + shard_idx),
+            '-N', str(replicates),
+        ]
+        stage_trace.run(
+            cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        move_raxml_trees(os.path.join(work_dir, 'RAxML_bootstrap.' + run_name), input_file, output_file_name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.info('Finished bootstrap shard {}: {}.'.format(shard_idx, input_file))
+
+    return output_file_name
+
+def map_bootstrap_support(input_file, output_dir, bootstrap, shards, threads=1, backend='cli'):
+    """
+    Write GENE.GTRCAT.BS.tree: the best tree with the support of the replicates of all shards.
+    """
+    output_file_name = gene_prefix(input_file, output_dir) + '.GTRCAT.BS.tree'
+
+    logger.info('Mapping bootstrap support for: {}.'.format(input_file))
+    if os.path.exists(output_file_name):
+        logger.info('File alredy exits, skiping creation: {}'.format(output_file_name))
+        return output_file_name
+
+    best_tree_file = tree_output_file(input_file, output_dir)
+    if best_tree_file.endswith('.qza'):
+        best_tree_file = extract_tree_from_qiime2(best_tree_file, output_dir, backend=backend)
+    with open(best_tree_file, 'r') as f:
+        best_tree = f.read()
+
+    bits = newick_stream.leaf_bits(best_tree)
+    counts, trees = Counter(), 0
+    for shard_idx in range(len(bootstrap_shard_sizes(bootstrap, shards))):
+        with open(bootstrap_shard_file(input_file, output_dir, shard_idx), 'r') as f:
+            shard_counts, shard_trees = newick_stream.count_splits(f, bits)
+        counts.update(shard_counts)
+        trees += shard_trees
+    assert trees == bootstrap, 'Expected {} bootstrap trees for {}, found {}.'.format(bootstrap, input_file, trees)
+
+    with open(output_file_name + '.tmp', 'w') as f_out:
+        f_out.write(newick_stream.map_support(best_tree, counts, trees))
+    os.replace(output_file_name + '.tmp', output_file_name)
+    logger.info('Finished bootstrap support ({} trees): {}.'.format(trees, input_file))
+
+    return output_file_name
+
+def bootstrap_shard_jobs(name, function, input_file, output_dir, bootstrap, shards, backend='cli'):
+    """
+    (output file, [(name, function, cost fraction), ...], (name, merge function)) of a gene with sharded
+    bootstrap: the best tree search (one replicate worth of work) and the shards, then the support mapping.
+    """
+    sizes = bootstrap_shard_sizes(bootstrap, shards)
+    # The tree stage function without bootstrap: best tree search only.
+    parts = [(name, partial(function, bootstrap=None), 1 / (1 + bootstrap))]
+    parts += [
+        ('bootstrap', partial(run_raxml_bootstrap_shard, output_dir=output_dir, shard_idx=shard_idx, replicates=replicates, backend=backend), replicates / (1 + bootstrap))
+        for shard_idx, replicates in enumerate(sizes)
+    ]
+    merge = ('support', partial(map_bootstrap_support, output_dir=output_dir, bootstrap=bootstrap, shards=shards, backend=backend))
+    return gene_prefix(input_file, output_dir) + '.GTRCAT.BS.tree', parts, merge
+
 def uppercase_aln_fasta(input_file, output_dir):
     output_file_name = os.path.join(output_dir, os.path.basename(input_file))
 
@@ -170,7 +533,7 @@ def uppercase_aln_fasta(input_file, output_dir):
         return output_file_name
 
     cmd = "awk '/^>/ {{print($0)}}; /^[^>]/ {{print(toupper($0))}}' {} > {}".format(input_file, output_file_name)
-    subprocess.run(
+    stage_trace.run(
         cmd,
         check=True,
         shell=True,
@@ -178,8 +541,8 @@ def uppercase_aln_fasta(input_file, output_dir):
     logger.info('Finished Uppercase file: {}.'.format(input_file))
     return output_file_name
 
-def run_fasttree(input_file, output_dir, threads):
-    output_file_name = os.path.join(output_dir, os.path.basename(input_file).replace('.masked.qza', '.GTRCAT.tree.qza'))
+def run_fasttree(input_file, output_dir, threads, backend='cli'):
+    output_file_name = tree_output_file(input_file, output_dir)
 
     logger.info('Running tree for: {}.'.format(input_file))
     if os.path.exists(output_file_name):
@@ -195,15 +558,316 @@ def run_fasttree(input_file, output_dir, threads):
         '--p-n-threads', str(threads),
     ]
 
-    subprocess.run(
-        cmd,
-        check=True,
-    )
+    if backend == 'api':
+        api = qiime2_api()
+        api['phylogeny'].fasttree(alignment=api['Artifact'].load(input_file), n_threads=threads).tree.save(output_file_name)
+    else:
+        stage_trace.run(
+            cmd,
+            check=True,
+        )
 
     logger.info('Tree finished: {}.'.format(input_file))
 
     return output_file_name
 
+def alignment_dimensions(fasta_file):
+    """
+    (taxa, columns) of a fasta alignment.
+    """
+    taxa, columns = 0, 0
+    with open(fasta_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                taxa += 1
+            elif taxa == 1:
+                columns += len(line.strip())
+    return taxa, columns
+
+def read_tree_runtimes(runtimes_file):
+    if not os.path.exists(runtimes_file):
+        return []
+    with open(runtimes_file, 'r') as f:
+        header = next(f, '').strip().split('\t')
+        return [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f if line.strip()]
+
+def write_tree_runtimes(runtimes_file, rows):
+    """
+    Merge this run's rows into the runtimes table (latest observation per gene, method and bootstrap wins).
+    """
+    key = lambda row: (row.get('gene'), row.get('method'), str(row.get('bootstrap')))
+    table = {key(row): row for row in read_tree_runtimes(runtimes_file)}
+    for row in rows:
+        table[key(row)] = row
+    with open(runtimes_file + '.tmp', 'w') as f:
+        f.write('\t'.join(TREE_RUNTIMES_COLUMNS) + '\n')
+        for row in table.values():
+            f.write('\t'.join(str(row.get(column, '')) for column in TREE_RUNTIMES_COLUMNS) + '\n')
+    os.replace(runtimes_file + '.tmp', runtimes_file)
+
+def fit_cost_model(runtimes):
+    """
+    (intercept, taxa exponent, columns exponent) of log(cpu seconds / (1 + bootstrap)) fitted to the
+    recorded runtimes; the default exponents with a median scale when there are too few of them.
+    """
+    observations = []
+    for row in runtimes:
+        try:
+            taxa, columns, bootstrap = int(row['taxa']), int(row['columns']), int(row['bootstrap'] or 0)
+            cpu_seconds = float(row['threads']) * float(row['seconds'])
+        except (KeyError, ValueError):
+            continue
+        if taxa > 0 and columns > 0 and cpu_seconds > 0:
+            observations.append((math.log(taxa), math.log(columns), math.log(cpu_seconds / (1 + bootstrap))))
+    if not observations:
+        return DEFAULT_COST_MODEL
+
+    log_taxa, log_columns, log_seconds = map(np.array, zip(*observations))
+    if len(observations) >= MIN_FIT_RUNTIMES and np.ptp(log_taxa) > 0 and np.ptp(log_columns) > 0:
+        design = np.column_stack([np.ones(len(observations)), log_taxa, log_columns])
+        intercept, taxa_exponent, columns_exponent = np.linalg.lstsq(design, log_seconds, rcond=None)[0]
+        if 0.5 <= taxa_exponent <= 3 and 0.5 <= columns_exponent <= 3:
+            return float(intercept), float(taxa_exponent), float(columns_exponent)
+
+    _, taxa_exponent, columns_exponent = DEFAULT_COST_MODEL
+    intercept = np.median(log_seconds - taxa_exponent * log_taxa - columns_exponent * log_columns)
+    return float(intercept), taxa_exponent, columns_exponent
+
+def estimate_tree_cost(model, taxa, columns, bootstrap):
+    intercept, taxa_exponent, columns_exponent = model
+    return math.exp(intercept) * max(1, taxa) ** taxa_exponent * max(1, columns) ** columns_exponent * (1 + (bootstrap or 0))
+
+def tree_cost_model(runtimes, method, bootstrap):
+    """
+    (cost model fitted to the runtimes of 'method', {gene: recorded cpu seconds with the same bootstrap}).
+    """
+    runtimes = [row for row in runtimes if row.get('method') == method]
+    model = fit_cost_model(runtimes)
+    observed = {}
+    for row in runtimes:
+        if row.get('bootstrap') == str(bootstrap or 0):
+            try:
+                observed[row['gene']] = float(row['threads']) * float(row['seconds'])
+            except (KeyError, ValueError):
+                continue
+    return model, observed
+
+def plan_tree_costs(input_files, runtimes, method, bootstrap):
+    """
+    {input_file: (expected cpu seconds, taxa, columns)}: recorded cpu seconds of a gene when
+    it was run before with the same method and bootstrap, the cost model otherwise.
+
+    Estimated on the unmasked alignments, only to order the genes entering the pipeline: the
+    TreeJobPacker estimates the cost again on the masked alignment when the tree job is submitted.
+    """
+    model, observed = tree_cost_model(runtimes, method, bootstrap)
+    logger.info('Tree cost model ({} recorded {} runtimes): cpu_seconds = {:.3g} * taxa^{:.2f} * columns^{:.2f} * (1 + bootstrap).'.format(
+        sum(row.get('method') == method for row in runtimes), method, math.exp(model[0]), model[1], model[2],
+    ))
+    costs = {}
+    for input_file in input_files:
+        taxa, columns = alignment_dimensions(input_file)
+        cost = observed.get(os.path.basename(input_file), estimate_tree_cost(model, taxa, columns, bootstrap))
+        costs[input_file] = (cost, taxa, columns)
+    return costs
+
+def timed_tree_job(name, function, gene, input_file, threads):
+    start = time.perf_counter()
+    with stage_trace.span(name, item=os.path.basename(gene), threads=threads):
+        output_file = function(input_file, threads=threads)
+    return output_file, time.perf_counter() - start
+
+class TreeJobPacker:
+    """
+    Executor-like front of the tree executor keeping the tree jobs within a budget of 'threads' cores.
+
+    Submitted jobs wait until their threads are free, the most expensive waiting job that fits starts
+    first (smaller ones backfill). A job gets threads in proportion to its cost over the fair share
+    of the work not started yet (remaining cost / threads), capped by its size. With a cost 'model',
+    the cost of a gene without 'observed' runtime is estimated again on its masked alignment (the
+    planned costs are estimated before masking).
+
+    'split_job(name, function, input_file)' may split a gene in parts (e.g. bootstrap shards), each
+    packed as a job with its fraction of the gene cost, and a merge job run (first, on one thread)
+    when all parts finished; the cpu seconds of all of them are recorded as the gene runtime.
+    """
+
+    def __init__(self, executor, threads, max_job_threads, costs, method, bootstrap, output_dir, split_job=None, model=None, observed=None):
+        self.executor = executor
+        self.threads = threads
+        self.free_threads = threads
+        self.max_job_threads = max_job_threads
+        self.costs = costs
+        self.remaining_cost = sum(cost for cost, _, _ in costs.values())
+        self.method = method
+        self.bootstrap = bootstrap or 0
+        self.output_dir = output_dir
+        self.split_job = split_job
+        self.model = model
+        self.observed = observed or {}
+        self.pending = []
+        self.rows = []
+        # Re-entrant: a job finishing right away calls back into start_jobs.
+        self.lock = threading.RLock()
+
+    def job_threads(self, cost, columns):
+        size_cap = FASTTREE_MAX_THREADS if self.method == 'fasttree' else max(1, columns // COLUMNS_PER_THREAD)
+        fair_share = max(self.remaining_cost, cost) / self.threads
+        wanted = math.ceil(cost / fair_share) if fair_share else 1
+        return max(1, min(self.threads, self.max_job_threads, size_cap, wanted))
+
+    def split(self, name, function, input_file):
+        if self.split_job:
+            return self.split_job(name, function, input_file)
+        output_file = tree_output_file(input_file, self.output_dir, self.bootstrap if self.method != 'fasttree' else None)
+        return output_file, [(name, function, 1.0)], None
+
+    def masked_cost(self, gene, input_file):
+        """
+        (cost, taxa, columns) of a gene from the alignment given to the tree program when it is a fasta
+        (native mask or reduced alignment), the planned ones otherwise.
+        """
+        planned = self.costs.get(gene, (0, 0, 0))
+        if input_file.endswith(REDUCED_SUFFIX):
+            masked_fasta = input_file
+        elif input_file.endswith('.masked.qza'):
+            masked_fasta = input_file.replace('.masked.qza', '.masked.fasta')
+        else:
+            return planned
+        if self.model is None or not os.path.exists(masked_fasta):
+            return planned
+        taxa, columns = alignment_dimensions(masked_fasta)
+        cost = self.observed.get(os.path.basename(gene), estimate_tree_cost(self.model, taxa, columns, self.bootstrap))
+        return cost, taxa, columns
+
+    def submit(self, traced_stage, name, function, gene, input_file):
+        future = Future()
+        cost, taxa, columns = self.masked_cost(gene, input_file)
+        output_file, parts, merge = self.split(name, function, input_file)
+        group = {
+            'future': future, 'gene': gene, 'input_file': input_file, 'taxa': taxa, 'columns': columns,
+            'parts': len(parts), 'merge': merge, 'tree_exists': os.path.exists(output_file), 'jobs': [],
+        }
+        with self.lock:
+            self.remaining_cost += cost - self.costs.get(gene, (0, 0, 0))[0]
+            self.costs[gene] = (cost, taxa, columns)
+            for part_name, part_function, fraction in parts:
+                self.pending.append((False, cost * fraction, part_name, part_function, group))
+            self.start_jobs()
+        return future
+
+    def start_jobs(self):
+        # Merges first (their gene is done but for them), then by cost.
+        self.pending.sort(key=lambda job: job[:2], reverse=True)
+        idx = 0
+        while idx < len(self.pending) and self.free_threads:
+            is_merge, cost, name, function, group = self.pending[idx]
+            threads = 1 if is_merge else self.job_threads(cost, group['columns'])
+            if threads > self.free_threads:
+                idx += 1
+                continue
+            self.pending.pop(idx)
+            self.free_threads -= threads
+            self.remaining_cost -= cost
+            job = self.executor.submit(timed_tree_job, name, function, group['gene'], group['input_file'], threads)
+            job.add_done_callback(partial(self.finished, group, is_merge, threads))
+
+    def finished(self, group, is_merge, threads, job):
+        with self.lock:
+            self.free_threads += threads
+            if not is_merge:
+                group['parts'] -= 1
+            try:
+                output_file, seconds = job.result()
+            except Exception as e:
+                if not group['future'].done():
+                    group['future'].set_exception(e)
+            else:
+                group['jobs'].append((threads, seconds))
+                if group['future'].done() or group['parts']:
+                    pass
+                elif group['merge'] and not is_merge:
+                    self.pending.append((True, 0.0, *group['merge'], group))
+                else:
+                    self.record(group)
+                    group['future'].set_result(output_file)
+            self.start_jobs()
+
+    def record(self, group):
+        if group['tree_exists']:
+            return
+        jobs = group['jobs']
+        threads, seconds = jobs[0] if len(jobs) == 1 else (1, sum(threads * seconds for threads, seconds in jobs))
+        self.rows.append({
+            'gene': os.path.basename(group['gene']), 'method': self.method, 'taxa': group['taxa'], 'columns': group['columns'],
+            'bootstrap': self.bootstrap, 'threads': threads, 'seconds': f'{seconds:.3f}',
+        })
+
+def traced_stage(name, function, gene, input_file):
+    with stage_trace.span(name, item=os.path.basename(gene)):
+        return function(input_file)
+
+def run_pipeline(input_files, stages, keep_going=False):
+    """
+    Move every gene through 'stages' [(name, function, executor), ...] as soon
+    as its previous stage finishes (no barrier between stages).
+
+    Each stage function takes the previous stage output file. Progress
+    counters per stage are logged on every completion. Returns the outputs
+    of the last stage; failed genes are logged and left out, then a
+    RuntimeError is raised unless keep_going.
+    """
+    total = len(input_files)
+    counters = {name: {'submitted': 0, 'done': 0, 'failed': 0} for name, _, _ in stages}
+    running = {}
+    results = []
+    last_report = 0.0
+
+    def submit(stage_idx, input_file, gene):
+        name, function, executor = stages[stage_idx]
+        running[executor.submit(traced_stage, name, function, gene, input_file)] = (stage_idx, gene)
+        counters[name]['submitted'] += 1
+
+    def report(force=False):
+        nonlocal last_report
+        if force or time.monotonic() - last_report >= 10:
+            last_report = time.monotonic()
+            logger.info('[progress] ' + ' | '.join(
+                '{} {}/{} ({} in flight{})'.format(
+                    name, c['done'], total, c['submitted'] - c['done'] - c['failed'],
+                    ', {} failed'.format(c['failed']) if c['failed'] else '',
+                ) for name, c in counters.items()
+            ))
+
+    for input_file in input_files:
+        submit(0, input_file, input_file)
+
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage_idx, gene = running.pop(future)
+            name = stages[stage_idx][0]
+            try:
+                output_file = future.result()
+            except Exception as e:
+                counters[name]['failed'] += 1
+                logger.error('Stage {} failed for {}: {}'.format(name, gene, e))
+                continue
+            counters[name]['done'] += 1
+            if stage_idx + 1 < len(stages):
+                submit(stage_idx + 1, output_file, gene)
+            else:
+                results.append(output_file)
+        report()
+
+    report(force=True)
+    failed = sum(c['failed'] for c in counters.values())
+    if failed:
+        logger.error('{} genes failed, see the errors above.'.format(failed))
+        if not keep_going:
+            raise RuntimeError('{} of {} genes failed.'.format(failed, total))
+    return results
+
 def main(*args, **kwargs):
 
     # Logging setup
@@ -218,14 +882,9 @@ def main(*args, **kwargs):
     logger.info('ARGS: {}'.format(kwargs))
 
     threads = int(kwargs['--threads'])
-    assert threads >= 1, 'Threads need to be more equal than 1'
-    raxml_threads = 4
-    if threads < raxml_threads:
-        raxml_threads = 1
-    raxml_instances = max(1, int(threads/raxml_threads))
+    max_job_threads = int(kwargs['--max_job_threads'])
+    assert threads >= 1 and max_job_threads >= 1, 'Threads need to be more equal than 1'
     logger.info('Running with {} threads.'.format(threads))
-    logger.info('Running with {} raxml_instances.'.format(raxml_instances))
-    logger.info('Running with {} raxml_threads.'.format(raxml_threads))
 
     kwargs['--alignment_fastas_dir'] = os.path.abspath(kwargs['--alignment_fastas_dir'])
     kwargs['--output_dir'] = os.path.abspath(kwargs['--output_dir'])
@@ -255,82 +914,124 @@ def main(*args, **kwargs):
         find_list = random.sample(find_list, int(kwargs['--sample_n_genes']))
         logger.info('Length of input fastas after sampling: {}'.format(len(find_list)))
 
-    if kwargs['--upper_case_aln']:
-        logger.info('MAKING SHORE ALIGNMENTS ARE UPPERCASED')
-        with Pool(processes=threads) as p:
-            find_list = p.map(
-                partial(
-                    uppercase_aln_fasta,
-                    output_dir=kwargs['--output_dir'],
-                ),
-                find_list
-            )
-
     assert find_list, 'No files found at {} with suffix {}'.format(kwargs['--alignment_fastas_dir'], kwargs['--alignment_fastas_suffix'])
 
-    logger.info('Converting alignments to qiime2 format ...')
-    with Pool(processes=threads) as p:
-        converted_files = p.map(
-            partial(
-                convert_alignment_to_qiime2_format,
-                output_dir=kwargs['--output_dir'],
-                alignment_fastas_suffix=kwargs['--alignment_fastas_suffix'],
-            ),
-            find_list,
-        )
-    logger.info('Finished alignments convertion.')
-
-    logger.info('Masking alignments ...')
-    with Pool(processes=threads) as p:
-        masked_files = p.map(
-            partial(
-                mask_alignments,
-                output_dir=kwargs['--output_dir'],
-            ),
-            converted_files,
-        )
-
+    max_gap_frequency = float(kwargs['--max_gap_frequency'])
+    min_conservation = float(kwargs['--min_conservation'])
 
     if kwargs['--bootstrap']:
         kwargs['--bootstrap'] = int(kwargs['--bootstrap'])
         assert kwargs['--bootstrap'] >= 1, 'Invalid bootstrap value.'
         logger.info("Bootstrap is active: {} replicates".format(kwargs['--bootstrap']))
 
+    prep_workers = int(kwargs['--prep_workers']) if kwargs['--prep_workers'] else max(1, threads // 4)
+    logger.info('Running cheap stages with {} workers.'.format(prep_workers))
 
-    if not kwargs['--use_fasttree'] == 'raxml':
-        logger.info('Using fasttree with {} threads and {} instances'.format(raxml_threads, raxml_instances))
-        with Pool(processes=raxml_instances) as p:
-            qiime2_trees = p.map(
-                partial(
-                    run_fasttree,
-                    output_dir=kwargs['--output_dir'],
-                    threads=raxml_threads,
-                ),
-                masked_files,
-            )
-    else:
-        with Pool(processes=raxml_instances) as p:
-            qiime2_trees = p.map(
-                partial(
-                    run_raxml,
-                    output_dir=kwargs['--output_dir'],
-                    threads=raxml_threads,
-                    bootstrap=kwargs['--bootstrap'],
-                ),
-                masked_files,
+    backend = kwargs['--qiime_backend']
+    assert backend in ('cli', 'api'), 'Invalid qiime backend: {}'.format(backend)
+    initializer = qiime2_api if backend == 'api' else None
+    logger.info('Using the qiime2 {} backend.'.format(backend))
+
+    method = 'fasttree' if kwargs['--use_fasttree'] else 'raxml'
+    tree_bootstrap = kwargs['--bootstrap'] if method == 'raxml' else None
+    if kwargs['--reduce_alignment']:
+        assert method == 'raxml', '--reduce_alignment needs raxml (fasttree does not take site pattern weights).'
+        # Runtimes on reduced alignments are modeled apart.
+        method = 'raxml_reduced'
+
+    bootstrap_shards = int(kwargs['--bootstrap_shards'])
+    assert bootstrap_shards >= 1, 'Invalid bootstrap shards value.'
+    split_job = None
+    if bootstrap_shards > 1:
+        if tree_bootstrap:
+            bootstrap_shards = len(bootstrap_shard_sizes(tree_bootstrap, bootstrap_shards))
+            logger.info('Bootstrap split in {} shards per gene (sizes {}).'.format(bootstrap_shards, bootstrap_shard_sizes(tree_bootstrap, bootstrap_shards)))
+            split_job = partial(
+                bootstrap_shard_jobs,
+                output_dir=kwargs['--output_dir'],
+                bootstrap=tree_bootstrap,
+                shards=bootstrap_shards,
+                backend=backend,
             )
+        else:
+            logger.warning('--bootstrap_shards only applies to raxml with --bootstrap, ignored.')
+    runtimes_file = os.path.join(kwargs['--output_dir'], TREE_RUNTIMES_FILE)
+    runtimes = read_tree_runtimes(runtimes_file)
+    costs = plan_tree_costs(find_list, runtimes, method, tree_bootstrap)
+    cost_model, observed = tree_cost_model(runtimes, method, tree_bootstrap)
+    # Most expensive genes first: their tree jobs are ready first.
+    find_list = sorted(find_list, key=lambda input_file: costs[input_file][0], reverse=True)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=prep_workers, initializer=initializer) as prep_executor, \
+            ProcessPoolExecutor(max_workers=threads, initializer=initializer) as tree_executor:
+        tree_packer = TreeJobPacker(tree_executor, threads, max_job_threads, costs, method, tree_bootstrap, kwargs['--output_dir'], split_job=split_job, model=cost_model, observed=observed)
+        stages = []
 
+        if kwargs['--upper_case_aln']:
+            logger.info('MAKING SHORE ALIGNMENTS ARE UPPERCASED')
+            stages.append(('uppercase', partial(uppercase_aln_fasta, output_dir=kwargs['--output_dir']), prep_executor))
 
-    with Pool(processes=threads) as p:
-        _ = p.map(
-            partial(
-                extract_tree_from_qiime2,
+        if kwargs['--mask_backend'] == 'native':
+            stages.append(('mask', partial(
+                mask_alignment_native,
                 output_dir=kwargs['--output_dir'],
-            ),
-            qiime2_trees,
-        )
+                alignment_fastas_suffix=kwargs['--alignment_fastas_suffix'],
+                max_gap_frequency=max_gap_frequency,
+                min_conservation=min_conservation,
+                backend=backend,
+            ), prep_executor))
+        else:
+            assert kwargs['--mask_backend'] == 'qiime', 'Invalid mask backend: {}'.format(kwargs['--mask_backend'])
+            stages.append(('convert', partial(
+                convert_alignment_to_qiime2_format,
+                output_dir=kwargs['--output_dir'],
+                alignment_fastas_suffix=kwargs['--alignment_fastas_suffix'],
+                backend=backend,
+            ), prep_executor))
+            stages.append(('mask', partial(
+                mask_alignments,
+                output_dir=kwargs['--output_dir'],
+                max_gap_frequency=max_gap_frequency,
+                min_conservation=min_conservation,
+                backend=backend,
+            ), prep_executor))
+
+        if kwargs['--reduce_alignment']:
+            stages.append(('reduce', partial(reduce_masked_alignment, output_dir=kwargs['--output_dir'], backend=backend), prep_executor))
+
+        # Threads of each tree job are set by the packer.
+        if kwargs['--use_fasttree']:
+            logger.info('Using fasttree, jobs packed on {} threads (max {} per job)'.format(threads, max_job_threads))
+            stages.append(('tree', partial(run_fasttree, output_dir=kwargs['--output_dir'], threads=1, backend=backend), tree_packer))
+        else:
+            logger.info('Using raxml, jobs packed on {} threads (max {} per job)'.format(threads, max_job_threads))
+            stages.append(('tree', partial(
+                run_raxml_reduced if kwargs['--reduce_alignment'] else run_raxml,
+                output_dir=kwargs['--output_dir'],
+                threads=1,
+                bootstrap=kwargs['--bootstrap'],
+                backend=backend,
+            ), tree_packer))
+
+        # The support mapping of sharded bootstraps and raxml on reduced alignments write the newick tree.
+        if not split_job and not kwargs['--reduce_alignment']:
+            stages.append(('extract', partial(extract_tree_from_qiime2, output_dir=kwargs['--output_dir'], backend=backend), prep_executor))
+
+        try:
+            run_pipeline(find_list, stages, keep_going=kwargs['--keep_going'])
+        finally:
+            # Runtimes of the jobs that finished, even when some genes failed.
+            write_tree_runtimes(runtimes_file, tree_packer.rows)
+
+    cpu_seconds = sum(row['threads'] * float(row['seconds']) for row in tree_packer.rows)
+    logger.info('Makespan {:.1f}s, {:.1f} tree cpu seconds on {} threads ({:.0%} busy). Wrote {} tree runtimes to {}.'.format(
+        time.perf_counter() - start, cpu_seconds, threads, cpu_seconds / threads / max(time.perf_counter() - start, 1e-9),
+        len(tree_packer.rows), runtimes_file,
+    ))
 
     logger.info('FINISHED ALL JOBS !')
 
 if __name__ == '__main__':
-    main(**docopt(__doc__))
+    with stage_trace.span('main', whole_process=True):
+        main(**docopt(__doc__))
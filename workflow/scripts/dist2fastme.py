@@ -1,8 +1,33 @@
 #!/usr/bin/env python3
+"""
+Mash distance matrix (tsv) to FastME (PHYLIP) input, with masked genome ids.
+
+Usage:
+    dist2fastme.py MASH_DIST MASK_FILE [THREADS] [CHUNK_ROWS] > OUTPUT
+
+Rows are parsed and formatted in blocks of CHUNK_ROWS with NumPy on THREADS
+worker processes; the output is the same as format(float(dist), '.10f') per cell.
+"""
 
 import sys
+import time
 import random
-import string 
+import string
+import resource
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+
+DIGITS = 10
+SCALE = 10 ** DIGITS
+# 'D.' + DIGITS digits + separator
+CELL_WIDTH = DIGITS + 3
+# Distance from a rounding tie below which a cell is formatted by Python (x * SCALE is not exact).
+TIE_MARGIN = 1e-4
+
+# genome_id -> masked id of a worker (see init_worker).
+MASK = None
 
 
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
@@ -26,7 +51,68 @@ def save_mask(fn, created_mask):
     with open(fn, 'w') as f:
         f.write('\n'.join(map('\t'.join, created_mask.items())) + '\n')
 
-def main(mash_dist, mask_file):
+def init_worker(mask):
+    global MASK
+    MASK = mask
+
+def format_row(line):
+    genome_id, *dists = line.split('\t')
+    return '\t'.join([MASK[genome_id], *map(lambda dist: format(float(dist), '.10f'), dists)]) + '\n'
+
+def format_cells(values):
+    """
+    (uint8 cells rows x cols x CELL_WIDTH, bool fast rows) of a distance block.
+
+    Only non negative finite values < 10 away from a rounding tie are formatted
+    here, rows with other values are flagged for format_row.
+    """
+    scaled = values * SCALE
+    fraction = scaled - np.floor(scaled)
+    fast = np.isfinite(values) & ~np.signbit(values) & (values < 10) & (np.abs(fraction - 0.5) > TIE_MARGIN)
+    rounded = np.where(fast, np.rint(np.where(fast, scaled, 0)), 0).astype(np.int64)
+    fast &= rounded < 10 * SCALE
+
+    cells = np.empty(values.shape + (CELL_WIDTH,), dtype=np.uint8)
+    cells[..., 0] = rounded // SCALE + ord('0')
+    cells[..., 1] = ord('.')
+    digits = rounded % SCALE
+    for idx in range(DIGITS + 1, 1, -1):
+        cells[..., idx] = digits % 10 + ord('0')
+        digits //= 10
+    cells[..., -1] = ord('\t')
+    cells[:, -1, -1] = ord('\n')
+    return cells, fast.all(axis=1)
+
+def format_block(lines):
+    """
+    PHYLIP rows of a block of mash distance lines, as bytes.
+    """
+    rows = [line.strip().split('\t', 1) for line in lines]
+    n_cols = {row[1].count('\t') + 1 if len(row) > 1 else 0 for row in rows}
+    n_cols = n_cols.pop() if len(n_cols) == 1 else 0
+    values = np.fromstring('\t'.join(row[1] for row in rows), sep='\t') if n_cols else np.empty(0)
+    if not n_cols or values.size != len(rows) * n_cols:
+        return ''.join(format_row(line.strip()) for line in lines).encode()
+
+    cells, fast_rows = format_cells(values.reshape(len(rows), n_cols))
+    cells = cells.reshape(len(rows), -1)
+    return b''.join(
+        MASK[row[0]].encode() + b'\t' + cells[idx].tobytes() if fast_rows[idx] else format_row('\t'.join(row)).encode()
+        for idx, row in enumerate(rows)
+    )
+
+def iter_blocks(f, chunk_rows):
+    block = []
+    for line in f:
+        block.append(line)
+        if len(block) == chunk_rows:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def main(mash_dist, mask_file, threads=1, chunk_rows=128):
+    threads, chunk_rows = int(threads), int(chunk_rows)
     try:
         mask = read_mask(mask_file)
     except FileNotFoundError:
@@ -34,25 +120,37 @@ def main(mash_dist, mask_file):
         mask = create_mask(mash_dist)
         save_mask(mask_file, mask)
 
-    print(len(mask))
+    start = time.perf_counter()
+    n_rows = 0
+    output = sys.stdout.buffer
+    output.write(f'{len(mask)}\n'.encode())
     with open(mash_dist, 'r') as f:
         _ = next(f)
-        for lines in map(str.strip, f):
-            genome_id, *dists = lines.split('\t')
-            print(
-                mask[genome_id],
-                *map(lambda dist: format(float(dist), '.10f'), dists),
-                sep='\t'
-            )
-
-            
-
-        
+        if threads <= 1:
+            init_worker(mask)
+            for block in iter_blocks(f, chunk_rows):
+                output.write(format_block(block))
+                n_rows += len(block)
+        else:
+            with Pool(threads, initializer=init_worker, initargs=(mask,)) as pool:
+                # Bounded number of blocks in flight, written in input order.
+                pending = deque()
+                for block in iter_blocks(f, chunk_rows):
+                    pending.append((len(block), pool.apply_async(format_block, (block,))))
+                    if len(pending) >= 2 * threads:
+                        size, result = pending.popleft()
+                        output.write(result.get())
+                        n_rows += size
+                while pending:
+                    size, result = pending.popleft()
+                    output.write(result.get())
+                    n_rows += size
+    output.flush()
 
-        
-        
+    elapsed = time.perf_counter() - start
+    peak_rss_mb = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024
+    print(f'{n_rows} rows in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.1f} rows/s), peak RSS {peak_rss_mb:.1f} MB', file=sys.stderr)
 
-    
 
 if __name__ == '__main__':
     main(*sys.argv[1:])
@@ -1,17 +1,160 @@
 #!/usr/bin/env python3
-import sys
-from itertools import chain
-from Bio import Phylo
+"""
+Node labels of newick files, and the taxon x gene-tree occupancy of many gene tree files.
 
+Labels are read with the streaming tokenizer of newick_stream.py (no tree objects).
 
-def main(fn):
-     
-    nodes = chain.from_iterable(map(lambda tree: tree.find_clades(), Phylo.parse(fn, "newick")))
+Usage:
+    extract_labels.py TREE
+    extract_labels.py occupancy ( --output_prefix=PATH ) [ --threads=INT ] [ --suffix=STR ]
+                                [ --min_taxon_occupancy=FLOAT ] [ --min_tree_occupancy=FLOAT ] TREE...
 
-    node_names = filter(bool, map(lambda node: node.name, nodes))
+Options:
+    TREE                         Newick file(s) (or directories of them for 'occupancy').
+    --output_prefix=PATH         Prefix of the occupancy outputs:
+                                   PREFIX.occupancy.npz  packed bool matrix taxa x trees ('taxa', 'trees', 'bits', 'shape').
+                                   PREFIX.taxa.tsv       taxon, trees with the taxon, kept.
+                                   PREFIX.trees.tsv      tree (file or file:index), taxa in the tree, kept taxa, kept.
+                                   PREFIX.kept.nwk       the kept gene trees, one per line (ASTRAL/wASTRID input).
+    --threads=INT                Files scanned in parallel [default: 1].
+    --suffix=STR                 Suffix of the newick files of input directories [default: .nwk].
+    --min_taxon_occupancy=FLOAT  Keep taxa present in at least this fraction of the trees [default: 0].
+    --min_tree_occupancy=FLOAT   Keep trees with at least this fraction of the kept taxa [default: 0].
+"""
 
-    print(*set(node_names), sep='\n')
+import os
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+import numpy as np
+from docopt import docopt
+
+from newick_stream import iter_tokens, unquote, TERMINAL, LABEL
+
+
+def is_number(label):
+    try:
+        float(label)
+        return True
+    except ValueError:
+        return False
+
+def scan_labels(tree_file):
+    """
+    Leaf labels of every tree of a newick file: [[label, ...], ...].
+    """
+    trees, labels = [], []
+    with open(tree_file) as f:
+        for kind, text in iter_tokens(f):
+            if kind == TERMINAL:
+                labels.append(unquote(text))
+            elif text == ';':
+                trees.append(labels)
+                labels = []
+    return trees
+
+def iter_tree_texts(tree_file):
+    """
+    Yield the text of every tree of a newick file (up to and including ';', without surrounding whitespace).
+    """
+    tree = []
+    with open(tree_file) as f:
+        for _, text in iter_tokens(f):
+            tree.append(text)
+            if text == ';':
+                yield ''.join(tree).strip()
+                tree = []
+
+def list_tree_files(trees, suffix):
+    for tree in trees:
+        if os.path.isdir(tree):
+            yield from sorted(map(str, Path(tree).glob('*' + suffix)))
+        else:
+            yield tree
+
+def occupancy_matrix(tree_files, threads):
+    """
+    (taxa, tree_ids, bool matrix taxa x trees, [(tree_file, index)]) of the gene trees of tree_files.
+    """
+    taxa, tree_ids, tree_sources, columns = {}, [], [], []
+    with Pool(threads) as pool:
+        for tree_file, trees in zip(tree_files, pool.imap(scan_labels, tree_files, chunksize=8)):
+            for idx, labels in enumerate(trees):
+                tree_ids.append(tree_file if len(trees) == 1 else '{}:{}'.format(tree_file, idx))
+                tree_sources.append((tree_file, idx))
+                columns.append([taxa.setdefault(label, len(taxa)) for label in labels])
+
+    matrix = np.zeros((len(taxa), len(columns)), dtype=bool)
+    for idx, rows in enumerate(columns):
+        matrix[rows, idx] = True
+    return list(taxa), tree_ids, matrix, tree_sources
+
+def prune(matrix, min_taxon_occupancy, min_tree_occupancy):
+    """
+    (kept taxa, kept trees) bool vectors: taxa in >= min_taxon_occupancy of the trees, then trees
+    with >= min_tree_occupancy of the kept taxa.
+    """
+    n_taxa, n_trees = matrix.shape
+    kept_taxa = matrix.sum(axis=1) >= min_taxon_occupancy * n_trees
+    kept_trees = matrix[kept_taxa].sum(axis=0) >= min_tree_occupancy * kept_taxa.sum()
+    return kept_taxa, kept_trees
+
+def write_kept_trees(output_file, tree_sources, kept_trees):
+    kept = {}
+    for (tree_file, idx), keep in zip(tree_sources, kept_trees):
+        if keep:
+            kept.setdefault(tree_file, set()).add(idx)
+    with open(output_file, 'w') as f_out:
+        for tree_file, indexes in kept.items():
+            for idx, tree in enumerate(iter_tree_texts(tree_file)):
+                if idx in indexes:
+                    f_out.write(tree + '\n')
+
+def run_occupancy(TREE, output_prefix, threads, suffix, min_taxon_occupancy, min_tree_occupancy):
+    tree_files = list(list_tree_files(TREE, suffix))
+    taxa, tree_ids, matrix, tree_sources = occupancy_matrix(tree_files, int(threads))
+    logger.info('{} taxa in {} trees from {} files.'.format(len(taxa), len(tree_ids), len(tree_files)))
+
+    kept_taxa, kept_trees = prune(matrix, float(min_taxon_occupancy), float(min_tree_occupancy))
+    logger.info('Kept {} taxa and {} trees.'.format(kept_taxa.sum(), kept_trees.sum()))
+
+    np.savez_compressed(
+        output_prefix + '.occupancy.npz',
+        taxa=np.array(taxa), trees=np.array(tree_ids),
+        bits=np.packbits(matrix, axis=1), shape=np.array(matrix.shape),
+    )
+    with open(output_prefix + '.taxa.tsv', 'w') as f_out:
+        f_out.write('taxon\ttrees\tkept\n')
+        for taxon, count, keep in zip(taxa, matrix.sum(axis=1).tolist(), kept_taxa.tolist()):
+            f_out.write('{}\t{}\t{}\n'.format(taxon, count, int(keep)))
+    with open(output_prefix + '.trees.tsv', 'w') as f_out:
+        f_out.write('tree\ttaxa\tkept_taxa\tkept\n')
+        for tree_id, count, kept_count, keep in zip(tree_ids, matrix.sum(axis=0).tolist(), matrix[kept_taxa].sum(axis=0).tolist(), kept_trees.tolist()):
+            f_out.write('{}\t{}\t{}\t{}\n'.format(tree_id, count, kept_count, int(keep)))
+    write_kept_trees(output_prefix + '.kept.nwk', tree_sources, kept_trees)
+
+def main(TREE, occupancy, output_prefix, threads, suffix, min_taxon_occupancy, min_tree_occupancy, *args, **kwargs):
+    if occupancy:
+        return run_occupancy(TREE, output_prefix, threads, suffix, min_taxon_occupancy, min_tree_occupancy)
+
+    # Leaf labels and the internal node labels that are not support values.
+    node_names = set()
+    with open(TREE[0]) as f:
+        for kind, text in iter_tokens(f):
+            if kind == TERMINAL or (kind == LABEL and not is_number(text)):
+                node_names.add(unquote(text))
+    node_names.discard('')
+
+    print(*node_names, sep='\n')
 
 
 if __name__ == '__main__':
-    main(*sys.argv[1:]) 
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        datefmt='%Y-%m-%d %H:%M:%S',
+        )
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
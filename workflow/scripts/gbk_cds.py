@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Streaming CDS extractor for (prokka) GenBank files.
+
+Only the FEATURES and ORIGIN sections are read: CDS locations and the
+'/locus_tag' qualifier. Sequences match 'feature.location.extract(record).seq'
+from Biopython (uppercase, join/order/complement locations).
+"""
+
+import os
+import re
+import gzip
+import logging
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+FEATURE_INDENT = ' ' * 5
+QUALIFIER_INDENT = ' ' * 21
+
+COMPLEMENT = str.maketrans('ACGTURYKMBVDHSWN', 'TGCAAYRMKVBHDSWN')
+SEQUENCE_DELETE = str.maketrans('', '', '0123456789 \t\r\n')
+RANGE_RE = re.compile(r'^[<>]?(\d+)(?:\.\.[<>]?(\d+))?$')
+LOCUS_TAG_RE = re.compile(r'^/locus_tag="?([^"]*)"?$')
+
+
+def split_location_parts(location: str) -> list:
+    """
+    Split the arguments of join(...)/order(...) at top level commas.
+    """
+    parts, depth, start = [], 0, 0
+    for idx, char in enumerate(location):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(location[start:idx])
+            start = idx + 1
+    parts.append(location[start:])
+    return parts
+
+
+def parse_location(location: str) -> list:
+    """
+    Parse a GenBank location into [(start, end, strand), ...] (0-based, end exclusive), in extraction order.
+    """
+    if location.startswith('complement(') and location.endswith(')'):
+        return [(start, end, -strand) for start, end, strand in reversed(parse_location(location[11:-1]))]
+
+    for operator in ('join(', 'order('):
+        if location.startswith(operator) and location.endswith(')'):
+            parts = []
+            for part in split_location_parts(location[len(operator):-1]):
+                parts.extend(parse_location(part))
+            return parts
+
+    match = RANGE_RE.match(location)
+    if not match:
+        raise ValueError('Unsupported location: {}'.format(location))
+    start = int(match.group(1))
+    end = int(match.group(2) or start)
+    return [(start - 1, end, 1)]
+
+
+def extract_location(sequence: str, parts: list) -> str:
+    extracted = []
+    for start, end, strand in parts:
+        chunk = sequence[start:end]
+        extracted.append(chunk if strand > 0 else chunk.translate(COMPLEMENT)[::-1])
+    return ''.join(extracted)
+
+
+def iter_cds(handle, locus_tags=None):
+    """
+    Yield (locus_tag, sequence) for every CDS with a locus_tag, in file order.
+
+    If 'locus_tags' is given, CDSs with other locus tags are skipped and
+    records without any wanted CDS do not have their sequence assembled.
+    """
+    cds = []
+    section = None
+    feature_type = None
+    location = []
+    locus_tag = None
+    in_qualifiers = False
+    sequence_lines = []
+
+    def close_feature():
+        if feature_type == 'CDS' and locus_tag and (locus_tags is None or locus_tag in locus_tags):
+            cds.append((locus_tag, ''.join(location)))
+
+    for line in handle:
+        if section == 'ORIGIN':
+            if line.startswith('//'):
+                if cds:
+                    sequence = ''.join(sequence_lines).translate(SEQUENCE_DELETE).upper()
+                    for tag, location_string in cds:
+                        try:
+                            yield tag, extract_location(sequence, parse_location(location_string))
+                        except ValueError as e:
+                            logger.warning('Skipping CDS {}: {}'.format(tag, e))
+                cds, sequence_lines, section = [], [], None
+            elif cds:
+                sequence_lines.append(line)
+            continue
+
+        if section == 'FEATURES':
+            if line.startswith(QUALIFIER_INDENT):
+                content = line.strip()
+                if content.startswith('/'):
+                    in_qualifiers = True
+                    if feature_type == 'CDS' and locus_tag is None:
+                        match = LOCUS_TAG_RE.match(content)
+                        if match:
+                            locus_tag = match.group(1)
+                elif not in_qualifiers:
+                    location.append(content)
+                continue
+            if line.startswith(FEATURE_INDENT) and line[5:6].strip():
+                close_feature()
+                fields = line.split(maxsplit=1)
+                feature_type = fields[0]
+                location = [fields[1].strip()] if len(fields) > 1 else []
+                locus_tag, in_qualifiers = None, False
+                continue
+            close_feature()
+            feature_type = None
+            section = None
+
+        if line.startswith('FEATURES'):
+            section = 'FEATURES'
+        elif line.startswith('ORIGIN'):
+            section = 'ORIGIN'
+        elif line.startswith('//'):
+            cds, sequence_lines = [], []
+
+
+def iter_cds_from_file(gbk_file: str, locus_tags=None):
+    """
+    iter_cds over a plain or gzipped GenBank file.
+    """
+    opener = gzip.open if gbk_file.endswith('.gz') else open
+    with opener(gbk_file, 'rt') as f:
+        yield from iter_cds(f, locus_tags=locus_tags)
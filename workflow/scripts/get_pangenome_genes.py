@@ -6,7 +6,8 @@ Usage:
     get_pangenome_genes.py -h
     get_pangenome_genes.py ( --panaroo_results_preffix=PATH ) ( --coregenome_threshold=FLOAT )
                            ( --annotation_path_list=PATH ) [ --core_cluster_names_to_file=PATH  ]
-                           [ --threads=N ] [ --debug ]
+                           [ --threads=N ] [ --bgzf_backend=STR ] [ --cluster_archive=PREFIX ]
+                           [ --merge_fan_in=N ] [ --annotation_dir=PATH [ --annotation_cache=PATH ] ] [ --debug ]
 
 Options:
     -i --panaroo_results_preffix=PATH       Dir of the panaroo result dir with prefix of the results tables to use.
@@ -14,30 +15,59 @@ Options:
     -a --annotation_path_list=PATH          Path to the directorie where the prokka are stored.
     -p --core_cluster_names_to_file=PATH    Write the names of coregenome clusters.
     -t --threads=N                          Write the names of coregenome clusters.
+    --bgzf_backend=STR                      'native' (bgzip and index in-process while writing, one pass) or
+                                            'samtools' (plain fasta then 'bgzip' + 'samtools faidx') [default: native].
+    --cluster_archive=PREFIX                Also write a cluster-major archive of the core records (cluster_archive.py):
+                                            PREFIX.fa, PREFIX.index.npy, PREFIX.clusters.txt and PREFIX.genomes.txt.
+    --merge_fan_in=N                        Max genome runs merged at once when building the archive [default: 256].
+    --annotation_dir=PATH                   Root of the annotation paths: check them against its listing
+                                            (annotation_tree.py) instead of a stat per path.
+    --annotation_cache=PATH                 Cache of the annotation dir listing, only the dirs changed since
+                                            the last run are read again (not cached if not given).
     -d --debug                              Run in debug mode (more verbose log).
 """
 
 import os
 import sys
-import gzip
+import shutil
 import logging
-import subprocess
 from multiprocessing import Pool
 from pathlib import Path
 from collections import namedtuple
-from Bio import SeqIO
+import numpy as np
 from docopt import docopt
 
+import stage_trace
+from annotation_tree import AnnotationTree
+from gbk_cds import iter_cds_from_file
+from bgzf_fasta import BgzfFastaWriter
+from cluster_archive import genome_order, iter_fasta_records, write_run, build as build_cluster_archive
+
 logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
 
+CoregenomeTable = namedtuple('CoregenomeTable', 'genome_ids cluster_names locustags')
+
+# Set in each Pool worker by init_coregenome_table.
+COREGENOME_TABLE = None
+CLUSTER_INDEX = None
+
 def get_min_persistence(coregenome_threshold: float, genome_count: int) -> int :
     assert 0 < coregenome_threshold <= 1, "'coregenome_threshold' needs to be greater than 0 or less equal than 1."
     return int(genome_count * (1 - coregenome_threshold))
 
-def get_cluster_names(panaroo_Rtab: str, coregenome_threshold: float) -> tuple:
-    with open(panaroo_Rtab, 'r') as f:
-        file_lines = iter(map(lambda x: x.strip().split('\t'), f.readlines()))
-        header = next(file_lines)
+def count_absences(rtab_line: bytes, genome_count: int) -> int:
+    """
+    Count the '0' cells of a Rtab row (cluster name excluded) without splitting it.
+    """
+    _, _, cells = rtab_line.rstrip(b'\r\n').partition(b'\t')
+    values = np.frombuffer(cells, dtype=np.uint8)
+    if len(values) == 2 * genome_count - 1:
+        return int(np.count_nonzero(values[::2] == ord('0')))
+    return cells.split(b'\t').count(b'0')
+
+def get_cluster_names(panaroo_Rtab: str, coregenome_threshold: float) -> set:
+    with open(panaroo_Rtab, 'rb') as f:
+        header = next(f).strip().split(b'\t')
 
         genome_count = len(header) - 1
         logger.info(f'Genome count: {genome_count}')
@@ -46,33 +76,54 @@ def get_cluster_names(panaroo_Rtab: str, coregenome_threshold: float) -> tuple:
         logger.info(f'Min persistence: {min_persistence}')
 
         logger.info('Reading panaroo Rtab ...')
-        return set(map(lambda x: x[0], filter(lambda x: x.count('0') < min_persistence, file_lines)))
-
-def get_coregenome_data(panaroo_csv: str, cluster_names: set):
+        names, absences = [], []
+        for line in f:
+            names.append(line.partition(b'\t')[0].strip().decode())
+            absences.append(count_absences(line, genome_count))
+
+    core = np.asarray(absences, dtype=np.int64) < min_persistence
+    return set(np.asarray(names, dtype=object)[core])
+
+def get_coregenome_data(panaroo_csv: str, cluster_names: set) -> CoregenomeTable:
+    """
+    Load the core rows of the panaroo csv as a (clusters x genomes) locus tag matrix.
+    """
     logger.info(f'Extracting locustags from: {panaroo_csv}')
-    data = {}
     with open(panaroo_csv, 'r') as f:
-        file_lines = iter(map(lambda x: x.strip().split(','), f.readlines()))
-        data['columns'] = next(file_lines)
-        coregenome_lines = filter(lambda x: x[0] in cluster_names, file_lines)
-        for i in coregenome_lines:
-            data[i[0]] = i
-
-    clusters_names = [i for i in data.keys() if i != 'columns']
-    logger.info('Finished locustags extraction.')
+        columns = next(f).strip().split(',')
+        rows = [line.strip().split(',') for line in f if line.partition(',')[0] in cluster_names]
 
-    genome_data = namedtuple('genomeData', 'genome_id locustags')
+    locustags = np.empty((len(rows), len(columns) - 3), dtype=object)
+    for idx, row in enumerate(rows):
+        locustags[idx, :] = row[3:]
 
-    for idx, columns in tuple(enumerate(data['columns']))[3:]:
-        locustags = dict(map(lambda x: (data[x][idx], x), clusters_names))
-        genome_id = columns
-        yield genome_data(genome_id, locustags)
+    logger.info('Finished locustags extraction.')
+    return CoregenomeTable(
+        genome_ids=columns[3:],
+        cluster_names=np.asarray([row[0] for row in rows], dtype=object),
+        locustags=locustags,
+    )
 
-def process_genome_list(genome_list_path: str) -> dict:
+def genome_locustags(table: CoregenomeTable, genome_idx: int) -> dict:
+    """
+    locus_tag -> cluster lookup of one genome (column) of the table.
+    """
+    return dict(zip(table.locustags[:, genome_idx], table.cluster_names))
+
+def init_coregenome_table(table: CoregenomeTable, cluster_index: dict = None) -> None:
+    """
+    Pool initializer: the table is handed to each worker once, jobs only carry the genome column index.
+    """
+    global COREGENOME_TABLE, CLUSTER_INDEX
+    COREGENOME_TABLE = table
+    CLUSTER_INDEX = cluster_index
+
+def process_genome_list(genome_list_path: str, annotation_dir: str = None, annotation_cache: str = None) -> dict:
+    tree = AnnotationTree(annotation_dir, cache_file=annotation_cache) if annotation_dir else None
     with open(genome_list_path, 'r') as f:
         data = {}
         for line in iter(map(str.strip, f.readlines())):
-            assert os.path.isfile(line)
+            assert tree.exists(line) if tree else os.path.isfile(line), f'File does not exist: {line}'
             genome_id = os.path.basename(line).replace('.gbk.gz', '')
             assert not data.get(genome_id), f'Genome ID ({genome_id}) is not unique.'
             data[genome_id] = line
@@ -87,34 +138,79 @@ def samtools_compress_and_index(fasta_path: str):
     assert os.path.isfile(fasta_path), f'File does not exist: {fasta_path}'
 
     logger.debug(f'Compressing : {fasta_path}')
-    subprocess.run(['bgzip', fasta_path], check=True)
+    stage_trace.run(['bgzip', fasta_path], check=True)
 
     logger.debug(f'Indexing : {fasta_path}')
-    subprocess.run(['samtools', 'faidx', fasta_path + '.gz'], check=True)
+    stage_trace.run(['samtools', 'faidx', fasta_path + '.gz'], check=True)
 
     assert os.path.isfile(fasta_path + '.gz'), f'File does not exist: {fasta_path}.gz'
 
-def fasta_clusters_from_gbk(genome_id, locustags, genome_path, no_clubber = True):
+def native_compress_and_index(genome_id, locustags, genome_path, output_path):
+    """
+    Write the bgzipped fasta and its '.fai'/'.gzi' in one pass (same files as bgzip + samtools faidx),
+    returns the (record_id, sequence) written.
+    """
+    records = []
+    with BgzfFastaWriter(output_path + '.gz') as writer:
+        for locustag, sequence in iter_cds_from_file(genome_path, locus_tags=locustags):
+            record_id = f'{genome_id}#{locustags[locustag]}'
+            writer.write(record_id, sequence)
+            records.append((record_id, sequence))
+    return records
+
+def fasta_clusters_from_gbk(genome_id, locustags, genome_path, no_clubber = True, bgzf_backend = 'native'):
+    """
+    Returns the (record_id, sequence) written, None when the existing file is kept.
+    """
     output_path = os.path.join(os.path.dirname(genome_path), genome_id + '.panclusters.fa')
 
     if no_clubber and ( Path(output_path + '.gz' ).exists() and Path(output_path + '.gz.fai' ).exists() ):
         logger.info('Skiping file creation: {}'.format(output_path))
-        return
+        return None
         
     logger.info(f'Creating file: {output_path}')
+    if bgzf_backend == 'native':
+        records = native_compress_and_index(genome_id, locustags, genome_path, output_path)
+        logger.info(f'FINISHED: {output_path}')
+        return records
+
+    records = []
     with open(output_path, 'w') as f_out:
-        with gzip.open(genome_path, 'rt') as f:
-            for record in SeqIO.parse(f, 'genbank'):
-                for feature in filter(lambda x: x.type == 'CDS', record.features):
-                    locustag = feature.qualifiers['locus_tag'][0]
-                    if locustag in locustags:
-                        cluster_name =  locustags[locustag]
-                        # f_out.write(f'>{genome_id}#{cluster_name}#{locustag}\n{feature.location.extract(record).seq}\n')
-                        f_out.write(f'>{genome_id}#{cluster_name}\n{feature.location.extract(record).seq}\n')
+        for locustag, sequence in iter_cds_from_file(genome_path, locus_tags=locustags):
+            cluster_name =  locustags[locustag]
+            # f_out.write(f'>{genome_id}#{cluster_name}#{locustag}\n{sequence}\n')
+            f_out.write(f'>{genome_id}#{cluster_name}\n{sequence}\n')
+            records.append((f'{genome_id}#{cluster_name}', sequence))
     samtools_compress_and_index(output_path)
     logger.info(f'FINISHED: {output_path}')
-
-def main(panaroo_results_preffix, coregenome_threshold, annotation_path_list, core_cluster_names_to_file, threads=1, debug=False, *args, **kwargs):
+    return records
+
+def write_archive_run(genome_id, records, archive_genome_idx, run_file):
+    """
+    Sorted run of one genome for the cluster archive from its (record_id, sequence) bytes records.
+    """
+    prefix = genome_id.encode() + b'#'
+    records = (
+        (CLUSTER_INDEX[record_id[len(prefix):].decode()], record_id, sequence)
+        for record_id, sequence in records
+        if record_id.startswith(prefix) and record_id[len(prefix):].decode() in CLUSTER_INDEX
+    )
+    return write_run(run_file, archive_genome_idx, records)
+
+def fasta_clusters_from_table(genome_idx, genome_path, bgzf_backend = 'native', archive_run = None, no_clubber = True):
+    genome_id = COREGENOME_TABLE.genome_ids[genome_idx]
+    with stage_trace.span('genome', item=genome_id):
+        locustags = genome_locustags(COREGENOME_TABLE, genome_idx)
+        records = fasta_clusters_from_gbk(genome_id, locustags, genome_path, no_clubber=no_clubber, bgzf_backend=bgzf_backend)
+        if archive_run:
+            if records is None:
+                # Kept fasta of a previous run: read it back.
+                records = iter_fasta_records(os.path.join(os.path.dirname(genome_path), genome_id + '.panclusters.fa.gz'))
+            else:
+                records = ((record_id.encode(), sequence.encode()) for record_id, sequence in records)
+            write_archive_run(genome_id, records, *archive_run)
+
+def main(panaroo_results_preffix, coregenome_threshold, annotation_path_list, core_cluster_names_to_file, threads=1, bgzf_backend='native', cluster_archive=None, merge_fan_in=256, annotation_dir=None, annotation_cache=None, debug=False, *args, **kwargs):
     logging.basicConfig(
         level=logging.DEBUG if debug else logging.INFO,
         datefmt="%Y-%m-%d %H:%M",
@@ -125,36 +221,63 @@ def main(panaroo_results_preffix, coregenome_threshold, annotation_path_list, co
     )
 
     coregenome_threshold = float(coregenome_threshold)
+    assert bgzf_backend in ('native', 'samtools'), f'Unknown bgzf backend: {bgzf_backend}'
 
     logger.debug(str(locals()))
 
     logger.info('Reading genome paths list ...')
-    genome_paths = process_genome_list(annotation_path_list)
+    genome_paths = process_genome_list(annotation_path_list, annotation_dir=annotation_dir, annotation_cache=annotation_cache)
 
-    cluster_names = get_cluster_names(panaroo_Rtab=panaroo_results_preffix + '.Rtab', coregenome_threshold=coregenome_threshold)
+    with stage_trace.span('core_clusters'):
+        cluster_names = get_cluster_names(panaroo_Rtab=panaroo_results_preffix + '.Rtab', coregenome_threshold=coregenome_threshold)
 
     logger.info(f'Coregenome genes count: {len(cluster_names)}')
     if core_cluster_names_to_file:
         logger.info('Writing core cluster names to file: {}'.format(core_cluster_names_to_file))
         write_coregenome_cluster_names(cluster_names, core_cluster_names_to_file)
 
-    coregenome_data = get_coregenome_data(panaroo_csv=panaroo_results_preffix + '.csv', cluster_names=cluster_names)
+    with stage_trace.span('load_coregenome'):
+        coregenome_data = get_coregenome_data(panaroo_csv=panaroo_results_preffix + '.csv', cluster_names=cluster_names)
 
     logger.info('Extracting fasta sequences ...')
    
     logger.info('Creating jobs ...') 
     jobs = []
-    for genome_data in coregenome_data:
-        idx = genome_paths.get(genome_data.genome_id, None)
+    for genome_idx, genome_id in enumerate(coregenome_data.genome_ids):
+        idx = genome_paths.get(genome_id, None)
         if idx:
-            jobs.append((genome_data.genome_id, genome_data.locustags, idx))
+            jobs.append((genome_idx, idx, bgzf_backend))
+
+    archive_clusters, cluster_index, run_files = None, None, []
+    if cluster_archive:
+        archive_clusters = sorted(cluster_names)
+        cluster_index = {name: idx for idx, name in enumerate(archive_clusters)}
+        archive_genomes = genome_order(coregenome_data.genome_ids[genome_idx] for genome_idx, _, _ in jobs)
+        archive_genome_idx = {genome_id: idx for idx, genome_id in enumerate(archive_genomes)}
+        runs_dir = cluster_archive + '.runs'
+        if os.path.isdir(runs_dir):
+            logger.warning('Removing the genome runs of a previous build: {}'.format(runs_dir))
+            shutil.rmtree(runs_dir)
+        os.makedirs(runs_dir)
+        for job_idx, (genome_idx, genome_path, backend) in enumerate(jobs):
+            genome_id = coregenome_data.genome_ids[genome_idx]
+            run_file = os.path.join(runs_dir, '{}.run'.format(archive_genome_idx[genome_id]))
+            jobs[job_idx] = (genome_idx, genome_path, backend, (archive_genome_idx[genome_id], run_file))
+            run_files.append(run_file)
 
     logger.info('Starting jobs ...')
-    with Pool(processes=int(threads)) as p:
-        _ = p.starmap(fasta_clusters_from_gbk, jobs)
+    with stage_trace.span('extract_fastas'), Pool(processes=int(threads), initializer=init_coregenome_table, initargs=(coregenome_data, cluster_index)) as p:
+        _ = p.starmap(fasta_clusters_from_table, jobs)
+
+    if cluster_archive:
+        logger.info('Merging {} genome runs into the cluster archive: {}'.format(len(run_files), cluster_archive))
+        with stage_trace.span('cluster_archive'):
+            build_cluster_archive(cluster_archive, run_files, archive_clusters, archive_genomes, fan_in=int(merge_fan_in))
+        os.rmdir(runs_dir)
 
     logger.info('All jobs finished.')
 
 if __name__ == '__main__':
     clean_dashes_from_args = lambda x: { i.replace('--', '') : y for i,y in x.items() }
-    main(**clean_dashes_from_args(docopt(__doc__)))
+    with stage_trace.span('main', whole_process=True):
+        main(**clean_dashes_from_args(docopt(__doc__)))
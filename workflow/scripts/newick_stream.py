@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Streaming Newick tokenizer: node labels are found (and rewritten) in the text,
+no tree objects are built. Handles multi-tree files, quoted labels, comments
+and trees split across lines or read buffers.
+
+Splits (bipartitions) are leaf bitmasks, oriented to exclude the first leaf of
+the reference tree, so the splits of unrooted trees compare equal.
+"""
+
+import io
+import os
+import re
+import logging
+from collections import Counter
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+READ_SIZE = 1 << 20
+
+TOKEN_RE = re.compile(r"""
+    (?P<quoted>'(?:[^']|'')*')
+  | (?P<comment>\[[^\]]*\])
+  | (?P<punct>[(),:;])
+  | (?P<space>\s+)
+  | (?P<word>[^\s(),:;\[\]']+)
+""", re.X)
+NEEDS_QUOTES_RE = re.compile(r"[\s(),:;\[\]']")
+
+# Token kinds
+LABEL = 'label'
+TERMINAL = 'terminal'
+OTHER = 'other'
+
+
+def unquote(label: str) -> str:
+    if label.startswith("'"):
+        return label[1:-1].replace("''", "'")
+    return label
+
+def quote(label: str) -> str:
+    if NEEDS_QUOTES_RE.search(label):
+        return "'{}'".format(label.replace("'", "''"))
+    return label
+
+def iter_tokens(handle, read_size=READ_SIZE):
+    """
+    Yield (kind, text) for the whole Newick text of 'handle'.
+
+    'kind' is TERMINAL for leaf labels, LABEL for internal node labels and
+    OTHER for punctuation, branch lengths, comments and whitespace. Joining the
+    texts gives back the input.
+    """
+    buffer, pos, eof = '', 0, False
+    # A label right after '(' / ',' / ';' (or at the start) names a leaf, after ')' an internal node.
+    terminal, label_expected = True, True
+    while True:
+        match = TOKEN_RE.match(buffer, pos)
+        if match is None or (match.end() == len(buffer) and not eof):
+            if eof:
+                if pos < len(buffer):
+                    raise ValueError('Malformed newick near: {!r}'.format(buffer[pos:pos + 50]))
+                return
+            chunk = handle.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        pos = match.end()
+        kind, text = match.lastgroup, match.group()
+
+        if kind == 'punct':
+            terminal = text in '(,;'
+            label_expected = text != ':'
+            yield OTHER, text
+        elif kind in ('word', 'quoted') and label_expected:
+            yield (TERMINAL if terminal else LABEL), text
+            label_expected = False
+        else:
+            yield OTHER, text
+
+def relabel(handle, output, mapping: dict, unknown: set, read_size=READ_SIZE) -> int:
+    """
+    Write the Newick text of 'handle' to 'output' with leaf labels replaced by 'mapping'.
+
+    Labels missing from 'mapping' are kept and added to 'unknown'. Returns the number of trees.
+    """
+    trees, pending = 0, []
+    for kind, text in iter_tokens(handle, read_size=read_size):
+        if kind == TERMINAL:
+            label = unquote(text)
+            if label in mapping:
+                text = quote(mapping[label])
+            else:
+                unknown.add(label)
+        elif text == ';':
+            trees += 1
+        pending.append(text)
+        if len(pending) >= 4096:
+            output.write(''.join(pending))
+            pending = []
+    output.write(''.join(pending))
+    return trees
+
+def graft_duplicates(handle, output, duplicates: dict, read_size=READ_SIZE) -> int:
+    """
+    Write the Newick text of 'handle' to 'output' with the leaves of 'duplicates' ({leaf: [labels]})
+    replaced by a clade of the leaf and its duplicates, all at zero length. Returns the number of trees.
+    """
+    trees, pending = 0, []
+    for kind, text in iter_tokens(handle, read_size=read_size):
+        if kind == TERMINAL and unquote(text) in duplicates:
+            text = '({}:0,{})'.format(text, ','.join(quote(label) + ':0' for label in duplicates[unquote(text)]))
+        elif text == ';':
+            trees += 1
+        pending.append(text)
+        if len(pending) >= 4096:
+            output.write(''.join(pending))
+            pending = []
+    output.write(''.join(pending))
+    return trees
+
+def leaf_bits(tree: str) -> dict:
+    """
+    {leaf label: bit} of the leaves of a Newick tree, in order of appearance.
+    """
+    labels = [unquote(text) for kind, text in iter_tokens(io.StringIO(tree)) if kind == TERMINAL]
+    assert len(set(labels)) == len(labels), 'Duplicated leaf labels in tree.'
+    return {label: 1 << idx for idx, label in enumerate(labels)}
+
+def canonical_split(mask: int, all_leaves: int) -> int:
+    return all_leaves ^ mask if mask & 1 else mask
+
+def is_trivial_split(split: int, leaves: int) -> bool:
+    size = bin(split).count('1')
+    return size <= 1 or size >= leaves - 1
+
+def count_splits(handle, bits: dict, read_size=READ_SIZE) -> tuple:
+    """
+    (Counter of the non trivial splits, trees) of the trees of 'handle' (e.g. bootstrap replicates).
+    """
+    all_leaves = sum(bits.values())
+    counts, trees, stack, splits = Counter(), 0, [], set()
+    for kind, text in iter_tokens(handle, read_size=read_size):
+        if kind == TERMINAL:
+            label = unquote(text)
+            assert label in bits, 'Leaf not in the reference tree: {}'.format(label)
+            if stack:
+                stack[-1] |= bits[label]
+        elif text == '(':
+            stack.append(0)
+        elif text == ')':
+            mask = stack.pop()
+            if stack:
+                stack[-1] |= mask
+                split = canonical_split(mask, all_leaves)
+                if not is_trivial_split(split, len(bits)):
+                    splits.add(split)
+        elif text == ';':
+            counts.update(splits)
+            trees, stack, splits = trees + 1, [], set()
+    return counts, trees
+
+def map_support(tree: str, counts: Counter, trees: int) -> str:
+    """
+    'tree' with the support (percent of 'trees' with the split, as RAxML) as internal node labels.
+    """
+    bits = leaf_bits(tree)
+    all_leaves = sum(bits.values())
+    output, stack, replaced = [], [], False
+    for kind, text in iter_tokens(io.StringIO(tree)):
+        if kind == LABEL and replaced:
+            replaced = False
+            continue
+        replaced = False
+        if kind == TERMINAL and stack:
+            stack[-1] |= bits[unquote(text)]
+        elif text == '(':
+            stack.append(0)
+        elif text == ')':
+            mask = stack.pop()
+            output.append(text)
+            if stack:
+                stack[-1] |= mask
+                split = canonical_split(mask, all_leaves)
+                if not is_trivial_split(split, len(bits)):
+                    output.append(str(round(100 * counts[split] / trees)) if trees else '0')
+                    replaced = True
+            continue
+        output.append(text)
+    return ''.join(output)
@@ -6,6 +6,10 @@ Usage:
     root_core_cluster.py ( --panaroo_genus_dir=PATH ) ( --specie=STR ) ( --roots_file=PATH )
                          ( --annotation_dir=PATH ) ( --panaroo_dir=PATH ) ( --fasta_suffix=STR )
                          ( --output_dir=PATH ) ( --core_clusters_file=PATH ) [ --threads=N ]
+                         [ --faidx_backend=STR ] [ --roots_backend=STR ] [ --annotation_cache=PATH ] [ --dry_run ]
+    root_core_cluster.py batch ( --panaroo_genus_dir=PATH ) ( --roots_file=PATH ) ( --annotation_dir=PATH )
+                         ( --fasta_suffix=STR ) ( --species_table=PATH ) [ --threads=N ]
+                         [ --faidx_backend=STR ] [ --roots_backend=STR ] [ --annotation_cache=PATH ] [ --dry_run ]
 
 Options:
     -h --help                     Show this screen.
@@ -17,6 +21,18 @@ Options:
     -c --core_clusters_file=PATH  Path to the core genes file (one per line).
     -o --output_dir=PATH          Path to the output directory.
     -t --threads=N                Threads number [default: 1].
+    -b --faidx_backend=STR        How records are extracted: 'native' (in-process BGZF/faidx reader)
+                                  or 'samtools' (one 'samtools faidx' call per record) [default: native].
+    --roots_backend=STR           How the roots file is read: 'index' (only the specie rows, from a sorted
+                                  copy indexed by specie built once next to it, see roots_index.py)
+                                  or 'full' (the whole file) [default: index].
+    -S --species_table=PATH       Batch mode, one species per line (tab separated, no header):
+                                  SPECIE PANAROO_DIR CORE_CLUSTERS_FILE OUTPUT_DIR. The genus and
+                                  annotation scans, the roots, the workers and their open fastas
+                                  are shared, the clusters of all species are scheduled together.
+    --annotation_cache=PATH       Cache of the annotation dir listing (annotation_tree.py), if not given
+                                  OUTPUT_DIR/.annotation_tree.tsv (of the first species in batch mode).
+    -n --dry_run                  Only report which cluster multifastas would be (re)built or removed.
 """
 
 # Native imports
@@ -25,9 +41,10 @@ import sys
 import datetime
 import datetime
 import re
+import zlib
+import resource
 from pathlib import Path
-from collections import defaultdict
-import uuid
+from collections import defaultdict, deque
 import logging
 import subprocess
 from multiprocessing import Pool
@@ -37,6 +54,19 @@ logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
 # 3th party modules
 from docopt import docopt
 
+# Local modules
+import stage_trace
+from annotation_tree import AnnotationTree, CACHE_NAME
+from bgzf_fasta import IndexedFastaPool
+from roots_index import read_specie_roots
+from cluster_manifest import MANIFEST_NAME, ManifestEntry, read_manifest, write_manifest, inputs_hash, is_up_to_date, finalize_cluster_fasta, remove_stale_fasta, report_changes
+
+# Per worker pool of open indexed fastas (see init_fasta_pool).
+FASTA_POOL = None
+MAX_OPEN_FASTAS = 256
+# File descriptors of a worker left for its pipes, logs and the samtools calls.
+FD_MARGIN = 64
+
 def read_roots(roots_file: str, separator="\t") -> list:
     """
     Read a file with roots for a given species.
@@ -58,17 +88,12 @@ def read_roots(roots_file: str, separator="\t") -> list:
 
 
 
-def list_and_filter_files(annotation_dir: str, genome_ids: set, fasta_suffix: str) -> list:
+def list_and_filter_files(annotation_dir: str, genome_ids: set, fasta_suffix: str, cache_file: str = None) -> list:
     """
-    List all the files in the annotation directory and filter them by specie and fasta_suffix.
+    List all the files in the annotation directory and filter them by specie and fasta_suffix
+    (listing cached in 'cache_file', only the dirs changed since the last run are read again).
     """
-    genomes_fasta = {}
-    for fasta in Path(annotation_dir).rglob('*' + fasta_suffix):
-        genome_id = os.path.basename(fasta).replace(fasta_suffix, "")
-        if genome_id in genome_ids:
-            assert not genome_id in genomes_fasta, "Duplicated genome id."
-            genomes_fasta[genome_id] = str(fasta.absolute())
-    return genomes_fasta
+    return AnnotationTree(annotation_dir, cache_file=cache_file).genomes(fasta_suffix, genome_ids)
 
 def read_core_clusters_from_file(core_clusters_file: str) -> dict:
     with open(core_clusters_file, 'r') as f:
@@ -104,14 +129,229 @@ def extract_record_from_fasta_faidx(fasta_file: str, record_id: str) -> str:
     Extract a record from a samtools indexed fasta file.
     """
     try:
-        record = subprocess.check_output(['samtools', 'faidx', fasta_file, record_id], encoding='utf-8').split('\n')
+        record = stage_trace.check_output(['samtools', 'faidx', fasta_file, record_id], stage='faidx', item=record_id, encoding='utf-8').split('\n')
         header = record[0]
         sequence = ''.join(record[1:-1])
         return f'{header}\n{sequence}'
     except subprocess.CalledProcessError as e:
         logger.info("Extracting record_id ('{}') from fasta file, RECORD might not exists on fasta: {}.".format(record_id, e))
 
-def main(panaroo_genus_dir: str, core_clusters_file: str, specie: str, roots_file: str, annotation_dir: str, panaroo_dir: str, fasta_suffix: str, output_dir: str, threads: int = 1, *args, **kwargs) -> None:
+def max_open_fastas() -> int:
+    """
+    Fasta handles a worker keeps open: its fd limit minus FD_MARGIN (MAX_OPEN_FASTAS without limit).
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return MAX_OPEN_FASTAS if soft == resource.RLIM_INFINITY else max(16, soft - FD_MARGIN)
+
+def init_fasta_pool(max_open: int = None) -> None:
+    """
+    Pool initializer: each worker keeps its own fasta handles (and their parsed indexes) open between calls.
+    """
+    global FASTA_POOL
+    FASTA_POOL = IndexedFastaPool(max_open=max_open or max_open_fastas())
+
+def extract_records_from_fasta_faidx(requests: list) -> list:
+    """
+    Extract a batch of (fasta_file, record_id) records with the worker's in-process reader.
+    """
+    if FASTA_POOL is None:
+        init_fasta_pool()
+    return FASTA_POOL.fetch_many(requests)
+
+def extract_shard_records(requests: list, faidx_backend: str = 'native') -> list:
+    """
+    Shard worker: the (fasta_file, record_id) records of one shard, None for the missing ones.
+    """
+    with stage_trace.span('extract', records=len(requests)):
+        if faidx_backend == 'samtools':
+            return [extract_record_from_fasta_faidx(*request) for request in requests]
+        return extract_records_from_fasta_faidx(requests)
+
+class FastaShards:
+    """
+    One single worker pool per shard of the fasta files: a fasta (fixed crc32 shard
+    of its path) is always read by the same worker, so every cluster reuses its
+    open handle and parsed '.fai'/'.gzi' instead of opening and parsing it again.
+    """
+
+    def __init__(self, threads: int, faidx_backend: str = 'native'):
+        self.faidx_backend = faidx_backend
+        initializer = init_fasta_pool if faidx_backend == 'native' else None
+        self.pools = [Pool(processes=1, initializer=initializer) for _ in range(threads)]
+
+    def shard(self, fasta_file: str) -> int:
+        return zlib.crc32(fasta_file.encode()) % len(self.pools)
+
+    def submit(self, requests: list):
+        """
+        Queue the (fasta_file, record_id) requests on their shards, returns a function waiting
+        for the records (requests order, missing records dropped).
+        """
+        shards = defaultdict(list)
+        for pos, request in enumerate(requests):
+            shards[self.shard(request[0])].append((pos, request))
+        pending = [
+            (items, self.pools[shard].apply_async(extract_shard_records, ([request for _, request in items], self.faidx_backend)))
+            for shard, items in shards.items()
+        ]
+
+        def result() -> tuple:
+            records = [None] * len(requests)
+            for items, shard_result in pending:
+                for (pos, _), record in zip(items, shard_result.get()):
+                    records[pos] = record
+            return tuple(filter(None, records))
+        return result
+
+    def extract(self, requests: list) -> tuple:
+        return self.submit(requests)()
+
+    def extract_clusters(self, jobs: list, lookahead: int):
+        """
+        Yield (job, specie_sequences, root_sequences) of the [(..., specie_requests, root_requests), ...]
+        jobs in order, with 'lookahead' clusters queued ahead so the shards do not wait for each other.
+        """
+        queued = deque()
+        for job in itertools.chain(jobs, [None] * lookahead):
+            if job is not None:
+                queued.append((job, self.submit(job[-2]), self.submit(job[-1])))
+            if queued and (job is None or len(queued) > lookahead):
+                job, specie_records, root_records = queued.popleft()
+                yield job, specie_records(), root_records()
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.close()
+        for pool in self.pools:
+            pool.join()
+
+    def terminate(self) -> None:
+        for pool in self.pools:
+            pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+def build_cluster_requests(core_cluster: str, specie: str, genome_ids: list, genomes_fastas: dict, roots: dict, roots_fastas: dict) -> tuple:
+    """
+    (specie_requests, root_requests, rooted) of a core cluster, in a deterministic order.
+    """
+    specie_requests = [(genomes_fastas[genome_id] , f'{genome_id}#{core_cluster}') for genome_id in genome_ids if genomes_fastas.get(genome_id) ]
+
+    root_requests = []
+    cluster_roots = roots.get(f'{specie}#{core_cluster}', [])
+    rooted = bool(cluster_roots)
+    if rooted:
+        cluster_roots = {k : v for k,v in cluster_roots.items() if k != specie}
+        root_requests = [ (roots_fastas[root_specie], root_id) for root_specie in sorted(cluster_roots) for root_id in sorted(cluster_roots[root_specie]) ]
+
+    return specie_requests, root_requests, rooted
+
+def read_species_table(species_table: str) -> list:
+    """
+    [(specie, panaroo_dir, core_clusters_file, output_dir)] of a batch species table.
+    """
+    species = []
+    with open(species_table, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            assert len(fields) == 4, "Expected 4 tab separated columns in species table: {}".format(line.strip())
+            species.append(tuple(fields))
+    assert len(set(specie for specie, *_ in species)) == len(species), "Duplicated species in species table."
+    return species
+
+def batch(panaroo_genus_dir: str, roots_file: str, annotation_dir: str, fasta_suffix: str, species_table: str, threads: int = 1, faidx_backend: str = 'native', roots_backend: str = 'index', annotation_cache: str = None, dry_run: bool = False, *args, **kwargs) -> None:
+    """
+    Multifastas of every species of the species table with shared scans and one pool.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M",
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+        ]
+    )
+
+    assert all([os.path.exists(x) for x in [roots_file, annotation_dir, species_table]]), "One or more paths do not exist."
+    assert faidx_backend in ('native', 'samtools'), "Invalid faidx backend: {}.".format(faidx_backend)
+    assert roots_backend in ('index', 'full'), "Invalid roots backend: {}.".format(roots_backend)
+
+    with stage_trace.span('read_inputs'):
+        species = read_species_table(species_table)
+        logger.info("Batch of {} species.".format(len(species)))
+
+        species_genome_ids = {specie: extract_species_genome_ids_from_panaroo_out(panaroo_dir=panaroo_dir) for specie, panaroo_dir, _, _ in species}
+
+        logger.info("Listing genomes fastas ...")
+        cache_file = annotation_cache or (os.path.join(species[0][3], CACHE_NAME) if species else None)
+        genomes_fastas = list_and_filter_files(annotation_dir=annotation_dir, genome_ids=set().union(*species_genome_ids.values()), fasta_suffix=fasta_suffix, cache_file=cache_file)
+
+        logger.info("Listing roots fasta files ...")
+        roots_fastas = list_roots_fasta_files(panaroo_genus_dir=panaroo_genus_dir)
+
+        logger.info("Reading roots ({} backend) ...".format(roots_backend))
+        all_roots = read_roots(roots_file=roots_file) if roots_backend == 'full' else None
+
+    assert roots_fastas, "Empty dict"
+
+    logger.info("Planning multifastas ...")
+    plans, jobs = {}, []
+    with stage_trace.span('plan'):
+        signatures = {}
+        for specie, panaroo_dir, core_clusters_file, output_dir in species:
+            roots = all_roots if all_roots is not None else read_specie_roots(roots_file=roots_file, specie=specie)
+            genome_ids = sorted(species_genome_ids[specie])
+            manifest_file = os.path.abspath(os.path.join(output_dir, MANIFEST_NAME))
+            manifest = read_manifest(manifest_file)
+            logger.info("Read {} clusters of {} from manifest: {}".format(len(manifest), specie, manifest_file))
+
+            plan, rooted, entries = {}, {}, []
+            for core_cluster in sorted(read_core_clusters_from_file(core_clusters_file=core_clusters_file)):
+                specie_requests, root_requests, rooted[core_cluster] = build_cluster_requests(core_cluster, specie, genome_ids, genomes_fastas, roots, roots_fastas)
+                plan[core_cluster] = inputs_hash(specie_requests + root_requests, signatures)
+                if is_up_to_date(manifest.get(core_cluster), plan[core_cluster]):
+                    entries.append(manifest[core_cluster])
+                else:
+                    jobs.append((specie, core_cluster, specie_requests, root_requests))
+
+            logger.info("Changes of specie {}:".format(specie))
+            changes = report_changes(plan, manifest)
+            plans[specie] = (output_dir, manifest_file, manifest, plan, rooted, changes, entries)
+
+    if dry_run:
+        logger.info("Dry run, nothing written.")
+        return
+
+    logger.info("Generating {} multifastas with {} fasta shards ({} faidx backend) ...".format(len(jobs), threads, faidx_backend))
+    with FastaShards(threads, faidx_backend) as shards:
+        for (specie, core_cluster, _, _), specie_sequences, root_sequences in shards.extract_clusters(jobs, lookahead=threads):
+            output_dir, _, manifest, plan, rooted, _, entries = plans[specie]
+            merged_sequences = '\n'.join(itertools.chain(specie_sequences, root_sequences))
+            cluster_fasta_file, cluster_content_hash = finalize_cluster_fasta(output_dir, specie, core_cluster, merged_sequences, manifest.get(core_cluster))
+            logger.info("Wrote {} + {} root sequences of {} cluster {}: {}".format(len(specie_sequences), len(root_sequences), specie, core_cluster, cluster_fasta_file))
+            entries.append(ManifestEntry(
+                core_cluster, cluster_fasta_file, 'rooted' if rooted[core_cluster] else 'unrooted',
+                cluster_content_hash, plan[core_cluster], len(specie_sequences) + len(root_sequences),
+            ))
+
+    for specie, (output_dir, manifest_file, manifest, plan, _, changes, entries) in plans.items():
+        for core_cluster in changes['removed']:
+            remove_stale_fasta(manifest[core_cluster].path, output_dir)
+        logger.info("Writing manifest file: {} ...".format(manifest_file))
+        write_manifest(manifest_file, entries)
+
+    logger.info("Finished.")
+
+def main(panaroo_genus_dir: str, core_clusters_file: str, specie: str, roots_file: str, annotation_dir: str, panaroo_dir: str, fasta_suffix: str, output_dir: str, threads: int = 1, faidx_backend: str = 'native', roots_backend: str = 'index', annotation_cache: str = None, dry_run: bool = False, *args, **kwargs) -> None:
 
     # Configure logging
     logging.basicConfig(
@@ -125,83 +365,87 @@ def main(panaroo_genus_dir: str, core_clusters_file: str, specie: str, roots_fil
 
     assert all([os.path.exists(x) for x in [roots_file, annotation_dir, panaroo_dir]]), "One or more paths do not exist."
 
-    logger.info("Extracting species genome_ids from panaroo output ...")
-    genome_ids = extract_species_genome_ids_from_panaroo_out(panaroo_dir=panaroo_dir)
+    with stage_trace.span('read_inputs'):
+        logger.info("Extracting species genome_ids from panaroo output ...")
+        genome_ids = extract_species_genome_ids_from_panaroo_out(panaroo_dir=panaroo_dir)
 
-    logger.info("Reading species core genes ...")
-    core_clusters = read_core_clusters_from_file(core_clusters_file=core_clusters_file)
+        logger.info("Reading species core genes ...")
+        core_clusters = read_core_clusters_from_file(core_clusters_file=core_clusters_file)
 
-    logger.info("Listing genomes fastas ...")
-    genomes_fastas = list_and_filter_files(annotation_dir=annotation_dir, genome_ids=genome_ids, fasta_suffix=fasta_suffix)
+        logger.info("Listing genomes fastas ...")
+        genomes_fastas = list_and_filter_files(annotation_dir=annotation_dir, genome_ids=genome_ids, fasta_suffix=fasta_suffix, cache_file=annotation_cache or os.path.join(output_dir, CACHE_NAME))
 
-    logger.info("Reading roots ...")
-    roots = read_roots(roots_file=roots_file)
+        logger.info("Reading roots ({} backend) ...".format(roots_backend))
+        assert roots_backend in ('index', 'full'), "Invalid roots backend: {}.".format(roots_backend)
+        if roots_backend == 'index':
+            roots = read_specie_roots(roots_file=roots_file, specie=specie)
+        else:
+            roots = read_roots(roots_file=roots_file)
 
-    logger.info("Listing roots fasta files ...")
-    roots_fastas = list_roots_fasta_files(panaroo_genus_dir=panaroo_genus_dir)
+        logger.info("Listing roots fasta files ...")
+        roots_fastas = list_roots_fasta_files(panaroo_genus_dir=panaroo_genus_dir)
 
-    logger.info("Generating multifastas ...")
+    assert roots_fastas, "Empty dict"
 
-    fasta_ids = set()
-    fasta_renamed = []
+    manifest_file = os.path.abspath(os.path.join(output_dir, MANIFEST_NAME))
+    manifest = read_manifest(manifest_file)
+    logger.info("Read {} clusters from manifest: {}".format(len(manifest), manifest_file))
 
-    assert roots_fastas, "Empty dict"
+    logger.info("Planning multifastas ...")
+    with stage_trace.span('plan'):
+        genome_ids = sorted(genome_ids)
+        signatures = {}
+        plan = {}
+        for core_cluster in sorted(core_clusters):
+            specie_requests, root_requests, _ = build_cluster_requests(core_cluster, specie, genome_ids, genomes_fastas, roots, roots_fastas)
+            plan[core_cluster] = inputs_hash(specie_requests + root_requests, signatures)
+
+    changes = report_changes(plan, manifest)
+    if dry_run:
+        logger.info("Dry run, nothing written.")
+        return
+
+    logger.info("Generating multifastas ...")
 
-    for core_cluster in core_clusters:
-        logger.info("Generating multifasta for core cluster: {}".format(core_cluster))
-
-        # check if id is in fasta_ids, if it is, create another
-        cluster_fasta_id = uuid.uuid1().hex
-        while cluster_fasta_id in fasta_ids:
-            cluster_fasta_id = uuid.uuid1().hex
-        fasta_ids.add(cluster_fasta_id)
-
-        cluster_fasta_file = os.path.join(output_dir, cluster_fasta_id + ".fasta")
-        logger.info("Writing multifasta to: {}".format(cluster_fasta_file))
-
-        with open(cluster_fasta_file, 'w') as f_out:
-            with Pool(processes=threads) as pool:
-                logger.info("Initiating pool of {} threads for core_cluster: {}".format(threads, core_cluster))
-                specie_sequences = pool.starmap(
-                    extract_record_from_fasta_faidx,
-                    [(genomes_fastas[genome_id] , f'{genome_id}#{core_cluster}') for genome_id in genome_ids if genomes_fastas.get(genome_id) ]
-                )
-                specie_sequences = tuple(filter(None, specie_sequences))
-                logger.info("Finished pool of {} threads for core_cluster: {}".format(threads, core_cluster))
-
-                # Root sequences
-                root_sequences = []
-
-                logger.info("Rooting cluster {} ...".format(core_cluster))
-                cluster_roots = roots.get(f'{specie}#{core_cluster}', [])
-                if cluster_roots or len(cluster_roots) > 1:
-                    cluster_roots = {k : v for k,v in cluster_roots.items() if k != specie}
-                    logger.info("Cluster {} has {} roots.".format(core_cluster, sum([len(v) for v in cluster_roots.values()])))
-
-                    root_sequences = pool.starmap(
-                        extract_record_from_fasta_faidx,
-                        [ (roots_fastas[root_specie], root_id) for root_specie, root_ids in cluster_roots.items() for root_id in root_ids ]
-                        )
-                    root_sequences = tuple(filter(None, root_sequences))
-                    fasta_renamed.append(f'{core_cluster},{cluster_fasta_file},rooted')
+    assert faidx_backend in ('native', 'samtools'), "Invalid faidx backend: {}.".format(faidx_backend)
+    manifest_entries, jobs = [], []
+    for core_cluster, cluster_inputs_hash in plan.items():
+        previous = manifest.get(core_cluster)
+        if is_up_to_date(previous, cluster_inputs_hash):
+            logger.info("Cluster {} is up to date: {}".format(core_cluster, previous.path))
+            manifest_entries.append(previous)
+            continue
+        specie_requests, root_requests, rooted = build_cluster_requests(core_cluster, specie, genome_ids, genomes_fastas, roots, roots_fastas)
+        jobs.append((core_cluster, rooted, specie_requests, root_requests))
+
+    logger.info("Initiating {} fasta shards ({} faidx backend) ...".format(threads, faidx_backend))
+    with FastaShards(threads, faidx_backend) as shards:
+        for (core_cluster, rooted, _, root_requests), specie_sequences, root_sequences in shards.extract_clusters(jobs, lookahead=threads):
+            with stage_trace.span('cluster', item=core_cluster):
+                logger.info("Extracted {} specie sequences for core_cluster: {}".format(len(specie_sequences), core_cluster))
+                if rooted:
+                    logger.info("Cluster {} has {} roots.".format(core_cluster, len(root_requests)))
                 else:
-                    fasta_renamed.append(f'{core_cluster},{cluster_fasta_file},unrooted')
                     logger.info("Cluster {} has no roots.".format(core_cluster))
 
                 # merge specie and root sequences and write to file
                 logger.info("Merging specie (count: {}) and root (count: {}) sequences for cluster {}".format(len(specie_sequences), len(root_sequences), core_cluster))
-                merged_sequences = iter(itertools.chain(specie_sequences, root_sequences))
+                merged_sequences = '\n'.join(itertools.chain(specie_sequences, root_sequences))
 
-                # write to file
-                logger.info("Writing merged sequences to file {} for cluster {}".format(cluster_fasta_file, core_cluster))
-                f_out.write('\n'.join(merged_sequences))
+                cluster_fasta_file, cluster_content_hash = finalize_cluster_fasta(output_dir, specie, core_cluster, merged_sequences, manifest.get(core_cluster))
+                logger.info("Wrote merged sequences to file {} for cluster {}".format(cluster_fasta_file, core_cluster))
 
+                manifest_entries.append(ManifestEntry(
+                    core_cluster, cluster_fasta_file, 'rooted' if rooted else 'unrooted',
+                    cluster_content_hash, plan[core_cluster], len(specie_sequences) + len(root_sequences),
+                ))
+    logger.info("Finished {} fasta shards.".format(threads))
 
-    summary_name = os.path.abspath(os.path.join(output_dir, 'renamed_fasta_names.csv'))
-    logger.info("Writing summary file: {} ...".format(summary_name))
+    for core_cluster in changes['removed']:
+        remove_stale_fasta(manifest[core_cluster].path, output_dir)
 
-    with open(summary_name, 'w') as f:
-        f.write("\n".join(fasta_renamed))
+    logger.info("Writing manifest file: {} ...".format(manifest_file))
+    write_manifest(manifest_file, manifest_entries)
 
     logger.info("Finished.")
 
@@ -210,4 +454,8 @@ if __name__ == "__main__":
     args = clean_args(docopt(__doc__))
     args['threads'] = int(args['threads'])
     assert args['threads'] > 0, "Threads must be greater than 0."
-    main(**args)
+    with stage_trace.span('main', whole_process=True):
+        if args.pop('batch'):
+            batch(**args)
+        else:
+            main(**args)
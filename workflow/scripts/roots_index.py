@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Sorted, species indexed copy of the genus-wide mmseqs roots tsv ('ROOT_CLUSTER<TAB>MEMBER').
+
+    ROOTS.sorted      rows sorted by root cluster ('SPECIE#CLUSTER') then member, quotes removed.
+    ROOTS.sorted.idx  'source<TAB>SIZE:MTIME_NS' then one 'SPECIE<TAB>START<TAB>END<TAB>ROWS' row per
+                      species (byte range of its root clusters in ROOTS.sorted).
+
+The sorted copy is built once with an external sort (chunks of 'chunk_rows' rows),
+and rebuilt when the roots file changes; each run then reads only the byte range
+of its species (read_specie_roots), same result as read_roots restricted to it.
+
+Usage:
+    roots_index.py ROOTS [ --chunk_rows=N ]
+
+Options:
+    --chunk_rows=N    Rows sorted in memory per chunk [default: 1000000].
+"""
+
+import os
+import heapq
+import logging
+from itertools import islice
+from collections import defaultdict
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+from docopt import docopt
+
+from cluster_manifest import file_signature
+
+CHUNK_ROWS = 1000000
+
+
+def index_files(roots_file: str) -> tuple:
+    return roots_file + '.sorted', roots_file + '.sorted.idx'
+
+
+def normalized_rows(roots_file: str, separator: str = '\t'):
+    with open(roots_file, 'r') as f:
+        for line in f:
+            line = line.strip().replace('"', '')
+            if line:
+                root_cluster, member = line.split(separator)
+                yield '{}\t{}\n'.format(root_cluster, member)
+
+
+def sorted_runs(roots_file: str, work_prefix: str, chunk_rows: int = CHUNK_ROWS) -> list:
+    """
+    Write the rows as sorted runs of at most 'chunk_rows' rows.
+    """
+    run_files = []
+    rows = normalized_rows(roots_file)
+    while True:
+        chunk = sorted(islice(rows, chunk_rows))
+        if not chunk:
+            return run_files
+        run_file = '{}.{}.run'.format(work_prefix, len(run_files))
+        with open(run_file, 'w') as f_out:
+            f_out.writelines(chunk)
+        run_files.append(run_file)
+
+
+def read_index(roots_file: str) -> dict:
+    """
+    {specie: (start, end, rows)} of an up to date index, None when missing or stale.
+    """
+    sorted_file, idx_file = index_files(roots_file)
+    if not (os.path.exists(sorted_file) and os.path.exists(idx_file)):
+        return None
+    with open(idx_file, 'r') as f:
+        _, signature = next(f).rstrip('\n').split('\t')
+        if signature != file_signature(roots_file, {}):
+            return None
+        index = {}
+        for line in f:
+            specie, start, end, rows = line.rstrip('\n').split('\t')
+            index[specie] = (int(start), int(end), int(rows))
+    return index
+
+
+def build_index(roots_file: str, chunk_rows: int = CHUNK_ROWS) -> dict:
+    """
+    Sort the roots file into ROOTS.sorted and write the species byte ranges to ROOTS.sorted.idx.
+    """
+    sorted_file, idx_file = index_files(roots_file)
+    # Unique temporary names: concurrent runs of several species may build at the same time.
+    work_prefix = '{}.{}'.format(sorted_file, os.getpid())
+    signature = file_signature(roots_file, {})
+
+    run_files = sorted_runs(roots_file, work_prefix, chunk_rows=chunk_rows)
+    index, offset = {}, 0
+    with open(work_prefix + '.tmp', 'w') as f_out:
+        handles = [open(run_file, 'r') for run_file in run_files]
+        try:
+            for line in heapq.merge(*handles):
+                specie = line.split('#', 1)[0].split('\t', 1)[0]
+                start, end, rows = index.get(specie, (offset, offset, 0))
+                assert end == offset, 'Root clusters of specie {} are not contiguous once sorted.'.format(specie)
+                size = len(line.encode('utf-8'))
+                index[specie] = (start, offset + size, rows + 1)
+                offset += size
+                f_out.write(line)
+        finally:
+            for handle in handles:
+                handle.close()
+            for run_file in run_files:
+                os.remove(run_file)
+
+    with open(work_prefix + '.idx.tmp', 'w') as f_out:
+        f_out.write('source\t{}\n'.format(signature))
+        for specie, (start, end, rows) in index.items():
+            f_out.write('{}\t{}\t{}\t{}\n'.format(specie, start, end, rows))
+    os.replace(work_prefix + '.tmp', sorted_file)
+    os.replace(work_prefix + '.idx.tmp', idx_file)
+    logger.info('Indexed {} roots rows of {} species: {}'.format(sum(rows for _, _, rows in index.values()), len(index), sorted_file))
+    return index
+
+
+def load_index(roots_file: str, chunk_rows: int = CHUNK_ROWS) -> dict:
+    index = read_index(roots_file)
+    if index is None:
+        logger.info('Building roots index of: {}'.format(roots_file))
+        index = build_index(roots_file, chunk_rows=chunk_rows)
+    return index
+
+
+def read_specie_roots(roots_file: str, specie: str, chunk_rows: int = CHUNK_ROWS) -> dict:
+    """
+    {root_cluster: {specie: set(members)}} of the root clusters of 'specie' (as read_roots).
+    """
+    index = load_index(roots_file, chunk_rows=chunk_rows)
+    if specie not in index:
+        return {}
+    start, end, _ = index[specie]
+    result = defaultdict(lambda: defaultdict(set))
+    with open(index_files(roots_file)[0], 'rb') as f:
+        f.seek(start)
+        for line in f.read(end - start).decode('utf-8').splitlines():
+            root_cluster, member = line.split('\t')
+            result[root_cluster][member.split('#')[0]].add(member)
+    return {root_cluster: dict(names) for root_cluster, names in result.items()}
+
+
+def main(ROOTS, chunk_rows, *args, **kwargs):
+    build_index(ROOTS, chunk_rows=int(chunk_rows))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        datefmt='%Y-%m-%d %H:%M:%S',
+        )
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
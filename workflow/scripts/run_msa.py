@@ -2,36 +2,64 @@
 """
 Runs the MSA algorithm on a list of fasta files.
 
+Jobs are scheduled largest first (cost from sequence count and mean length,
+or from the runtimes recorded by previous runs) and each one gets a number of
+mafft threads proportional to its cost, sharing the --threads budget.
+
+Only the unique sequences of a fasta are aligned; the alignment is then
+expanded back to every original header. Alignments of unique sequence sets
+are cached by hash(sequences + mafft options), so unchanged clusters are
+never re-aligned.
+
 Usage:
-    run_msa.py ( --input_dir=PATH ) ( --output_dir=PATH ) [ --threads=INT ]
+    run_msa.py ( --input_dir=PATH ) ( --output_dir=PATH ) [ --threads=INT ] [ --max_job_threads=INT ]
+               [ --cache_dir=PATH ]
 
 Options:
-    --input_dir=PATH    The directory containing the fasta files.
-    --output_dir=PATH   The directory to write the output to.
-    --threads=INT       The number of threads to use. [default: 1]
+    --input_dir=PATH        The directory containing the fasta files.
+    --output_dir=PATH       The directory to write the output to.
+    --threads=INT           The number of threads to use. [default: 1]
+    --max_job_threads=INT   Max threads given to a single mafft instance. [default: 16]
+    --cache_dir=PATH        Alignment cache directory (OUTPUT_DIR/.msa_cache if not given).
 """
 
 import os
 import sys
+import math
+import time
+import statistics
+import hashlib
+import tempfile
 import subprocess
-import multiprocessing
 import logging
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from collections import namedtuple
 logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
 from docopt import docopt
 
-def run_mafft(fasta_file, output_dir, mafft_threads):
+import stage_trace
+from cluster_manifest import cluster_fasta_key
+
+RUNTIMES_FILE = 'msa_runtimes.tsv'
+RUNTIMES_COLUMNS = ('fasta', 'sequences', 'unique', 'mean_length', 'threads', 'seconds')
+MAFFT_OPTIONS = ('--quiet', '--auto')
+
+MsaJob = namedtuple('MsaJob', 'cost threads fasta_file sequences unique mean_length cached expected')
+
+def aln_output_file(fasta_file, output_dir):
+    return os.path.join(output_dir, os.path.basename(fasta_file).replace('.fasta', '.aln.fasta'))
+
+def run_mafft(fasta_file, output_dir, mafft_threads, output_file=None):
     """
     Runs mafft on a fasta file.
     """
     logger.info('Running mafft on {}'.format(fasta_file))
-    output_file = os.path.join(output_dir, os.path.basename(fasta_file).replace('.fasta', '.aln.fasta'))
+    output_file = output_file or aln_output_file(fasta_file, output_dir)
     cmd = [
         'mafft',
         '--thread', str(mafft_threads),
-        '--quiet',
-        '--auto',
+        *MAFFT_OPTIONS,
         fasta_file,
         '>',
         output_file,
@@ -42,14 +70,273 @@ def run_mafft(fasta_file, output_dir, mafft_threads):
     logger.info('cmd: {}'.format(cmd))
 
     try:
-        subprocess.run(cmd, check=True, shell=True)
+        stage_trace.run(cmd, check=True, shell=True)
         logger.info('Finished mafft on {}'.format(fasta_file))
+        return True
     except subprocess.CalledProcessError as e:
         logger.error('Error running mafft on {}'.format(fasta_file))
         logger.error(e)
     except Exception as e:
         logger.error('Error running mafft on {}'.format(fasta_file))
         logger.error(e)
+    return False
+
+def read_fasta(fasta_file):
+    """
+    [(header, sequence), ...] of a fasta file (header without '>', sequence unwrapped).
+    """
+    records = []
+    with open(fasta_file, 'r') as f:
+        header, sequence = None, []
+        for line in f:
+            if line.startswith('>'):
+                if header is not None:
+                    records.append((header, ''.join(sequence)))
+                header, sequence = line[1:].rstrip('\n'), []
+            else:
+                sequence.append(line.strip())
+        if header is not None:
+            records.append((header, ''.join(sequence)))
+    return records
+
+def read_aligned_blocks(aln_file):
+    """
+    {header: aligned sequence lines as written by mafft} of an alignment.
+    """
+    blocks = {}
+    with open(aln_file, 'r') as f:
+        header = None
+        for line in f:
+            if line.startswith('>'):
+                header = line[1:].rstrip('\n')
+                blocks[header] = []
+            elif header is not None:
+                blocks[header].append(line)
+    return {header: ''.join(lines) for header, lines in blocks.items()}
+
+def fasta_dimensions(fasta_file):
+    """
+    (sequence count, unique sequence count, mean sequence length, alignment_key) of a fasta file.
+    """
+    records = read_fasta(fasta_file)
+    sequences = len(records)
+    bases = sum(len(sequence) for _, sequence in records)
+    unique_sequences = sorted(set(sequence for _, sequence in records))
+    return sequences, len(unique_sequences), (bases / sequences if sequences else 0), alignment_key(unique_sequences)
+
+def alignment_key(unique_sequences):
+    """
+    Cache key of a (sorted) unique sequence set aligned with MAFFT_OPTIONS.
+    """
+    digest = hashlib.sha256(' '.join(MAFFT_OPTIONS).encode('utf-8') + b'\n')
+    for sequence in unique_sequences:
+        digest.update(sequence.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+def align_unique(fasta_file, output_dir, mafft_threads, cache_dir):
+    """
+    Align the unique sequences of fasta_file (or reuse the cached alignment)
+    and expand it back to every original header, in the original order.
+
+    Returns (success, cache_hit, sequences, unique).
+    """
+    records = read_fasta(fasta_file)
+    unique_sequences = sorted(set(sequence for _, sequence in records))
+    output_file = aln_output_file(fasta_file, output_dir)
+
+    if len(unique_sequences) < 2:
+        # Nothing to align: the copies as mafft writes them (lowercase).
+        with open(output_file + '.tmp', 'w') as f_out:
+            f_out.write(''.join('>{}\n{}\n'.format(header, sequence.lower()) for header, sequence in records))
+        os.replace(output_file + '.tmp', output_file)
+        return True, False, len(records), len(unique_sequences)
+
+    key = alignment_key(unique_sequences)
+    cached_aln = os.path.join(cache_dir, key + '.aln.fasta')
+    cache_hit = os.path.exists(cached_aln)
+
+    if cache_hit:
+        logger.info('Cache hit for {}: {}'.format(fasta_file, cached_aln))
+    else:
+        # Unique names: jobs (of this run or of runs sharing the cache) may align the same sequence set.
+        fd, unique_fasta = tempfile.mkstemp(dir=cache_dir, prefix=key + '.', suffix='.fasta')
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join('>u{}\n{}\n'.format(idx, sequence) for idx, sequence in enumerate(unique_sequences)))
+        fd, tmp_aln = tempfile.mkstemp(dir=cache_dir, prefix=key + '.', suffix='.aln.fasta.tmp')
+        os.close(fd)
+        try:
+            success = run_mafft(unique_fasta, cache_dir, mafft_threads, output_file=tmp_aln)
+        finally:
+            os.remove(unique_fasta)
+        if not success:
+            os.remove(tmp_aln)
+            return False, False, len(records), len(unique_sequences)
+        if os.path.exists(cached_aln):
+            logger.info('Cached while aligning {}, keeping {}'.format(fasta_file, cached_aln))
+            os.remove(tmp_aln)
+        else:
+            os.replace(tmp_aln, cached_aln)
+
+    blocks = read_aligned_blocks(cached_aln)
+    unique_idx = {sequence: idx for idx, sequence in enumerate(unique_sequences)}
+    with open(output_file + '.tmp', 'w') as f_out:
+        for header, sequence in records:
+            f_out.write('>{}\n{}'.format(header, blocks['u{}'.format(unique_idx[sequence])]))
+    os.replace(output_file + '.tmp', output_file)
+
+    return True, cache_hit, len(records), len(unique_sequences)
+
+def estimate_cost(sequences, mean_length):
+    """
+    Relative mafft cost: pairwise distances/progressive alignment grow ~ n^2 * L.
+    """
+    return max(1.0, sequences) ** 2 * max(1.0, mean_length)
+
+def read_runtimes(runtimes_file):
+    """
+    {cluster key: (cpu seconds (threads * seconds), estimated cost of the recorded size)} recorded by previous runs.
+
+    Keyed by cluster (cluster_fasta_key), not by the content-addressed file name: a
+    cluster whose sequences changed (so it is actually aligned) finds its runtime.
+    """
+    runtimes = {}
+    if not os.path.exists(runtimes_file):
+        return runtimes
+    with open(runtimes_file, 'r') as f:
+        header = next(f, '').strip().split('\t')
+        for line in f:
+            row = dict(zip(header, line.strip().split('\t')))
+            try:
+                runtimes[cluster_fasta_key(row['fasta'])] = (
+                    float(row['threads']) * float(row['seconds']),
+                    estimate_cost(float(row['unique']), float(row['mean_length'])),
+                )
+            except (KeyError, ValueError):
+                continue
+    return runtimes
+
+def write_runtimes(runtimes_file, rows):
+    """
+    Merge this run's rows into the runtimes table (latest observation per cluster wins).
+    """
+    table = {}
+    if os.path.exists(runtimes_file):
+        with open(runtimes_file, 'r') as f:
+            header = next(f, '').strip().split('\t')
+            for line in f:
+                row = dict(zip(header, line.strip().split('\t')))
+                if 'fasta' in row:
+                    table[cluster_fasta_key(row['fasta'])] = dict(row, fasta=cluster_fasta_key(row['fasta']))
+    for row in rows:
+        table[row['fasta']] = row
+
+    with open(runtimes_file + '.tmp', 'w') as f:
+        f.write('\t'.join(RUNTIMES_COLUMNS) + '\n')
+        for row in table.values():
+            f.write('\t'.join(str(row.get(column, '')) for column in RUNTIMES_COLUMNS) + '\n')
+    os.replace(runtimes_file + '.tmp', runtimes_file)
+
+def plan_jobs(fasta_files, runtimes, threads, max_job_threads, cache_dir):
+    """
+    [MsaJob, ...] largest cost first.
+
+    A cluster aligned before gets its observed cpu seconds scaled by the
+    n^2 * L estimate (n = unique sequences) of its current over its recorded
+    size; other clusters get the estimate scaled by the median seconds/estimate
+    ratio of every recorded alignment. A job gets threads in
+    proportion to how many fair shares (total cost / threads) it represents:
+    small jobs and cache hits run single threaded.
+    """
+    jobs = []
+    for fasta_file in fasta_files:
+        sequences, unique, mean_length, key = fasta_dimensions(fasta_file)
+        cached = unique >= 2 and os.path.exists(os.path.join(cache_dir, key + '.aln.fasta'))
+        jobs.append([estimate_cost(unique, mean_length), fasta_file, sequences, unique, mean_length, cached])
+
+    scale = statistics.median(cpu_seconds / recorded for cpu_seconds, recorded in runtimes.values()) if runtimes else 1.0
+
+    planned = []
+    for estimate, fasta_file, sequences, unique, mean_length, cached in jobs:
+        cpu_seconds, recorded = runtimes.get(cluster_fasta_key(fasta_file), (None, None))
+        expected = cpu_seconds * estimate / recorded if cpu_seconds is not None else estimate * scale
+        planned.append(MsaJob(0.0 if cached else expected, 1, fasta_file, sequences, unique, mean_length, cached, expected))
+
+    fair_share = sum(job.cost for job in planned) / threads
+    if fair_share:
+        planned = [job._replace(threads=min(max_job_threads, threads, max(1, math.ceil(job.cost / fair_share)))) for job in planned]
+    return sorted(planned, key=lambda x: x.cost, reverse=True)
+
+def timed_alignment(job, output_dir, cache_dir):
+    """
+    (success, cache_hit, seconds) of a job; errors are logged as a failed alignment (the other jobs go on).
+    """
+    start = time.perf_counter()
+    try:
+        with stage_trace.span('align', item=os.path.basename(job.fasta_file), threads=job.threads, sequences=job.sequences, unique=job.unique) as record:
+            success, cache_hit, _, _ = align_unique(job.fasta_file, output_dir, job.threads, cache_dir)
+            record['cache_hit'] = cache_hit
+    except Exception as e:
+        logger.error('Error aligning {}'.format(job.fasta_file))
+        logger.error(e)
+        success, cache_hit = False, False
+    return success, cache_hit, time.perf_counter() - start
+
+def run_scheduled(jobs, output_dir, threads, cache_dir):
+    """
+    Run planned jobs sharing 'threads' cores: the largest job that fits in the
+    free cores starts as soon as any job finishes (small jobs backfill the gaps).
+
+    Returns (runtimes rows of the alignments actually run, dedup/cache report).
+    """
+    pending = list(jobs)
+    running = {}
+    free_threads = threads
+    rows = []
+    report = {'sequences': 0, 'unique': 0, 'cache_hits': 0, 'saved_cpu_seconds': 0.0}
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or running:
+            started = True
+            while pending and started:
+                started = False
+                for idx, job in enumerate(pending):
+                    if job.threads <= free_threads:
+                        future = executor.submit(timed_alignment, job, output_dir, cache_dir)
+                        running[future] = pending.pop(idx)
+                        free_threads -= job.threads
+                        started = True
+                        break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                free_threads += job.threads
+                success, cache_hit, seconds = future.result()
+                logger.info('{} ({} seqs, {} unique, {:.0f} bp mean) took {:.1f}s with {} threads{}.'.format(
+                    os.path.basename(job.fasta_file), job.sequences, job.unique, job.mean_length, seconds, job.threads,
+                    ' (cached)' if cache_hit else '',
+                ))
+                if not success:
+                    continue
+
+                report['sequences'] += job.sequences
+                report['unique'] += job.unique
+                if cache_hit:
+                    report['cache_hits'] += 1
+                    report['saved_cpu_seconds'] += job.expected
+                    continue
+
+                if job.unique:
+                    report['saved_cpu_seconds'] += job.threads * seconds * ((job.sequences / job.unique) ** 2 - 1)
+                rows.append({
+                    'fasta': cluster_fasta_key(job.fasta_file),
+                    'sequences': job.sequences,
+                    'unique': job.unique,
+                    'mean_length': f'{job.mean_length:.1f}',
+                    'threads': job.threads,
+                    'seconds': f'{seconds:.3f}',
+                })
+    return rows, report
 
 def main(*args, **kwargs):
 
@@ -63,21 +350,37 @@ def main(*args, **kwargs):
         ]
     )
 
-    
     threads = int(kwargs['--threads'])
-    mafft_threads = 4
-    mafft_instances = max(1, int(threads/mafft_threads))
+    max_job_threads = int(kwargs['--max_job_threads'])
+    assert threads >= 1 and max_job_threads >= 1, 'Threads need to be more equal than 1'
+
+    runtimes_file = os.path.join(kwargs['--output_dir'], RUNTIMES_FILE)
+    runtimes = read_runtimes(runtimes_file)
+    logger.info('Loaded {} recorded runtimes from {}.'.format(len(runtimes), runtimes_file))
+
+    cache_dir = kwargs['--cache_dir'] or os.path.join(kwargs['--output_dir'], '.msa_cache')
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    fasta_files = list(map(lambda x: str(x), Path(kwargs['--input_dir']).glob('*.fasta')))
+    jobs = plan_jobs(fasta_files, runtimes, threads, max_job_threads, cache_dir)
+
+    logger.info('Starting run_msa.py with {} threads for {} alignments.'.format(threads, len(jobs)))
+    logger.info('Threads per mafft instance: {}.'.format(
+        ', '.join('{}x{}'.format(sum(1 for job in jobs if job.threads == t), t) for t in sorted({job.threads for job in jobs}))
+    ))
 
-    logger.info('Starting run_msa.py with {} threads.'.format(mafft_instances))
-    logger.info('Each mafft instance with {} threads.'.format(mafft_threads))
+    rows, report = run_scheduled(jobs, kwargs['--output_dir'], threads, cache_dir)
+    write_runtimes(runtimes_file, rows)
+    logger.info('Wrote runtimes of {} alignments to {}.'.format(len(rows), runtimes_file))
 
-    with multiprocessing.Pool(processes=mafft_instances) as pool:
-        pool.map(
-            partial(run_mafft, output_dir=kwargs['--output_dir'], mafft_threads=mafft_threads),
-            list(map(lambda x: str(x), Path(kwargs['--input_dir']).glob('*.fasta'))),
-        )
+    logger.info('Dedup: {} sequences, {} unique (ratio {:.2f}).'.format(
+        report['sequences'], report['unique'], report['sequences'] / report['unique'] if report['unique'] else 0
+    ))
+    logger.info('Cache hits: {}/{} alignments.'.format(report['cache_hits'], len(jobs)))
+    logger.info('Estimated cpu time saved by dedup and cache: {:.1f}s.'.format(report['saved_cpu_seconds']))
 
     logger.info('ALL ALIGNMENTS FINISHED !!!')
 
 if __name__ == '__main__':
-    main(**docopt(__doc__))
+    with stage_trace.span('main', whole_process=True):
+        main(**docopt(__doc__))
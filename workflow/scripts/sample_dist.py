@@ -1,19 +1,147 @@
 #!/usr/bin/env python3
+"""
+Random row/column subsamples of a FastME (PHYLIP) distance matrix.
+
+Usage:
+    sample_dist.py MATRIX SAMPLE_SIZE > OUTPUT
+    sample_dist.py MATRIX SAMPLE_SIZE REPLICATES OUTPUT_PREFIX [SEED]
+
+Rows are fetched with seeks through a byte offset index built once next to the
+matrix ('MATRIX.rows.npy'). With REPLICATES, every sampled row is read once and
+written to each replicate ('OUTPUT_PREFIX.<n>.phylip') that drew it; replicates
+are written in groups of at most MAX_OPEN_REPLICATES open files, fewer under a
+low fd limit (one pass over the sampled rows of each group).
+"""
+
+import os
 import sys
 import random
+import resource
+
+import numpy as np
+
+INDEX_SUFFIX = '.rows.npy'
+READ_SIZE = 1 << 24
+# Replicate files open at once (each with a WRITE_BUFFER buffer) and fds left for the rest.
+MAX_OPEN_REPLICATES = 256
+FD_MARGIN = 32
+WRITE_BUFFER = 1 << 20
+
+
+def build_row_index(fn):
+    """
+    int64 offsets of the n rows of the matrix plus the end of file (n + 1 values).
+    """
+    offsets = []
+    with open(fn, 'rb') as f:
+        header = f.readline()
+        n_rows = int(header)
+        position = len(header)
+        offsets.append(np.array([position], dtype=np.int64))
+        while chunk := f.read(READ_SIZE):
+            offsets.append(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n')).astype(np.int64) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        # Last row without a trailing newline.
+        offsets = np.append(offsets, position)
+    assert len(offsets) == n_rows + 1, f'{fn}: header says {n_rows} rows, found {len(offsets) - 1}.'
+    return offsets
+
+def load_row_index(fn):
+    """
+    Row index of the matrix, (re)built when missing or older than the matrix.
+    """
+    index_file = fn + INDEX_SUFFIX
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fn):
+        return np.load(index_file)
+    offsets = build_row_index(fn)
+    tmp_file = index_file + '.tmp.npy'
+    np.save(tmp_file, offsets)
+    os.replace(tmp_file, index_file)
+    return offsets
+
+def iter_rows(fn, offsets, rows):
+    """
+    Yield (row, uint8 array of the line with its newline) for the sorted 'rows'.
+    """
+    with open(fn, 'rb') as f:
+        for row in rows:
+            f.seek(offsets[row])
+            line = f.read(offsets[row + 1] - offsets[row])
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            yield row, np.frombuffer(line, dtype=np.uint8)
+
+def select_fields(line, fields):
+    """
+    Bytes of the tab separated 'fields' (sorted field numbers) of a line, tab joined and newline ended.
+    """
+    tabs = np.flatnonzero((line == ord('\t')) | (line == ord('\n')))
+    starts = np.concatenate(([0], tabs[:-1] + 1))[fields]
+    # Each field is taken with the separator that follows it.
+    lengths = tabs[fields] - starts + 1
+    ends = np.cumsum(lengths)
+    gather = np.arange(ends[-1]) - np.repeat(ends - lengths - starts, lengths)
+    selected = line[gather]
+    selected[ends - 1] = ord('\t')
+    selected[-1] = ord('\n')
+    return selected.tobytes()
+
+def sample_dist(fn, sample_size, rng=random):
+    offsets = load_row_index(fn)
+    random_recs = np.array(sorted(rng.sample(range(len(offsets) - 1), sample_size)), dtype=np.int64)
+    fields = np.concatenate(([0], random_recs + 1))
+    output = sys.stdout.buffer
+    output.write(f'{sample_size}\n'.encode())
+    for _, line in iter_rows(fn, offsets, random_recs):
+        output.write(select_fields(line, fields))
+    output.flush()
+
+def sample_dist_replicates(fn, sample_size, replicates, output_prefix, seed=None):
+    """
+    Write 'replicates' seeded subsamples of the matrix reading each sampled row once per group of replicates.
+    """
+    rng = random.Random(seed)
+    offsets = load_row_index(fn)
+    samples = [np.array(sorted(rng.sample(range(len(offsets) - 1), sample_size)), dtype=np.int64) for _ in range(replicates)]
+    width = len(str(replicates - 1))
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    group_size = MAX_OPEN_REPLICATES if soft == resource.RLIM_INFINITY else max(1, min(MAX_OPEN_REPLICATES, soft - FD_MARGIN))
+    for first in range(0, replicates, group_size):
+        group = range(first, min(first + group_size, replicates))
+        write_replicates(fn, offsets, sample_size, {replicate: samples[replicate] for replicate in group}, output_prefix, width)
+
+def write_replicates(fn, offsets, sample_size, samples, output_prefix, width):
+    """
+    Write the {replicate: sample} replicates, all open at once, reading each sampled row once.
+    """
+    fields = {replicate: np.concatenate(([0], sample + 1)) for replicate, sample in samples.items()}
+
+    # row -> replicates that drew it
+    row_replicates = {}
+    for replicate, sample in samples.items():
+        for row in sample.tolist():
+            row_replicates.setdefault(row, []).append(replicate)
 
-def sample_dist(fn, sample_size):
-    with open(fn, 'r') as f:
-        lines = map(str.strip, f)
-        header = int(next(lines))
-        random_recs = set(random.sample(range( header ), sample_size))
-        print(sample_size)
-        for _, line in filter(lambda x: x[0] in random_recs, enumerate(lines)):
-            genome_id, *dists = line.split('\t')
-            print(genome_id, *(dist for i, dist in enumerate(dists) if i in random_recs), sep='\t')
+    outputs = {}
+    try:
+        for replicate in samples:
+            outputs[replicate] = open(f'{output_prefix}.{replicate:0{width}d}.phylip', 'wb', buffering=WRITE_BUFFER)
+            outputs[replicate].write(f'{sample_size}\n'.encode())
+        for row, line in iter_rows(fn, offsets, sorted(row_replicates)):
+            for replicate in row_replicates[row]:
+                outputs[replicate].write(select_fields(line, fields[replicate]))
+    finally:
+        for output in outputs.values():
+            output.close()
 
 
 if __name__ == '__main__':
-    fn, sample_size = sys.argv[1:]
+    fn, sample_size, *replicate_args = sys.argv[1:]
     sample_size = int(sample_size)
-    sample_dist(fn, sample_size)
+    if replicate_args:
+        replicates, output_prefix, *seed = replicate_args
+        sample_dist_replicates(fn, sample_size, int(replicates), output_prefix, seed=int(seed[0]) if seed else None)
+    else:
+        sample_dist(fn, sample_size)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Structured stage/item tracing shared by the workflow scripts.
+
+Tracing is enabled by setting PIPELINE_TRACE to a file path (inherited by
+pool workers and child scripts); every process appends JSON lines to it:
+
+    {"kind": "span",  "script", "pid", "stage", "item", "start", "end", "seconds",
+     "cpu_self", "cpu_children", "max_rss_children_mb", ...}
+    {"kind": "child", "script", "pid", "stage", "item", "program", "cmd", "start", "end",
+     "seconds", "cpu", "max_rss_mb", "returncode"}
+
+span cpu_self is the CPU of the calling thread (RUSAGE_THREAD) and
+cpu_children the CPU of the children started with stage_trace.run inside the span
+(wait4, one rusage per child). Spans opened with whole_process=True ('main')
+measure RUSAGE_SELF/RUSAGE_CHILDREN instead, which includes joined pool
+workers and their children.
+
+Usage:
+    stage_trace.py report TRACE [ --top=N ] [ --cores=N ]
+
+Options:
+    --top=N     Rows of each table [default: 15].
+    --cores=N   Cores of the run for the utilization (default: recorded by the 'main' spans).
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import resource
+import statistics
+from collections import defaultdict
+from contextlib import contextmanager
+
+TRACE_ENV = 'PIPELINE_TRACE'
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+# Items slower than 3x their stage median are stragglers only when at least this much slower.
+STRAGGLER_MIN_SECONDS = 1.0
+
+_local = threading.local()
+_trace_fd = {}
+
+
+def enabled() -> bool:
+    return bool(os.environ.get(TRACE_ENV))
+
+def configure(trace_file: str) -> None:
+    """
+    Enable tracing to trace_file for this process and the processes it starts.
+    """
+    os.environ[TRACE_ENV] = os.path.abspath(trace_file)
+
+def script_name() -> str:
+    return os.path.basename(sys.argv[0]).replace('.py', '') if sys.argv and sys.argv[0] else 'python'
+
+def emit(record: dict) -> None:
+    """
+    Append one JSON line (single write on an O_APPEND descriptor, opened once per process).
+    """
+    trace_file = os.environ.get(TRACE_ENV)
+    if not trace_file:
+        return
+    fd = _trace_fd.get((os.getpid(), trace_file))
+    if fd is None:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        _trace_fd[(os.getpid(), trace_file)] = fd
+    record.setdefault('script', script_name())
+    record.setdefault('pid', os.getpid())
+    os.write(fd, (json.dumps(record, default=str) + '\n').encode())
+
+def _stack() -> list:
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+def _cpu(usage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+@contextmanager
+def span(stage: str, item=None, whole_process: bool = False, **fields):
+    """
+    Time a stage (and optionally one item of it: a cluster, a gene ...), see the module docstring.
+
+    Yields the record dict, extra fields can be added to it inside the block.
+    """
+    record = {'kind': 'span', 'stage': stage, 'item': item, 'cpu_children': 0.0, 'max_rss_children_mb': 0.0, **fields}
+    if not enabled():
+        yield record
+        return
+
+    stack = _stack()
+    record['depth'] = len(stack)
+    who = resource.RUSAGE_SELF if whole_process else RUSAGE_THREAD
+    self_start = resource.getrusage(who)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN) if whole_process else None
+    record['start'] = time.time()
+    wall_start = time.perf_counter()
+    stack.append(record)
+    status = 'ok'
+    try:
+        yield record
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        stack.pop()
+        record['seconds'] = time.perf_counter() - wall_start
+        record['end'] = record['start'] + record['seconds']
+        self_end = resource.getrusage(who)
+        record['cpu_self'] = _cpu(self_end) - _cpu(self_start)
+        record['max_rss_mb'] = self_end.ru_maxrss / 1024
+        if whole_process:
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['cpu_children'] = _cpu(children_end) - _cpu(children_start)
+            record['max_rss_children_mb'] = children_end.ru_maxrss / 1024
+            record['cores'] = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        record['status'] = status
+        emit(record)
+
+def wait_process(process: subprocess.Popen):
+    """
+    Reap a child with wait4: sets its returncode (negative signal if killed), returns its rusage.
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    # By hand: os.waitstatus_to_exitcode is Python >= 3.9 (the qiime2 and mafft envs are older).
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage
+
+def run(cmd, stage: str = None, item=None, check: bool = False, stdout=None, stderr=None, input=None, **popen_kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run replacement that reaps the child with wait4 and traces its CPU and max RSS.
+
+    stdout/stderr may be subprocess.PIPE (read in threads), 'input' is written to stdin.
+    """
+    stack = _stack()
+    if stage is None and stack:
+        stage = stack[-1]['stage']
+        item = stack[-1]['item'] if item is None else item
+
+    start, wall_start = time.time(), time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, stdin=subprocess.PIPE if input is not None else None, **popen_kwargs)
+    outputs = {}
+    readers = []
+    for name, stream in (('stdout', process.stdout), ('stderr', process.stderr)):
+        if stream is not None:
+            reader = threading.Thread(target=lambda name, stream: outputs.__setitem__(name, stream.read()), args=(name, stream))
+            reader.start()
+            readers.append(reader)
+    if input is not None:
+        process.stdin.write(input)
+        process.stdin.close()
+    for reader in readers:
+        reader.join()
+    for stream in (process.stdout, process.stderr):
+        if stream is not None:
+            stream.close()
+    usage = wait_process(process)
+    seconds = time.perf_counter() - wall_start
+
+    cpu, max_rss_mb = _cpu(usage), usage.ru_maxrss / 1024
+    for parent in stack:
+        parent['cpu_children'] += cpu
+        parent['max_rss_children_mb'] = max(parent['max_rss_children_mb'], max_rss_mb)
+    if enabled():
+        args = cmd.split() if isinstance(cmd, str) else list(map(str, cmd))
+        emit({
+            'kind': 'child', 'stage': stage, 'item': item, 'program': os.path.basename(args[0]) if args else '',
+            'cmd': ' '.join(args)[:500], 'start': start, 'end': start + seconds, 'seconds': seconds,
+            'cpu': cpu, 'max_rss_mb': max_rss_mb, 'returncode': process.returncode,
+        })
+
+    completed = subprocess.CompletedProcess(cmd, process.returncode, outputs.get('stdout'), outputs.get('stderr'))
+    if check:
+        completed.check_returncode()
+    return completed
+
+def check_output(cmd, **kwargs):
+    return run(cmd, check=True, stdout=subprocess.PIPE, **kwargs).stdout
+
+
+def read_trace(trace_file: str) -> list:
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def print_table(title: str, header: tuple, rows: list) -> None:
+    print('\n## ' + title)
+    print(*header, sep='\t')
+    for row in rows:
+        print(*(f'{value:.2f}' if isinstance(value, float) else value for value in row), sep='\t')
+
+def report(trace_file: str, top: int = 15, cores: int = None) -> None:
+    """
+    Hotspots (stages and child programs), stragglers and core utilization of a trace.
+    """
+    records = read_trace(trace_file)
+    spans = [r for r in records if r['kind'] == 'span']
+    children = [r for r in records if r['kind'] == 'child']
+
+    stages = defaultdict(list)
+    for record in spans:
+        if record['stage'] != 'main':
+            stages[(record['script'], record['stage'])].append(record)
+    rows = []
+    for (script, stage), group in stages.items():
+        seconds = [r['seconds'] for r in group]
+        rows.append((
+            script, stage, len(group), sum(seconds), statistics.median(seconds), percentile(seconds, 0.95), max(seconds),
+            sum(r['cpu_self'] + r['cpu_children'] for r in group), max(max(r['max_rss_mb'], r['max_rss_children_mb']) for r in group),
+            sum(r['status'] != 'ok' for r in group),
+        ))
+    print_table(
+        'Hotspots: stages', ('script', 'stage', 'count', 'total_s', 'median_s', 'p95_s', 'max_s', 'cpu_s', 'max_rss_mb', 'failed'),
+        sorted(rows, key=lambda row: -row[3])[:top],
+    )
+
+    programs = defaultdict(list)
+    for record in children:
+        programs[(record['script'], record['program'])].append(record)
+    rows = [
+        (script, program, len(group), sum(r['seconds'] for r in group), sum(r['cpu'] for r in group),
+         max(r['max_rss_mb'] for r in group), sum(r['returncode'] != 0 for r in group))
+        for (script, program), group in programs.items()
+    ]
+    print_table(
+        'Hotspots: child processes', ('script', 'program', 'count', 'total_s', 'cpu_s', 'max_rss_mb', 'failed'),
+        sorted(rows, key=lambda row: -row[3])[:top],
+    )
+
+    rows = []
+    for (script, stage), group in stages.items():
+        items = [r for r in group if r['item'] is not None]
+        if len(items) < 5:
+            continue
+        median = statistics.median(r['seconds'] for r in items)
+        for record in items:
+            if median > 0 and record['seconds'] > 3 * median and record['seconds'] - median > STRAGGLER_MIN_SECONDS:
+                rows.append((script, stage, record['item'], record['seconds'], record['seconds'] / median))
+    print_table('Stragglers (> 3x the stage median)', ('script', 'stage', 'item', 'seconds', 'x_median'), sorted(rows, key=lambda row: -row[4])[:top])
+
+    rows = []
+    for record in (r for r in spans if r['stage'] == 'main'):
+        run_cores = cores or record.get('cores') or os.cpu_count()
+        cpu = record['cpu_self'] + record['cpu_children']
+        rows.append((record['script'], record['pid'], record['seconds'], cpu, cpu / max(record['seconds'], 1e-9), run_cores, cpu / max(record['seconds'], 1e-9) / run_cores, record['status']))
+    print_table('Core utilization (main spans)', ('script', 'pid', 'wall_s', 'cpu_s', 'effective_cores', 'cores', 'utilization', 'status'), rows)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    report(args['TRACE'], top=int(args['--top']), cores=int(args['--cores']) if args['--cores'] else None)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Concatenate the per-cluster alignments of run_msa.py into a partitioned supermatrix.
+
+Clusters are read from the 'renamed_fasta_names.csv' manifest, their alignment
+is ALIGNMENT_DIR/<cluster fasta>.aln.fasta. Rows are genomes (the header part
+before the first '#' of 'GENOME#CLUSTER'), a genome missing from a cluster gets
+gaps for that cluster. Sequences are written uppercase (as the masked alignments).
+
+Two passes over the alignments, clusters in parallel in both: the first one
+only reads headers and lengths (genomes and columns of every cluster), then
+PREFIX.fasta is written filled with gaps (one line per genome) and the second
+one writes every cluster into its columns of the file through a memory map.
+Workers fill chunks of consecutive clusters (up to FILL_CHUNK_BYTES of the
+matrix, so a row is written in few pages) and then drop the written pages from
+their mapping: memory is bounded by one chunk and the largest cluster
+alignment, not by the matrix.
+
+Outputs:
+    PREFIX.fasta            Concatenated alignment.
+    PREFIX.partitions.txt   RAxML partition file ('DNA, CLUSTER = START-END'), also read by IQ-TREE (-p/-q).
+    PREFIX.clusters.tsv     cluster, alignment, start, end, genomes (occupancy of every partition).
+
+Usage:
+    supermatrix.py ( --manifest=PATH ) ( --alignment_dir=PATH ) ( --output_prefix=PATH ) [ --threads=N ] [ --rooted_only ]
+
+Options:
+    --manifest=PATH         'renamed_fasta_names.csv' of the cluster multifastas.
+    --alignment_dir=PATH    Output dir of run_msa.py.
+    --output_prefix=PATH    Prefix of the output files.
+    --threads=N             Clusters read in parallel [default: 1].
+    --rooted_only           Only concatenate the clusters marked 'rooted' in the manifest.
+"""
+
+import os
+import mmap
+import logging
+from multiprocessing import Pool
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+import numpy as np
+from docopt import docopt
+
+import stage_trace
+from cluster_manifest import read_manifest, slugify
+from alignment_mask import read_alignment
+from run_msa import aln_output_file
+
+GAP = b'-'
+WRITE_CHUNK = 1 << 20
+FILL_CHUNK_BYTES = 64 << 20
+
+# Supermatrix memory map (and its array view) and row offsets of a worker (see init_worker).
+MATRIX_MMAP = None
+MATRIX = None
+ROW_OFFSETS = None
+
+
+def genome_id(header: str) -> str:
+    return header.split('#', 1)[0]
+
+
+def alignment_shape(aln_file: str) -> tuple:
+    """
+    (genome ids, columns) of an alignment, without keeping its sequences.
+    """
+    genomes, lengths, length = [], set(), 0
+    with open(aln_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if genomes:
+                    lengths.add(length)
+                genomes.append(genome_id(line[1:].rstrip(b'\r\n').decode()))
+                length = 0
+            else:
+                length += len(line.strip())
+        if genomes:
+            lengths.add(length)
+    assert len(lengths) <= 1, 'Sequences of {} have different lengths: {}'.format(aln_file, sorted(lengths))
+    return genomes, lengths.pop() if lengths else 0
+
+
+def scan_cluster(job: tuple) -> tuple:
+    core_cluster, aln_file = job
+    with stage_trace.span('scan_cluster', item=core_cluster):
+        genomes, columns = alignment_shape(aln_file)
+    return core_cluster, aln_file, genomes, columns
+
+
+def list_clusters(manifest_file: str, alignment_dir: str, rooted_only: bool = False) -> list:
+    """
+    [(core_cluster, alignment file), ...] of the manifest, sorted by cluster; missing alignments are logged and left out.
+    """
+    clusters = []
+    for core_cluster, entry in sorted(read_manifest(manifest_file).items()):
+        if rooted_only and entry.rooted != 'rooted':
+            continue
+        aln_file = aln_output_file(entry.path, alignment_dir)
+        if not os.path.exists(aln_file):
+            logger.warning('No alignment for cluster {}: {}'.format(core_cluster, aln_file))
+            continue
+        clusters.append((core_cluster, aln_file))
+    return clusters
+
+
+def row_offsets(genomes: list, columns: int) -> tuple:
+    """
+    ({genome: offset of its sequence in PREFIX.fasta}, file size) of the one line per genome layout.
+    """
+    offsets, position = {}, 0
+    for genome in genomes:
+        position += len('>{}\n'.format(genome).encode())
+        offsets[genome] = position
+        position += columns + 1
+    return offsets, position
+
+
+def write_gap_matrix(output_file: str, genomes: list, columns: int) -> None:
+    chunk = GAP * min(columns, WRITE_CHUNK)
+    with open(output_file, 'wb') as f_out:
+        for genome in genomes:
+            f_out.write('>{}\n'.format(genome).encode())
+            for _ in range(columns // len(chunk) if chunk else 0):
+                f_out.write(chunk)
+            f_out.write(chunk[:columns % len(chunk)] if chunk else b'')
+            f_out.write(b'\n')
+
+
+def init_worker(output_file: str, offsets: dict) -> None:
+    global MATRIX_MMAP, MATRIX, ROW_OFFSETS
+    with open(output_file, 'r+b') as f:
+        MATRIX_MMAP = mmap.mmap(f.fileno(), 0)
+    MATRIX = np.frombuffer(MATRIX_MMAP, dtype=np.uint8)
+    ROW_OFFSETS = offsets
+
+
+def fill_cluster(job: tuple) -> int:
+    """
+    Write the rows of one cluster alignment at its columns of the supermatrix, returns the duplicated genomes skipped.
+    """
+    core_cluster, aln_file, start = job
+    with stage_trace.span('fill_cluster', item=core_cluster):
+        headers, matrix = read_alignment(aln_file)
+        seen = set()
+        for header, row in zip(headers, matrix):
+            genome = genome_id(header)
+            if genome in seen:
+                continue
+            seen.add(genome)
+            offset = ROW_OFFSETS[genome] + start
+            MATRIX[offset:offset + len(row)] = row
+    return len(headers) - len(seen)
+
+
+def fill_chunk(jobs: list) -> int:
+    duplicated = sum(map(fill_cluster, jobs))
+    # Shared file mapping: the written pages stay in the page cache, they are only dropped from this worker.
+    MATRIX_MMAP.madvise(mmap.MADV_DONTNEED)
+    return duplicated
+
+
+def fill_chunks(partitions: list, genomes: int, chunk_bytes: int) -> list:
+    """
+    Fill jobs [(core_cluster, alignment, start), ...] of consecutive partitions, about chunk_bytes of the matrix each.
+    """
+    chunks, chunk, size = [], [], 0
+    for core_cluster, aln_file, start, columns, _ in partitions:
+        chunk.append((core_cluster, aln_file, start))
+        size += columns * genomes
+        if size >= chunk_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    return chunks + [chunk] if chunk else chunks
+
+
+def build(manifest_file: str, alignment_dir: str, output_prefix: str, threads: int = 1, rooted_only: bool = False) -> dict:
+    """
+    Write the supermatrix files of the manifest clusters, returns their sizes.
+    """
+    clusters = list_clusters(manifest_file, alignment_dir, rooted_only=rooted_only)
+    assert clusters, 'No cluster alignments found for {} in {}'.format(manifest_file, alignment_dir)
+
+    with Pool(threads) as pool:
+        shapes = pool.map(scan_cluster, clusters, chunksize=max(1, len(clusters) // (threads * 8)))
+
+    genomes, partitions, start = set(), [], 0
+    for core_cluster, aln_file, cluster_genomes, columns in shapes:
+        if not columns:
+            logger.warning('Empty alignment for cluster {}: {}'.format(core_cluster, aln_file))
+            continue
+        genomes.update(cluster_genomes)
+        partitions.append((core_cluster, aln_file, start, columns, len(set(cluster_genomes))))
+        start += columns
+    genomes, total_columns = sorted(genomes), start
+    logger.info('Supermatrix of {} genomes x {} columns from {} clusters.'.format(len(genomes), total_columns, len(partitions)))
+
+    output_file = output_prefix + '.fasta'
+    offsets, size = row_offsets(genomes, total_columns)
+    write_gap_matrix(output_file + '.tmp', genomes, total_columns)
+    assert os.path.getsize(output_file + '.tmp') == size, 'Unexpected supermatrix size.'
+
+    # Small enough chunks to keep every worker busy.
+    chunks = fill_chunks(partitions, len(genomes), min(FILL_CHUNK_BYTES, size // (threads * 4) + 1))
+    with Pool(threads, initializer=init_worker, initargs=(output_file + '.tmp', offsets)) as pool:
+        duplicated = sum(pool.imap_unordered(fill_chunk, chunks))
+    if duplicated:
+        logger.warning('{} duplicated genome rows skipped (first one of each genome kept).'.format(duplicated))
+    os.replace(output_file + '.tmp', output_file)
+
+    with open(output_prefix + '.partitions.txt', 'w') as f_out:
+        for core_cluster, _, start, columns, _ in partitions:
+            f_out.write('DNA, {} = {}-{}\n'.format(slugify(core_cluster), start + 1, start + columns))
+    with open(output_prefix + '.clusters.tsv', 'w') as f_out:
+        for core_cluster, aln_file, start, columns, cluster_genomes in partitions:
+            f_out.write('{}\t{}\t{}\t{}\t{}\n'.format(core_cluster, aln_file, start + 1, start + columns, cluster_genomes))
+
+    occupancy = sum(columns * cluster_genomes for _, _, _, columns, cluster_genomes in partitions) / max(1, len(genomes) * total_columns)
+    logger.info('Wrote {} ({:.1%} of the cells filled) and {}.'.format(output_file, occupancy, output_prefix + '.partitions.txt'))
+    return {'genomes': len(genomes), 'columns': total_columns, 'clusters': len(partitions), 'occupancy': occupancy}
+
+
+def main(manifest, alignment_dir, output_prefix, threads, rooted_only, *args, **kwargs):
+    build(manifest, alignment_dir, output_prefix, threads=int(threads), rooted_only=rooted_only)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        datefmt='%Y-%m-%d %H:%M:%S',
+        )
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    with stage_trace.span('main', whole_process=True):
+        main(**clean_args(docopt(__doc__)))
@@ -1,28 +1,104 @@
-#!/usr/bin/env bash
+#!/usr/bin/env python3
+"""
+Replace the masked leaf labels of Newick trees (e.g. the FastME tree of the
+dist2fastme.py masks, or gene-tree collections for ASTRAL/wASTRID).
 
+Labels are rewritten in the Newick text (newick_stream.py), every tree of a
+multi-tree file is relabeled and branch lengths/support values are kept as written.
 
+Usage:
+    unmask_tree.py [ --invert ] [ --strict ] MASK TREE
+    unmask_tree.py [ --invert ] [ --strict ] [ --suffix=STR ] [ --threads=INT ] ( --output_dir=PATH ) MASK TREE...
+
+Options:
+    MASK               Tab separated mask file, one 'masked_label<TAB>label' per line.
+    TREE               Newick file(s), or directories of newick files (batch mode, needs --output_dir).
+    --invert           Mask columns are 'label<TAB>masked_label' (the dist2fastme.py mask file).
+    --strict           Fail when a leaf label is not in the mask (unknown labels are kept and reported otherwise).
+    --suffix=STR       Suffix of the newick files of input directories [default: .nwk].
+    --threads=INT      Files relabeled in parallel [default: 1].
+    --output_dir=PATH  Dir for the relabeled trees (same file names as the inputs).
+"""
+
+import os
 import sys
-from Bio import Phylo
-from Bio.Phylo.NewickIO import parse
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+logger = logging.getLogger(os.path.basename(__file__).replace('.py', ''))
+
+from docopt import docopt
+
+from newick_stream import relabel
+
+# masked label -> label of a worker (see init_mask).
+LABELS = None
+
+
+def read_mask(mask_file, invert=False):
+    with open(mask_file) as f:
+        pairs = map(lambda line: line.rstrip('\n').split('\t')[:2], filter(str.strip, f))
+        return { v : k for k, v in pairs } if invert else dict(pairs)
+
+def init_mask(mask):
+    global LABELS
+    LABELS = mask
+
+def relabel_file(tree_file, output_file=None):
+    """
+    Relabel tree_file into output_file (stdout if None), returns (tree_file, trees, unknown labels).
+    """
+    unknown = set()
+    with open(tree_file) as f_in:
+        if output_file is None:
+            trees = relabel(f_in, sys.stdout, LABELS, unknown)
+        else:
+            tmp_file = output_file + '.tmp'
+            with open(tmp_file, 'w') as f_out:
+                trees = relabel(f_in, f_out, LABELS, unknown)
+            os.replace(tmp_file, output_file)
+    return tree_file, trees, unknown
 
-def main(mask, tree):
-    # read in the tree and parse it into a tree object
-    with open(tree) as nj:
-        tree = next(parse(nj))
+def list_tree_files(trees, suffix):
+    for tree in trees:
+        if os.path.isdir(tree):
+            yield from sorted(map(str, Path(tree).glob('*' + suffix)))
+        else:
+            yield tree
 
-    # read in the mask file and create a dictionary mapping the original names to the new names
-    with open(mask) as f:
-        mask = dict(map(lambda line: line.strip().split('\t'), f))
+def report_unknown(results, strict):
+    unknown = {}
+    for tree_file, _, labels in results:
+        for label in labels:
+            unknown.setdefault(label, []).append(tree_file)
+    for label, tree_files in sorted(unknown.items()):
+        logger.warning("Label not in mask: '{}' ({} files, e.g. {})".format(label, len(tree_files), tree_files[0]))
+    assert not (strict and unknown), '{} labels not in the mask.'.format(len(unknown))
 
-    # iterate through the tree and replace the names of the nodes with the new names from the mask
-    for node in tree.get_terminals():
-        node.name = mask[node.name]
+def main(MASK, TREE, invert, strict, suffix, threads, output_dir, *args, **kwargs):
+    mask = read_mask(MASK, invert=invert)
+    init_mask(mask)
 
-    # write the modified tree to a new file
-    # Phylo.write(tree, "modified_tree.nwk", "newick")
-    print(tree.format('newick'))
+    if output_dir is None:
+        assert len(TREE) == 1 and not os.path.isdir(TREE[0]), 'Batch mode needs --output_dir.'
+        results = [relabel_file(TREE[0])]
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        tree_files = list(list_tree_files(TREE, suffix))
+        output_files = [os.path.join(output_dir, os.path.basename(tree_file)) for tree_file in tree_files]
+        assert len(set(output_files)) == len(output_files), 'Input trees with the same file name, they would overwrite each other in {}.'.format(output_dir)
+        with Pool(int(threads), initializer=init_mask, initargs=(mask,)) as pool:
+            results = pool.starmap(relabel_file, zip(tree_files, output_files), chunksize=16)
+        logger.info('Relabeled {} trees in {} files.'.format(sum(trees for _, trees, _ in results), len(results)))
 
+    report_unknown(results, strict)
 
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s][%(asctime)s][%(levelname)s] %(message)s",
+        datefmt='%Y-%m-%d %H:%M:%S',
+        )
+    clean_args = lambda args: { k.replace('-', '') : v for k, v in args.items() }
+    main(**clean_args(docopt(__doc__)))
@@ -1,24 +1,34 @@
-import Bio
-from Bio import Phylo
-from Bio.Phylo.NewickIO import _translate_name
-read in newick file
+#!/usr/bin/env python3
+"""
+Replace the leaf names of a newick tree with the names of a replacements file
+('original<TAB>replacement' per line).
 
-tree = Phylo.read("tree.nwk", "newick")
-open txt file with name replacements
+Usage:
+    unmaske_newick.py [ TREE ] [ REPLACEMENTS ] [ OUTPUT ]
 
-with open("name_replacements.txt") as f:
-replacements = {}
-for line in f:
-original, replacement = line.strip().split("\t")
-replacements[original] = replacement
-translate names in newick tree using name replacements
+Defaults: 'tree.nwk', 'name_replacements.txt' and 'modified_tree.nwk'. See unmask_tree.py
+for batch mode and reports of unknown labels.
+"""
 
-for clade in tree.find_clades():
-if clade.name:
-clade.name = _translate_name(replacements, clade.name)
-write modified tree to new file
+import sys
 
-Phylo.write(tree, "modified_tree.nwk", "newick")
+from newick_stream import relabel
 
-print("Name replacements complete!")
 
+def main(tree='tree.nwk', name_replacements='name_replacements.txt', output='modified_tree.nwk'):
+    # read name replacements
+    with open(name_replacements) as f:
+        replacements = dict(map(lambda line: line.strip().split('\t'), filter(str.strip, f)))
+
+    # translate names in the newick text and write the modified tree to a new file
+    unknown = set()
+    with open(tree) as f_in, open(output, 'w') as f_out:
+        relabel(f_in, f_out, replacements, unknown)
+
+    if unknown:
+        print('{} names without replacement kept as is.'.format(len(unknown)), file=sys.stderr)
+    print("Name replacements complete!")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Columns kept by the native alignment mask (alignment_mask.py) on a hand-made
+alignment; the comparison with 'qiime alignment mask' is bench_alignment_mask.py --check_qiime.
+
+Run: python -m pytest workflow/tests
+"""
+
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from alignment_mask import read_alignment, compute_mask, mask_alignment_file
+
+# Column:          0123456
+ALIGNMENT = [
+    ('s0',        'AAAA-aA'),
+    ('s1',        'AACA-A.'),
+    ('s2',        'ACG--c.'),
+    ('s3',        'ACT--CA'),
+    ('s4',        'AG---GA'),
+]
+# Gap frequency:   0 0 .2 .6 1 0 .4  ('.' is a gap)
+# Conservation:    1 .4 .2 .4 0 .4 .6  (case-insensitive: column 5 is A A C C G)
+
+
+@pytest.fixture
+def alignment_file(tmp_path):
+    with open(tmp_path / 'gene.fasta', 'w') as f_out:
+        f_out.writelines('>{}\n{}\n'.format(header, sequence) for header, sequence in ALIGNMENT)
+    return str(tmp_path / 'gene.fasta')
+
+
+@pytest.mark.parametrize('max_gap_frequency, min_conservation, kept', [
+    (1.0, 0.4, [0, 1, 3, 5, 6]),
+    # Gap frequency <= max_gap_frequency.
+    (0.4, 0.4, [0, 1, 5, 6]),
+    (0.39, 0.4, [0, 1, 5]),
+    (0.2, 0.2, [0, 1, 2, 5]),
+    # Conservation >= min_conservation.
+    (1.0, 0.41, [0, 6]),
+    (1.0, 0.6, [0, 6]),
+    (1.0, 0.61, [0]),
+    # An all-gap column passes the gap filter at 1.0 but has no conserved character.
+    (1.0, 0.2, [0, 1, 2, 3, 5, 6]),
+])
+def test_kept_columns(alignment_file, max_gap_frequency, min_conservation, kept):
+    _, matrix = read_alignment(alignment_file)
+    mask = compute_mask(matrix, max_gap_frequency=max_gap_frequency, min_conservation=min_conservation)
+    assert [idx for idx, keep in enumerate(mask) if keep] == kept
+
+
+def test_masked_alignment_is_uppercase(alignment_file, tmp_path):
+    assert mask_alignment_file(alignment_file, str(tmp_path / 'gene.masked.fasta')) == (5, 7)
+    with open(tmp_path / 'gene.masked.fasta') as f:
+        assert f.read() == '>s0\nAAAAA\n>s1\nAAAA.\n>s2\nAC-C.\n>s3\nAC-CA\n>s4\nAG-GA\n'
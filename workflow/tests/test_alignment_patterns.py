@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+The alignment reduction (alignment_patterns.py) does not change the tree: on a
+small simulated alignment with clonal groups, the weighted site patterns give
+the distances of the full alignment, neighbor joining finds the same splits and
+the duplicates are grafted back as zero-length sisters.
+
+Run: python -m pytest workflow/tests
+"""
+
+import io
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from Bio import Phylo
+from Bio.Phylo.TreeConstruction import DistanceMatrix, DistanceTreeConstructor
+
+import newick_stream
+from alignment_mask import read_alignment, write_alignment
+from alignment_patterns import reduce_alignment_file, read_duplicates, graft_tree_file
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def simulate_alignment(rng, taxa=12, columns=400, rate=0.05, max_copies=4):
+    """
+    (headers, matrix, clonal group of each header): sequences evolved on a random tree, then copied.
+    """
+    nodes = [rng.choice(BASES, columns)]
+    while len(nodes) < taxa:
+        parent = nodes.pop(rng.integers(len(nodes)))
+        for _ in range(2):
+            child = parent.copy()
+            mutated = rng.random(columns) < rate
+            child[mutated] = rng.choice(BASES, int(mutated.sum()))
+            nodes.append(child)
+    headers, rows, groups = [], [], []
+    for idx, sequence in enumerate(nodes):
+        for copy in range(rng.integers(1, max_copies + 1)):
+            headers.append('G{:02d}_{}'.format(idx, copy))
+            rows.append(sequence)
+            groups.append(idx)
+    order = rng.permutation(len(headers))
+    return [headers[i] for i in order], np.array(rows)[order], [groups[i] for i in order]
+
+
+def p_distances(matrix, weights):
+    return np.array([((matrix != row) * weights).sum(axis=1) / weights.sum() for row in matrix])
+
+
+def nj_splits(headers, distances, bits):
+    lower = [list(distances[idx, :idx + 1]) for idx in range(len(headers))]
+    tree = DistanceTreeConstructor().nj(DistanceMatrix(list(headers), lower))
+    for clade in tree.get_nonterminals():
+        clade.name = None
+    counts, _ = newick_stream.count_splits(io.StringIO(tree.format('newick')), bits)
+    return set(counts)
+
+
+def reduce(tmp_path, seed):
+    headers, matrix, groups = simulate_alignment(np.random.default_rng(seed))
+    # Fully undetermined columns are dropped by the reduction.
+    matrix[:, 10:15] = ord('-')
+    write_alignment(headers, matrix, str(tmp_path / 'gene.fasta'))
+    prefix = str(tmp_path / 'gene.reduced')
+    sizes = reduce_alignment_file(str(tmp_path / 'gene.fasta'), prefix)
+    reduced_headers, reduced = read_alignment(prefix + '.fasta')
+    with open(prefix + '.weights') as f:
+        weights = np.array(f.read().split(), dtype=np.int64)
+    return headers, matrix, groups, prefix, sizes, reduced_headers, reduced, weights
+
+
+def test_clonal_groups_and_site_patterns(tmp_path):
+    headers, matrix, groups, prefix, sizes, reduced_headers, reduced, weights = reduce(tmp_path, seed=1)
+
+    assert len(reduced_headers) == sizes['unique_rows'] == len(set(groups))
+    assert sizes['determined_columns'] == matrix.shape[1] - 5 == weights.sum()
+    assert sizes['patterns'] == reduced.shape[1] < sizes['determined_columns']
+    duplicates = read_duplicates(prefix + '.duplicates.tsv')
+    assert sum(map(len, duplicates.values())) == len(headers) - len(reduced_headers)
+    assert all(groups[headers.index(duplicate)] == groups[headers.index(representative)]
+               for representative, group in duplicates.items() for duplicate in group)
+
+    keep = [headers.index(header) for header in reduced_headers]
+    determined = matrix[keep][:, [idx for idx in range(matrix.shape[1]) if not 10 <= idx < 15]]
+    assert np.allclose(p_distances(determined, np.ones(determined.shape[1])), p_distances(reduced, weights))
+
+
+def test_neighbor_joining_splits_unchanged(tmp_path):
+    for seed in (1, 2, 3):
+        headers, matrix, _, _, _, reduced_headers, reduced, weights = reduce(tmp_path, seed)
+        keep = [headers.index(header) for header in reduced_headers]
+        bits = newick_stream.leaf_bits('({});'.format(','.join(reduced_headers)))
+
+        full_splits = nj_splits(reduced_headers, p_distances(matrix[keep], np.ones(matrix.shape[1])), bits)
+        assert full_splits
+        assert nj_splits(reduced_headers, p_distances(reduced, weights), bits) == full_splits
+
+
+def test_duplicates_grafted_as_zero_length_sisters(tmp_path):
+    headers, _, _, prefix, _, reduced_headers, _, _ = reduce(tmp_path, seed=1)
+    with open(prefix + '.tree', 'w') as f_out:
+        f_out.write('({});\n({});\n'.format(
+            ','.join('{}:0.1'.format(header) for header in reduced_headers),
+            ','.join(reversed(reduced_headers)),
+        ))
+
+    assert graft_tree_file(prefix + '.tree', prefix + '.duplicates.tsv', prefix + '.grafted.tree') == 2
+    duplicates = read_duplicates(prefix + '.duplicates.tsv')
+    for tree in Phylo.parse(prefix + '.grafted.tree', 'newick'):
+        assert sorted(leaf.name for leaf in tree.get_terminals()) == sorted(headers)
+        for representative, group in duplicates.items():
+            clade = tree.common_ancestor(representative, *group)
+            assert sorted(leaf.name for leaf in clade.get_terminals()) == sorted([representative] + group)
+            assert all(not leaf.branch_length for leaf in clade.get_terminals())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+The streaming CDS extractor (gbk_cds.py) gives the same (locus_tag, sequence)
+pairs as Bio.SeqIO + feature.location.extract on a small GenBank file.
+
+Run: python -m pytest workflow/tests
+"""
+
+import io
+import os
+import sys
+import gzip
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from Bio import SeqIO
+
+import gbk_cds
+
+# (feature lines, with prokka's indentation) of each record; the sequence is random.
+RECORDS = {
+    'contig_1': '''\
+     source          1..120
+                     /mol_type="genomic DNA"
+     gene            3..20
+                     /locus_tag="TEST_00001"
+     CDS             complement(3..20)
+                     /locus_tag="TEST_00001"
+                     /product="complement"
+     CDS             join(1..10,30..40,52..60,70..75,80..90,95..99,100..105,
+                     110..115)
+                     /locus_tag="TEST_00002"
+                     /product="join wrapping across lines"
+     CDS             complement(join(5..10,20..30))
+                     /locus_tag="TEST_00003"
+     CDS             join(complement(40..50),complement(10..20))
+                     /locus_tag="TEST_00004"
+     CDS             <1..>15
+                     /locus_tag="TEST_00005"
+                     /note="fuzzy ends"
+     CDS             order(1..5,10..15)
+                     /locus_tag="TEST_00006"
+     CDS             20..40
+                     /product="no locus_tag"
+     CDS             complement(<100..120)
+                     /locus_tag="TEST_00007"
+''',
+    'contig_2': '''\
+     source          1..90
+                     /mol_type="genomic DNA"
+     CDS             join(1..9,
+                     20..29)
+                     /locus_tag="TEST_00008"
+     tRNA            40..60
+                     /locus_tag="TEST_00009"
+     CDS             complement(61..>90)
+                     /locus_tag="TEST_00010"
+''',
+    'contig_3': '''\
+     source          1..60
+                     /mol_type="genomic DNA"
+''',
+}
+
+
+def origin(sequence):
+    lines = []
+    for start in range(0, len(sequence), 60):
+        blocks = [sequence[idx:idx + 10] for idx in range(start, min(start + 60, len(sequence)), 10)]
+        lines.append('{:>9} {}\n'.format(start + 1, ' '.join(blocks)))
+    return ''.join(lines)
+
+
+def genbank_text():
+    rng = random.Random(42)
+    text = []
+    for name, features in RECORDS.items():
+        length = int(features.split('source', 1)[1].split('..', 1)[1].split()[0])
+        sequence = ''.join(rng.choice('acgt') for _ in range(length))
+        text.append(
+            'LOCUS       {:<16} {:>11} bp    DNA     linear       20-OCT-2026\n'.format(name, length)
+            + 'DEFINITION  {}.\n'.format(name)
+            + 'FEATURES             Location/Qualifiers\n'
+            + features
+            + 'ORIGIN\n'
+            + origin(sequence)
+            + '//\n'
+        )
+    return ''.join(text)
+
+
+def biopython_cds(text):
+    return [
+        (feature.qualifiers['locus_tag'][0], str(feature.location.extract(record).seq))
+        for record in SeqIO.parse(io.StringIO(text), 'genbank')
+        for feature in record.features
+        if feature.type == 'CDS' and feature.qualifiers.get('locus_tag', None)
+    ]
+
+
+def test_same_cds_as_biopython():
+    text = genbank_text()
+    expected = biopython_cds(text)
+
+    assert [tag for tag, _ in expected] == ['TEST_{:05d}'.format(idx) for idx in (1, 2, 3, 4, 5, 6, 7, 8, 10)]
+    assert list(gbk_cds.iter_cds(io.StringIO(text))) == expected
+
+
+def test_locus_tags_filter(tmp_path):
+    text = genbank_text()
+    with gzip.open(tmp_path / 'genome.gbk.gz', 'wt') as f_out:
+        f_out.write(text)
+    wanted = {'TEST_00003', 'TEST_00010', 'TEST_00009'}
+
+    observed = list(gbk_cds.iter_cds_from_file(str(tmp_path / 'genome.gbk.gz'), locus_tags=wanted))
+    assert observed == [(tag, sequence) for tag, sequence in biopython_cds(text) if tag in wanted]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Alignments with too few distinct sequences for raxml are not reduced
+(convert_mask_and_run_phylogeny.py --reduce_alignment).
+
+Run: python -m pytest workflow/tests
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import convert_mask_and_run_phylogeny as phylogeny
+
+
+def write_masked(tmp_path, sequences):
+    with open(tmp_path / 'gene.masked.fasta', 'w') as f_out:
+        f_out.writelines('>g{}#gene\n{}\n'.format(idx, sequence) for idx, sequence in enumerate(sequences))
+    # The artifact is not read: the native mask fasta next to it is.
+    (tmp_path / 'gene.masked.qza').touch()
+    return str(tmp_path / 'gene.masked.qza')
+
+
+def test_two_distinct_sequences_use_the_masked_alignment(tmp_path, monkeypatch):
+    masked = write_masked(tmp_path, ['ACGTACGT', 'ACGTACGT', 'ACGTACGA', 'ACGTACGT', 'ACGTACGA'])
+
+    assert phylogeny.reduce_masked_alignment(masked, str(tmp_path)) == masked
+    assert not [name for name in os.listdir(tmp_path) if '.reduced.' in name]
+
+    calls = []
+    monkeypatch.setattr(phylogeny, 'run_raxml', lambda input_file, output_dir, threads, bootstrap=None, backend='cli': calls.append(('raxml', input_file, bootstrap)) or 'gene.GTRCAT.BS.tree.qza')
+    monkeypatch.setattr(phylogeny, 'extract_tree_from_qiime2', lambda input_file, output_dir, backend='cli': calls.append(('extract', input_file)) or 'gene.GTRCAT.BS.tree')
+
+    assert phylogeny.run_raxml_reduced(masked, str(tmp_path), 2, bootstrap=10) == 'gene.GTRCAT.BS.tree'
+    assert calls == [('raxml', masked, 10), ('extract', 'gene.GTRCAT.BS.tree.qza')]
+
+
+def test_four_distinct_sequences_are_reduced(tmp_path):
+    masked = write_masked(tmp_path, ['ACGTACGT', 'ACGTACGA', 'ACGTACCA', 'TCGTACGT', 'ACGTACGT'])
+
+    reduced = phylogeny.reduce_masked_alignment(masked, str(tmp_path))
+    assert reduced == str(tmp_path / 'gene.reduced.fasta')
+    with open(tmp_path / 'gene.reduced.duplicates.tsv') as f:
+        assert f.read() == 'g0#gene\tg4#gene\n'